@@ -0,0 +1,5 @@
+# Created by Qingzhi Ma at 2019-07-23
+# All right reserved
+# Department of Computer Science
+# the University of Warwick
+# Q.Ma.2@warwick.ac.uk
\ No newline at end of file
@@ -0,0 +1,176 @@
+# Created by Qingzhi Ma at 2019-07-27
+# All right reserved
+# Department of Computer Science
+# the University of Warwick
+# Q.Ma.2@warwick.ac.uk
+"""
+A reproducible benchmark of DBEst: build time, query latency and accuracy on synthetic data.
+
+    python -m dbestclient.benchmark.benchmark --rows 1000000 --groups 20 --skew 1 --output results.json
+
+The data is generated with a fixed seed, models are built with CREATE TABLE, and random range queries are answered
+with COUNT, SUM and AVG, with and without GROUP BY. Estimates are compared with the exact answers computed from the
+same data, and the results are written as JSON.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import tempfile
+
+import numpy as np
+
+from dbestclient.benchmark.datagen import generate_csv
+from dbestclient.cli.prompt import config as default_config
+from dbestclient.executor.executor import SqlExecutor
+
+FUNCS = ["count", "sum", "avg"]
+PERCENTILES = [50, 90, 99]
+
+
+def get_exact_answers(x, y, z, x_lb, x_ub):
+    """
+    :return: {func: exact answer}, and {func: {group: exact answer}}, over the rows with x in [x_lb, x_ub].
+    """
+    mask = (x >= x_lb) & (x <= x_ub)
+    count = float(mask.sum())
+    total = float(y[mask].sum())
+    exact = {'count': count, 'sum': total, 'avg': total / count if count else None}
+
+    n_group = int(z.max()) + 1
+    counts = np.bincount(z[mask], minlength=n_group)
+    totals = np.bincount(z[mask], weights=y[mask], minlength=n_group)
+    exact_groups = {func: {} for func in FUNCS}
+    for group in range(n_group):
+        exact_groups['count'][str(group)] = float(counts[group])
+        exact_groups['sum'][str(group)] = float(totals[group])
+        exact_groups['avg'][str(group)] = float(totals[group] / counts[group]) if counts[group] else None
+    return exact, exact_groups
+
+
+def get_relative_error(estimate, exact):
+    if estimate is None or exact is None or exact == 0:
+        return None
+    return abs(estimate - exact) / abs(exact)
+
+
+def summarize(values):
+    """
+    :return: the mean and the percentiles of the values, ignoring None.
+    """
+    values = np.array([value for value in values if value is not None], dtype=float)
+    if len(values) == 0:
+        return None
+    summary = {'mean': float(values.mean()), 'n': int(len(values))}
+    for percentile in PERCENTILES:
+        summary['p%d' % percentile] = float(np.percentile(values, percentile))
+    return summary
+
+
+def run_benchmark(n_row=100000, n_group=10, skew=0.0, sample_size=10000, n_query=100, n_warmup=5, seed=0,
+                  warehousedir=None, config=None):
+    """
+    run the benchmark, see the module documentation.
+
+    :param n_row: the number of rows of the synthetic table.
+    :param n_group: the number of groups.
+    :param skew: the skew of the data, see generate_csv().
+    :param sample_size: the SIZE of the models.
+    :param n_query: the number of random ranges, each queried with every aggregate function.
+    :param n_warmup: the number of queries run before timing, to load the models.
+    :param seed: the seed of the data and of the queries.
+    :param warehousedir: the warehouse to use, a temporary directory (removed afterwards) by default.
+    :param config: settings overriding the default configuration.
+    :return: the results, as a dict.
+    """
+    b_temporary = warehousedir is None
+    if b_temporary:
+        warehousedir = tempfile.mkdtemp(prefix="dbest_benchmark_")
+    elif not os.path.exists(warehousedir):
+        os.makedirs(warehousedir)
+    settings = dict(default_config, warehousedir=warehousedir, b_result_cache=False,
+                    b_sample_cache=False)
+    settings.update(config or {})
+
+    try:
+        x, y, z = generate_csv(os.path.join(warehousedir, "benchmark.csv"), n_row, n_group=n_group, skew=skew,
+                               seed=seed, split_char=settings['csv_split_char'])
+        sqlExecutor = SqlExecutor(settings)
+
+        # build the models, with and without group by
+        build = {}
+        for name, groupby in [("simple", ""), ("groupby", " group by z")]:
+            result = sqlExecutor.run("create table bm_%s(y real, x real) from benchmark.csv%s method uniform size %d"
+                                     % (name, groupby, sample_size))
+            if result.status != "OK":
+                raise RuntimeError(result.message)
+            build[name] = dict(result.stages, total=result.latency)
+
+        # random ranges, covering 5% to 50% of the domain of x
+        rng = np.random.RandomState(seed + 1)
+        widths = rng.uniform(5, 50, size=n_query + n_warmup)
+        x_lbs = rng.uniform(0, 100 - widths)
+        ranges = list(zip(np.round(x_lbs, 3), np.round(x_lbs + widths, 3)))
+
+        queries = {}
+        for name, groupby in [("simple", ""), ("groupby", " group by z")]:
+            for func in FUNCS:
+                latencies, errors = [], []
+                for idx, (x_lb, x_ub) in enumerate(ranges):
+                    result = sqlExecutor.run("select %s(y) from bm_%s where x between %s and %s%s"
+                                             % (func, name, x_lb, x_ub, groupby))
+                    if idx < n_warmup:
+                        continue
+                    latencies.append(result.latency)
+                    exact, exact_groups = get_exact_answers(x, y, z, x_lb, x_ub)
+                    if name == "simple":
+                        errors.append(get_relative_error(result.answer, exact[func]))
+                    else:
+                        errors.extend(get_relative_error(estimate, exact_groups[func].get(str(group)))
+                                      for group, estimate in result.answer.items())
+                queries["%s_%s" % (name, func)] = {'latency': summarize(latencies),
+                                                   'relative_error': summarize(errors)}
+        sqlExecutor.close()
+    finally:
+        if b_temporary:
+            shutil.rmtree(warehousedir, ignore_errors=True)
+
+    return {
+        'parameters': {'n_row': n_row, 'n_group': n_group, 'skew': skew, 'sample_size': sample_size,
+                       'n_query': n_query, 'n_warmup': n_warmup, 'seed': seed},
+        'config': {key: value for key, value in settings.items() if key != 'warehousedir'},
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                        'platform': platform.platform(), 'cpu_count': os.cpu_count()},
+        'build': build,
+        'queries': queries,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark DBEst on synthetic data.")
+    parser.add_argument('--rows', type=int, default=100000, help="the number of rows of the table.")
+    parser.add_argument('--groups', type=int, default=10, help="the number of groups.")
+    parser.add_argument('--skew', type=float, default=0.0, help="the skew of the group sizes and of x.")
+    parser.add_argument('--size', type=int, default=10000, help="the sample size of the models.")
+    parser.add_argument('--queries', type=int, default=100, help="the number of queries of each kind.")
+    parser.add_argument('--warmup', type=int, default=5, help="the number of queries run before timing.")
+    parser.add_argument('--seed', type=int, default=0, help="the seed of the data and of the queries.")
+    parser.add_argument('--warehouse', help="the warehouse directory, a temporary one by default.")
+    parser.add_argument('--config', help="settings overriding the default configuration, as JSON.")
+    parser.add_argument('--output', help="write the results to this JSON file, instead of printing them.")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.rows, args.groups, args.skew, args.size, args.queries, args.warmup, args.seed,
+                            warehousedir=args.warehouse,
+                            config=json.loads(args.config) if args.config is not None else None)
+    if args.output is None:
+        print(json.dumps(results, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("Results written to " + args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+# Created by Qingzhi Ma at 2019-07-27
+# All right reserved
+# Department of Computer Science
+# the University of Warwick
+# Q.Ma.2@warwick.ac.uk
+import numpy as np
+
+
+def generate_csv(file, n_row, n_group=10, skew=0.0, seed=0, split_char=",", chunk_size=1 << 20):
+    """
+    generate a synthetic table with the header y,x,z, written in chunks so that its size is not bounded by memory.
+
+    - z is the group, in 0..n_group-1, with Zipf sizes: the k-th group has a weight 1/(k+1)^skew.
+    - x is in [0, 100], Beta(2, 2 + 2*skew) distributed, shifted a little for each group.
+    - y = 2x + 10 sin(x/5) + 5 z/n_group + N(0, 5), so that the regression is not linear.
+
+    :param file: the path of the CSV file.
+    :param n_row: the number of rows.
+    :param n_group: the number of distinct values of z.
+    :param skew: 0 for uniform group sizes and a symmetric x, larger for more skewed data.
+    :param seed: the seed of the random generator, so that the same parameters give the same file.
+    :return: x, y, z, as arrays, to compute exact answers.
+    """
+    rng = np.random.RandomState(seed)
+    weights = 1.0 / np.arange(1, n_group + 1) ** skew
+    weights /= weights.sum()
+    xs, ys, zs = [], [], []
+    with open(file, 'w') as f:
+        f.write(split_char.join(["y", "x", "z"]) + "\n")
+        for start in range(0, n_row, chunk_size):
+            n = min(chunk_size, n_row - start)
+            z = rng.choice(n_group, size=n, p=weights)
+            x = np.clip(100 * rng.beta(2, 2 + 2 * skew, size=n) + 5 * (z / max(n_group - 1, 1) - 0.5), 0, 100)
+            y = 2 * x + 10 * np.sin(x / 5) + 5 * z / n_group + rng.normal(0, 5, size=n)
+            x = np.round(x, 3)
+            y = np.round(y, 3)
+            rows = np.char.add(np.char.add(np.char.add(np.char.add(y.astype(str), split_char), x.astype(str)),
+                                           split_char), z.astype(str))
+            f.write("\n".join(rows.tolist()) + "\n")
+            xs.append(x)
+            ys.append(y)
+            zs.append(z)
+    return np.concatenate(xs), np.concatenate(ys), np.concatenate(zs)
@@ -3,16 +3,224 @@
 # Department of Computer Science
 # the University of Warwick
 # Q.Ma.2@warwick.ac.uk
+from collections import OrderedDict
+import json
+import os
+import pickle
+import threading
+import time
+
+from dbestclient.ml.modelwraper import GroupByModelWrapper, deserialize_groupby_model_wrapper, \
+    deserialize_model_file, GroupByModelArchive, MODEL_FILE_EXTENSIONS, GROUPBY_ARCHIVE_EXTENSION
+from dbestclient.ml.modelformat import read_archive_index
+
+MANIFEST_FILE_NAME = "manifest.json"
 
 
 class DBEstModelCatalog:
-    def __init__(self):
-        self.model_catalog = {}
+    """
+    The catalog of the models in the warehouse.
+    The available models are listed in a small manifest file in the warehouse, so that startup only reads the
+    manifest. Models are loaded on first use, and the least recently used ones are evicted once the loaded models
+    exceed the memory budget, estimated from their size on disk.
+    """
+
+    def __init__(self, warehousedir=None, memory_budget=None):
+        """
+        :param warehousedir: the warehouse directory.
+        :param memory_budget: the maximum size of the loaded models, in bytes. None for no limit.
+        """
+        self.warehousedir = warehousedir
+        self.memory_budget = memory_budget
+        self.manifest = {}
+        # the loaded models, from the least to the most recently used.
+        self.model_catalog = OrderedDict()
+        self.memory_usage = 0
+        # the catalog is shared by the threads of the query server
+        self.lock = threading.RLock()
+
+    def load_manifest(self):
+        """
+        read the manifest of the warehouse, or build it by listing the warehouse if it does not exist yet.
+        The manifest is checked against the listing of the warehouse: the models whose files were deleted are
+        dropped from it, and those whose files were added are read into it.
+
+        :return: the number of models in the warehouse.
+        """
+        with self.lock:
+            manifest_file = os.path.join(self.warehousedir, MANIFEST_FILE_NAME)
+            manifest = {}
+            if os.path.exists(manifest_file):
+                with open(manifest_file, 'r') as f:
+                    manifest = json.load(f)
+            file_names = self._list_model_files()
+            for key in list(self.model_catalog):
+                if key not in file_names:
+                    self._uncache(key)
+            self.manifest = {key: entry for key, entry in manifest.items()
+                             if entry.get('path') in file_names.get(key, ())}
+            for key, names in file_names.items():
+                if key not in self.manifest:
+                    # a model saved in several formats is read from its latest file
+                    self.manifest[key] = self._read_entry(max(names, key=lambda name: os.path.getmtime(
+                        os.path.join(self.warehousedir, name))))
+            if self.manifest != manifest:
+                self.save_manifest()
+            return len(self.manifest)
 
-    def add_model_wrapper(self, model_wrapper):
-        if model_wrapper.groupby_value is None:
-            self.model_catalog[model_wrapper.init_pickle_file_name()] = model_wrapper
+    def _list_model_files(self):
+        """
+        :return: {key: [file names]}, the files of the models in the warehouse.
+        """
+        file_names = {}
+        for file_name in os.listdir(self.warehousedir):
+            path = os.path.join(self.warehousedir, file_name)
+            if file_name.endswith(GROUPBY_ARCHIVE_EXTENSION):
+                key = file_name[:-len(GROUPBY_ARCHIVE_EXTENSION)]
+            elif _get_model_format(file_name) is not None:
+                # models are known by their pickle file name, whatever their format
+                key = os.path.splitext(file_name)[0] + ".pkl"
+            # hidden directories, such as the sample cache, are not models
+            elif os.path.isdir(path) and not file_name.startswith(".") and \
+                    any(_get_model_format(name) is not None for name in os.listdir(path)):
+                key = file_name
+            else:
+                continue
+            file_names.setdefault(key, []).append(file_name)
+        return file_names
+
+    def _read_entry(self, file_name):
+        """
+        :return: the manifest entry of a model file of the warehouse.
+        """
+        path = os.path.join(self.warehousedir, file_name)
+        if file_name.endswith(GROUPBY_ARCHIVE_EXTENSION):
+            entry = {'type': 'groupby', 'path': file_name, 'size': os.path.getsize(path),
+                     'n_groups': len(read_archive_index(path)['groups']), 'format': 'dbm'}
+        elif os.path.isdir(path):
+            names = [name for name in os.listdir(path) if _get_model_format(name) is not None]
+            entry = {'type': 'groupby', 'path': file_name,
+                     'size': sum(os.path.getsize(os.path.join(path, name)) for name in names),
+                     'n_groups': len(names), 'format': _get_model_format(names[0])}
         else:
-            self.model_catalog[model_wrapper.dir]=model_wrapper.models
+            entry = {'type': 'simple', 'path': file_name, 'size': os.path.getsize(path),
+                     'format': _get_model_format(file_name)}
+        entry['version'] = _get_file_version(path)
+        return entry
+
+    def save_manifest(self):
+        manifest_file = os.path.join(self.warehousedir, MANIFEST_FILE_NAME)
+        with open(manifest_file + ".tmp", 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(manifest_file + ".tmp", manifest_file)
+
+    def add_model_wrapper(self, model_wrapper, model_format='pickle'):
+        """
+        register a model that has been serialized to the warehouse, and keep it loaded.
+
+        :param model_format: the format the model has been serialized in, 'pickle' or 'dbm'.
+        """
+        with self.lock:
+            if isinstance(model_wrapper, GroupByModelWrapper):
+                key = path = model_wrapper.dir
+                if model_format == 'dbm':
+                    path += GROUPBY_ARCHIVE_EXTENSION
+                    size = os.path.getsize(os.path.join(self.warehousedir, path))
+                else:
+                    directory = os.path.join(self.warehousedir, path)
+                    size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+                entry = {'type': 'groupby', 'n_groups': len(model_wrapper.models)}
+                model = model_wrapper.models
+            else:
+                key = model_wrapper.init_pickle_file_name()
+                path = model_wrapper.get_model_file_name(model_format)
+                size = os.path.getsize(os.path.join(self.warehousedir, path))
+                entry = {'type': 'simple', 'n_total_point': model_wrapper.n_total_point}
+                model = model_wrapper
+            # a new version on every build, so that results of the former model are not reused
+            entry.update({'path': path, 'size': size, 'format': model_format, 'version': "%x" % int(time.time() * 1e9),
+                          'mdl': model_wrapper.mdl, 'tbl': model_wrapper.tbl,
+                          'x': model_wrapper.x, 'y': model_wrapper.y,
+                          'groupby_attribute': getattr(model_wrapper, 'groupby_attribute', None)})
+            self._uncache(key)
+            self.manifest[key] = entry
+            self.save_manifest()
+            self._cache(key, model)
+
+    def __contains__(self, key):
+        with self.lock:
+            if key in self.model_catalog:
+                return True
+            if key in self.manifest and not os.path.exists(os.path.join(self.warehousedir, self.manifest[key]['path'])):
+                # the file of the model was deleted from the warehouse
+                del self.manifest[key]
+                self.save_manifest()
+            elif key not in self.manifest and key in self._list_model_files():
+                # the model was copied into the warehouse since it was listed
+                self.load_manifest()
+            return key in self.manifest
+
+    def get_version(self, key):
+        """
+        :return: the version of a model, which changes whenever the model is rebuilt.
+        """
+        entry = self.manifest[key]
+        if 'version' not in entry:
+            entry['version'] = _get_file_version(os.path.join(self.warehousedir, entry['path']))
+        return entry['version']
+
+    def is_loaded(self, key):
+        return key in self.model_catalog
+
+    def get_model(self, key):
+        """
+        :param key: <mdl>.pkl for a simple model, or <mdl>_groupby_<attribute> for a group by model.
+        :return: the SimpleModelWrapper, or the per-group models of a group by model.
+        """
+        with self.lock:
+            if key in self.model_catalog:
+                self.model_catalog.move_to_end(key)
+                return self.model_catalog[key]
+            if key not in self:
+                raise KeyError("Model " + key + " does not exist in the warehouse.")
+
+            entry = self.manifest[key]
+            path = os.path.join(self.warehousedir, entry['path'])
+            if entry['type'] == 'groupby' and path.endswith(GROUPBY_ARCHIVE_EXTENSION):
+                # the models of the groups are read on first use
+                model = GroupByModelArchive(path)
+            elif entry['type'] == 'groupby':
+                model = deserialize_groupby_model_wrapper(path).models
+            elif entry.get('format', 'pickle') == 'dbm':
+                model = deserialize_model_file(path)
+            else:
+                with open(path, 'rb') as f:
+                    model = pickle.load(f)
+            self._cache(key, model)
+            return model
+
+    def _cache(self, key, model):
+        # make room for the model, dropping the least recently used models first.
+        size = self.manifest[key]['size']
+        if self.memory_budget is not None:
+            while self.model_catalog and self.memory_usage + size > self.memory_budget:
+                self._uncache(next(iter(self.model_catalog)))
+        self.model_catalog[key] = model
+        self.memory_usage += size
+
+    def _uncache(self, key):
+        if key in self.model_catalog:
+            del self.model_catalog[key]
+            self.memory_usage -= self.manifest[key]['size']
+
+
+def _get_model_format(file_name):
+    for model_format, extension in MODEL_FILE_EXTENSIONS.items():
+        if file_name.endswith(extension):
+            return model_format
+    return None
 
 
+def _get_file_version(path):
+    stat = os.stat(path)
+    return "%x-%x" % (stat.st_mtime_ns, stat.st_size)
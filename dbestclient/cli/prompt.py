@@ -13,10 +13,54 @@ config = {
     'epsrel': 0.1,
     'mesh_grid_num': 20,
     'limit': 30,
-    'csv_split_char': ','
+    'csv_split_char': ',',
+    'integration_method': 'table',
+    'cumulative_grid_num': 1000,
+    'qmc_point_num': 4096,
+    'n_jobs': 1,
+    'b_batch_groupby': True,
+    'stratified_group_cap': 10000,
+    'stratified_group_floor': 100,
+    'b_sample_cache': True,
+    'b_keep_reservoir': True,
+    'catalog_memory_budget_mb': 1024,
+    'model_format': 'dbm',
+    'model_dtype': 'float64',
+    'b_result_cache': True,
+    'result_cache_size': 1024,
+    'b_result_cache_persist': False,
+    'plan_cache_size': 1024,
+    'server_host': 'localhost',
+    'server_port': 8009,
+    'server_socket': None,
+    'server_threads': 4
 }
 
 
+def load_config():
+    """
+    load config.json in the current directory, or create it with the default values, and initialize the warehouse.
+
+    :return: the configuration
+    """
+    # deal with configuration file
+    if os.path.exists('config.json'):
+        print("Configuration file loaded.")
+        loaded_config = json.load(open('config.json'))
+    else:
+        print("Configuration file config.json does not exist! use default values")
+        loaded_config = config
+        json.dump(loaded_config, open('config.json', 'w'))
+
+    # deal with warehouse
+    if os.path.exists(loaded_config['warehousedir']):
+        print("warehouse is initialized.")
+    else:
+        print("warehouse does not exists, so initialize one.")
+        os.mkdir(loaded_config['warehousedir'])
+    return loaded_config
+
+
 class DBEstPrompt(Cmd):
     def __init__(self):
         super(DBEstPrompt, self).__init__()
@@ -24,33 +68,46 @@ class DBEstPrompt(Cmd):
         self.intro = "Welcome to DBEst: a model-based AQP engine! Type exit to exit!"
         self.query = ""
 
-
-        # deal with configuration file
-        if os.path.exists('config.json'):
-            print("Configuration file loaded.")
-            self.config = json.load(open('config.json'))
-        else:
-            print("Configuration file config.json does not exist! use default values")
-            self.config = config
-            json.dump(self.config, open('config.json', 'w'))
+        self.config = load_config()
         self.verbose = self.config['verbose']
         self.b_show_latency = self.config['b_show_latency']
 
-        # deal with warehouse
-        if os.path.exists(self.config['warehousedir']):
-            print("warehouse is initialized.")
-        else:
-            print("warehouse does not exists, so initialize one.")
-            os.mkdir(self.config['warehousedir'])
-
         self.sqlExecutor = SqlExecutor(self.config)
 
     # print the exit message.
     def do_exit(self, inp):
         '''exit the application.'''
+        self.sqlExecutor.close()
         print("DBEst closed successfully.")
         return True
 
+    def do_source(self, inp):
+        '''run the statements of a SQL script, and print their results as a table: source <file> [<output csv>].'''
+        args = inp.split()
+        if not args:
+            print("Usage: source <file> [<output csv>]")
+            return
+        if not os.path.exists(args[0]):
+            print("File " + args[0] + " does not exist.")
+            return
+        self.run_batch(self.sqlExecutor.execute_script, args[0], output=args[1] if len(args) > 1 else None)
+
+    def run_batch(self, execute, statements, output=None):
+        """
+        run statements without the interactive prompt.
+
+        :param execute: SqlExecutor.execute_many or SqlExecutor.execute_script.
+        :param statements: the list of statements, or the script file.
+        :param output: if given, the results are written to this CSV file instead of being printed.
+        """
+        results = execute(statements)
+        if output is None:
+            print(results.to_string(index=False))
+        else:
+            results.to_csv(output, index=False)
+            print("%d statements executed, results written to %s." % (results['query_id'].nunique(), output))
+        return results
+
     # process the query
     def default(self, inp):
         if ";" not in inp:
@@ -93,6 +150,7 @@ class DBEstPrompt(Cmd):
                 break
             except KeyboardInterrupt:
                 # self.do_exit("")
+                self.sqlExecutor.close()
                 print("DBEst closed successfully.")
                 return True
 
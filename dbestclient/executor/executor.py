@@ -7,17 +7,61 @@ import sys
 import pickle
 from dbestclient.io.sampling import DBEstSampling
 from dbestclient.ml.modeltrainer import SimpleModelTrainer, GroupByModelTrainer
-from dbestclient.parser.parser import DBEstParser
+from dbestclient.parser.parser import DBEstParser, QueryPlan, QueryPlanCache, split_statements
 from dbestclient.io import getxy
 from dbestclient.ml.regression import DBEstReg
 from dbestclient.ml.density import DBEstDensity
-from dbestclient.executor.queryengine import QueryEngine
-from dbestclient.ml.modelwraper import SimpleModelWrapper, get_pickle_file_name, GroupByModelWrapper
+from dbestclient.executor.queryengine import QueryEngine, GroupByQueryEngine, get_query_engine
+from dbestclient.executor.parallel import GroupByPool
+from dbestclient.executor.resultcache import QueryResultCache
+from dbestclient.executor.metrics import QueryMetrics
+from dbestclient.ml.modelwraper import SimpleModelWrapper, get_pickle_file_name, GroupByModelWrapper, \
+    GroupByModelArchive
 from dbestclient.catalog.catalog import DBEstModelCatalog
-from dbestclient.tools.dftools import convert_df_to_yx, get_group_count_from_df, get_group_count_from_file
+from dbestclient.tools.dftools import convert_df_to_yx, get_group_count_from_df
 import numpy as np
+import pandas as pd
 from datetime import datetime
+from collections import OrderedDict
 import os
+import copy
+import threading
+
+
+class QueryResult:
+    """
+    The result of a statement.
+    answer is the estimate of a query, {group value: estimate} for a group by query, or None for a DDL statement
+    or a failed statement, whose error is given in message. latency is in seconds, and metrics is the QueryMetrics
+    of the statement, the time of each of its stages and the number of model evaluations.
+    For EXPLAIN ANALYZE, answer is the metrics, as {metric: value}.
+    """
+    COLUMNS = ['query_id', 'query', 'status', 'message', 'group', 'answer', 'latency']
+
+    def __init__(self, query, status="OK", answer=None, message=None, latency=0.0, metrics=None):
+        self.query = query
+        self.status = status
+        self.answer = answer
+        self.message = message
+        self.latency = latency
+        self.metrics = metrics if metrics is not None else QueryMetrics()
+
+    @property
+    def stages(self):
+        """
+        :return: {stage: seconds}, e.g. sample (which also counts the rows), train and serialize for a CREATE TABLE.
+        """
+        return self.metrics.stages
+
+    def get_rows(self, query_id):
+        """
+        :return: the rows of the result, one for each group of a group by query.
+        """
+        if isinstance(self.answer, dict):
+            return [(query_id, self.query, self.status, self.message, group, answer, self.latency)
+                    for group, answer in self.answer.items()]
+        return [(query_id, self.query, self.status, self.message, None, self.answer, self.latency)]
+
 
 class SqlExecutor:
     """
@@ -25,183 +69,622 @@ class SqlExecutor:
     """
 
     def __init__(self, config):
-        self.parser = None
         self.config = config
-
-        self.model_catalog = DBEstModelCatalog()
+        # run() can be called from several threads, see dbestclient.server: the caches, the catalog and the
+        # group by state are guarded by locks, and models are built one at a time.
+        self.lock = threading.RLock()
+        self.ddl_lock = threading.Lock()
+        self.plan_cache = QueryPlanCache(self.config.get('plan_cache_size', 1024))
+        self.groupby_pool = None
+        self.groupby_engines = {}
+
+        budget = self.config.get('catalog_memory_budget_mb', None)
+        self.model_catalog = DBEstModelCatalog(self.config['warehousedir'],
+                                               memory_budget=None if budget is None else float(budget) * 1024 ** 2)
         self.init_model_catalog()
+
+        self.result_cache = None
+        if self.config.get('b_result_cache', False):
+            self.result_cache = QueryResultCache(self.config.get('result_cache_size', 1024),
+                                                 file=self.config['warehousedir'] + "/.resultcache.json"
+                                                 if self.config.get('b_result_cache_persist', False) else None)
         # exit()
 
     def init_model_catalog(self):
-        # search the warehouse, and add all available models.
-        # >>>>>>>>>>>>>>>>>>> implement this please!!! <<<<<<<<<<<<<<<<<<
-        n_model = 0
-        for file_name in os.listdir(self.config['warehousedir']):
-
-            # load simple models
-            if file_name.endswith(".pkl"):
-                if n_model == 0:
-                    print("start loading pre-existing models.")
-
-                with open(self.config['warehousedir'] + "/"+ file_name, 'rb') as f:
-                    model = pickle.load(f)
-                self.model_catalog.model_catalog[model.init_pickle_file_name()]=model
-                n_model += 1
-
-            # load group by models
-            if os.path.isdir(self.config['warehousedir'] + "/"+ file_name):
-                n_models_in_groupby = 0
-                if n_model == 0:
-                    print("start loading pre-existing models.")
-
-                for model_name in os.listdir(self.config['warehousedir'] + "/"+ file_name):
-                    if model_name.endswith(".pkl"):
-                        with open(self.config['warehousedir'] + "/"+ file_name +"/"+model_name, 'rb') as f:
-                            model = pickle.load(f)
-                            n_models_in_groupby += 1
-
-                        if n_models_in_groupby == 1:
-                            groupby_model_wrapper = GroupByModelWrapper(model.mdl, model.tbl, model.x, model.y,
-                                                                        model.groupby_attribute,
-                                                                        x_min_value=model.x_min_value,
-                                                                        x_max_value=model.x_max_value)
-                        groupby_model_wrapper.add_simple_model(model)
-
-                self.model_catalog.model_catalog[file_name] = groupby_model_wrapper.models
-                n_model += 1
-
-
+        # read the manifest of the warehouse; the models themselves are loaded on first use.
+        n_model = self.model_catalog.load_manifest()
         if n_model >0:
-            print("Loaded " + str(n_model) + " models." )
-        # >>>>>>>>>>>>>>>>>>> implement this please!!! <<<<<<<<<<<<<<<<<<
+            print("Found " + str(n_model) + " models." )
 
     def execute(self, sql):
-        # prepare the parser
-        if type(sql) == str:
-            self.parser = DBEstParser()
-            self.parser.parse(sql)
-        elif type(sql) == DBEstParser:
-            self.parser = sql
+        """
+        execute a statement, and print its result.
+        """
+        result = self.run(sql)
+        if result.status != "OK":
+            print(result.message)
+            return
+        if result.answer is None:
+            return
+        print("OK")
+        if isinstance(result.answer, dict):
+            for key, item in result.answer.items():
+                print(key, item)
+            if self.config['verbose']:
+                print("Time cost: %.4fs." % result.latency)
         else:
-            print("Unrecognized SQL! Please check it!")
-            exit(-1)
+            print(result.answer)
+            if self.config['verbose']:
+                print("time cost: " + str(result.latency))
+        if self.config['verbose']:
+            self.print_result_cache_stats()
+        print("------------------------")
+
+    def execute_many(self, sqls):
+        """
+        execute many statements, without printing their results. A statement which fails does not stop the others.
+
+        :param sqls: a list of SQL queries.
+        :return: a DataFrame with a row for each query, or for each group of a group by query, with the columns
+            query_id, query, status, message, group, answer and latency (in seconds).
+        """
+        rows = []
+        for query_id, sql in enumerate(sqls):
+            try:
+                result = self.run(sql)
+            except Exception as e:
+                result = QueryResult(sql, status="ERROR", message=str(e))
+            rows.extend(result.get_rows(query_id))
+        return pd.DataFrame(rows, columns=QueryResult.COLUMNS)
+
+    def execute_script(self, file):
+        """
+        execute the statements of a SQL script, separated by ;, see execute_many().
+        """
+        with open(file, 'r') as f:
+            return self.execute_many(split_statements(f.read()))
+
+    def run(self, sql):
+        """
+        execute a statement without printing its result.
+
+        :param sql: a SQL query, a DBEstParser or a QueryPlan.
+        :return: the QueryResult
+        """
+        start = datetime.now()
+        metrics = QueryMetrics()
+        # prepare the plan of the query
+        with metrics.timer('parse'):
+            if type(sql) == str:
+                plan = self.plan_cache.get_plan(sql, metrics)
+            elif type(sql) == DBEstParser:
+                plan = sql.get_plan()
+            elif type(sql) == QueryPlan:
+                plan = sql
+            else:
+                return QueryResult(str(sql), status="ERROR", message="Unrecognized SQL! Please check it!")
 
         # execute the query
-        if self.parser.if_nested_query():
-            print("Nested query is currently not supported!")
+        if plan.b_nested:
+            result = QueryResult(plan.query, status="ERROR", message="Nested query is currently not supported!")
+        elif plan.b_ddl:
+            with self.ddl_lock:
+                result = self.create_model(plan, metrics)
+        elif plan.b_insert:
+            with self.ddl_lock:
+                result = self.insert_into(plan, metrics)
         else:
-            if self.parser.if_ddl():
-                # DDL, create the model as requested
-                mdl = self.parser.get_ddl_model_name()
-                tbl = self.parser.get_from_name()
-                original_data_file = self.config['warehousedir'] + "/" + tbl
-                yheader = self.parser.get_y()[0]
-                xheader = self.parser.get_x()[0]
-                ratio = self.parser.get_sampling_ratio()
-                method = self.parser.get_sampling_method()
-
-                sampler = DBEstSampling()
-                sampler.make_sample(original_data_file, ratio, method, split_char=self.config['csv_split_char'])
-
-                if not self.parser.if_contain_groupby():  # if group by is not involved
-                    # check whether this model exists, if so, skip training
-                    if os.path.exists(self.config['warehousedir'] + "/" +mdl + '.pkl'):
-                        print("Model {0} exists in the warehouse, please use another model name to train it.".format(mdl))
-                        return
-
-                    n_total_point = sampler.n_total_point
-                    xys = sampler.getyx(yheader, xheader)
-                    simple_model_wrapper = SimpleModelTrainer(mdl,tbl, xheader, yheader,
-                                                              n_total_point,ratio).fit_from_df(xys)
-                    # reg = DBEstReg().fit(x, y)
-                    # density = DBEstDensity().fit(x)
-                    # simpleWrapper = SimpleModelWrapper(mdl, tbl, xheader, y=yheader,n_total_point=n_total_point,
-                    #                                    n_sample_point=ratio)
-                    # simpleWrapper.load_model(density, reg)
-
-                    simple_model_wrapper.serialize2warehouse(self.config['warehousedir'])
-                    self.model_catalog.add_model_wrapper(simple_model_wrapper)
-
-                else:  # if group by is involved in the query
-                    groupby_attribute = self.parser.get_groupby_value()
-                    # check whether this model exists, if so, skip training
-                    if os.path.exists(self.config['warehousedir'] + "/" + mdl+"_groupby_" + groupby_attribute):
-                        print(
-                            "Model {0} exists in the warehouse, please use another model name to train it.".format(mdl))
-                        return
-
-
-                    xys = sampler.getyx(yheader,xheader)
-                    # print(xys[groupby_attribute])
-                    n_total_point = get_group_count_from_file(original_data_file,groupby_attribute,sep=self.config['csv_split_char'])
-                    n_sample_point = get_group_count_from_df(xys,groupby_attribute)
-                    groupby_model_wrapper = GroupByModelTrainer(mdl, tbl, xheader, yheader, groupby_attribute, n_total_point, n_sample_point,
-                                                                x_min_value=-np.inf, x_max_value=np.inf).fit_from_df(xys)
-                    groupby_model_wrapper.serialize2warehouse(self.config['warehousedir']+"/"+groupby_model_wrapper.dir)
-                    self.model_catalog.model_catalog[groupby_model_wrapper.dir] = groupby_model_wrapper.models
-
+            result = self.answer_query(plan, metrics)
+        result.metrics = metrics
+        result.latency = (datetime.now() - start).total_seconds()
+        if plan.b_explain and result.status == "OK":
+            result.answer = dict(metrics.to_dict(), total_time=result.latency)
+        return result
+
+    def create_model(self, plan, metrics=None):
+        """
+        DDL, create the model as requested.
+
+        :param metrics: the QueryMetrics of the statement, which gets the time of each stage.
+        :return: the QueryResult
+        """
+        metrics = metrics if metrics is not None else QueryMetrics()
+        mdl = plan.model_name
+        tbl = plan.tbl
+        original_data_file = self.config['warehousedir'] + "/" + tbl
+        yheader = plan.y[0]
+        # a model over several columns is trained on the list of its columns
+        xheader = [column[0] for column in plan.x_columns] if len(plan.x_columns) > 1 else plan.x[0]
+        ratio = plan.sampling_ratio
+        method = plan.sampling_method
+        density_backend = plan.density_backend
+        model_format = self.config.get('model_format', 'pickle')
+        model_dtype = self.config.get('model_dtype', None)
+
+        groupby_attribute = plan.groupby_attribute
+
+        # check whether this model exists, if so, skip sampling and training
+        if not plan.b_groupby and get_pickle_file_name(mdl) in self.model_catalog or plan.b_groupby and (
+                mdl + "_groupby_" + groupby_attribute in self.model_catalog or
+                os.path.exists(self.config['warehousedir'] + "/" + mdl + "_groupby_" + groupby_attribute)):
+            return QueryResult(plan.query, status="ERROR", message="Model {0} exists in the warehouse, please "
+                                                                   "use another model name to train it.".format(mdl))
+
+        start = datetime.now()
+        sampler = DBEstSampling()
+        sampler.make_sample(original_data_file, ratio, method, split_char=self.config['csv_split_char'],
+                            groupby_attribute=groupby_attribute,
+                            group_cap=self.config.get('stratified_group_cap', None),
+                            group_floor=self.config.get('stratified_group_floor', 100),
+                            n_jobs=int(self.config.get('n_jobs', 1)),
+                            cache_dir=self.config['warehousedir'] + "/.samplecache"
+                            if self.config.get('b_sample_cache', False) else None)
+        if sampler.sample is None:
+            return QueryResult(plan.query, status="ERROR", message="Sampling failed, model {0} is not created.".format(mdl))
+        if self.config.get('b_keep_reservoir', False):
+            # keep the sample, to update the model with INSERT INTO
+            sampler.save_reservoir(self.get_reservoir_file(mdl + "_groupby_" + groupby_attribute if plan.b_groupby
+                                                           else mdl),
+                                   tbl=tbl, y=yheader, x=xheader, density_backend=density_backend)
+        metrics.add_time('sample', (datetime.now() - start).total_seconds())
+        start = datetime.now()
+
+        if not plan.b_groupby:  # if group by is not involved
+            n_total_point = sampler.n_total_point
+            xys = sampler.getyx(yheader, xheader)
+            simple_model_wrapper = SimpleModelTrainer(mdl,tbl, xheader, yheader,
+                                                      n_total_point,ratio,
+                                                      cumulative_grid_num=self.config.get('cumulative_grid_num', 1000),
+                                                      density_backend=density_backend).fit_from_df(xys)
+            metrics.add_time('train', (datetime.now() - start).total_seconds())
+            start = datetime.now()
+            # reg = DBEstReg().fit(x, y)
+            # density = DBEstDensity().fit(x)
+            # simpleWrapper = SimpleModelWrapper(mdl, tbl, xheader, y=yheader,n_total_point=n_total_point,
+            #                                    n_sample_point=ratio)
+            # simpleWrapper.load_model(density, reg)
+
+            simple_model_wrapper.serialize2warehouse(self.config['warehousedir'], model_format=model_format,
+                                                     dtype=model_dtype)
+            self.model_catalog.add_model_wrapper(simple_model_wrapper, model_format=model_format)
+            if self.result_cache is not None:
+                self.result_cache.invalidate(get_pickle_file_name(mdl))
+
+        else:  # if group by is involved in the query
+            xys = sampler.getyx(yheader,xheader)
+            # print(xys[groupby_attribute])
+            n_total_point = sampler.group_counts
+            n_sample_point = get_group_count_from_df(xys,groupby_attribute)
+            groupby_model_wrapper = GroupByModelTrainer(mdl, tbl, xheader, yheader, groupby_attribute, n_total_point, n_sample_point,
+                                                        x_min_value=-np.inf, x_max_value=np.inf,
+                                                        cumulative_grid_num=self.config.get('cumulative_grid_num', 1000),
+                                                        density_backend=density_backend,
+                                                        n_jobs=int(self.config.get('n_jobs', 1))).fit_from_df(xys)
+            metrics.add_time('train', (datetime.now() - start).total_seconds())
+            start = datetime.now()
+            groupby_model_wrapper.serialize2warehouse(self.config['warehousedir']+"/"+groupby_model_wrapper.dir,
+                                                      model_format=model_format, dtype=model_dtype)
+            self.model_catalog.add_model_wrapper(groupby_model_wrapper, model_format=model_format)
+            if self.result_cache is not None:
+                self.result_cache.invalidate(groupby_model_wrapper.dir)
+            self.reset_groupby_pool()
+        metrics.add_time('serialize', (datetime.now() - start).total_seconds())
+        return QueryResult(plan.query, message="Model {0} is created.".format(mdl), metrics=metrics)
+
+    def insert_into(self, plan, metrics=None):
+        """
+        INSERT INTO, update a model with the rows of a file, appended to its table. The sample kept when the model
+        was created is continued with the new rows, and the row counts are updated. Only the models whose sample
+        changed are trained again, the others only get their new row counts.
+
+        :param metrics: the QueryMetrics of the statement, which gets the time of each stage.
+        :return: the QueryResult
+        """
+        metrics = metrics if metrics is not None else QueryMetrics()
+        mdl = plan.model_name
+        model_format = self.config.get('model_format', 'pickle')
+        model_dtype = self.config.get('model_dtype', None)
+        if plan.b_groupby:
+            model_key = reservoir_key = mdl + "_groupby_" + plan.groupby_attribute
+        else:
+            model_key, reservoir_key = get_pickle_file_name(mdl), mdl
+        reservoir_file = self.get_reservoir_file(reservoir_key)
+        new_data_file = self.config['warehousedir'] + "/" + plan.tbl
+        if model_key not in self.model_catalog:
+            return QueryResult(plan.query, status="ERROR",
+                               message="Model {0} does not exist in the warehouse.".format(reservoir_key))
+        if not os.path.exists(reservoir_file):
+            return QueryResult(plan.query, status="ERROR",
+                               message="The sample of model {0} is not kept, so it can not be updated. Set "
+                                       "b_keep_reservoir in config.json, and create it again.".format(reservoir_key))
+        if not os.path.exists(new_data_file):
+            return QueryResult(plan.query, status="ERROR", message="File {0} does not exist.".format(plan.tbl))
+
+        start = datetime.now()
+        sampler = DBEstSampling()
+        try:
+            metadata = sampler.update_sample(reservoir_file, new_data_file)
+        except ValueError as e:
+            return QueryResult(plan.query, status="ERROR", message=str(e))
+        # the updated sample replaces the kept one once the model is updated
+        sampler.save_reservoir(reservoir_file + ".new", **metadata)
+        metrics.add_time('sample', (datetime.now() - start).total_seconds())
+        start = datetime.now()
+
+        yheader, xheader = metadata['y'], metadata['x']
+        xys = sampler.getyx(yheader, xheader)
+        if not plan.b_groupby:
+            model_wrapper = self.model_catalog.get_model(model_key)
+            if sampler.changed_groups:
+                model_wrapper = SimpleModelTrainer(mdl, metadata['tbl'], xheader, yheader, sampler.n_total_point,
+                                                   sampler.options['ratio'],
+                                                   cumulative_grid_num=self.config.get('cumulative_grid_num', 1000),
+                                                   density_backend=metadata['density_backend']).fit_from_df(xys)
+                n_trained, n_model = 1, 1
             else:
-                # DML, provide the prediction using models
-                mdl = self.parser.get_from_name()
-                func, yheader = self.parser.get_aggregate_function_and_variable()
-                if self.parser.if_where_exists():
-                    xheader, x_lb, x_ub = self.parser.get_where_name_and_range()
-                    x_lb = float(x_lb)
-                    x_ub = float(x_ub)
-
-                else:
-                    print("support for query without where clause is not implemented yet! abort!")
-
-                if not self.parser.if_contain_groupby():  # if group by is not involved in the query
-                    simple_model_wrapper = self.model_catalog.model_catalog[get_pickle_file_name(mdl)]
-                    reg = simple_model_wrapper.reg
-                    density = simple_model_wrapper.density
-                    n_sample_point = int(simple_model_wrapper.n_sample_point)
-                    n_total_point = int(simple_model_wrapper.n_total_point)
-                    x_min_value = float(simple_model_wrapper.x_min_value)
-                    x_max_value = float(simple_model_wrapper.x_max_value)
-                    query_engine = QueryEngine(reg, density, n_sample_point, n_total_point, x_min_value, x_max_value,
-                                              self.config)
-                    p,t = query_engine.predict(func,x_lb=x_lb,x_ub=x_ub)
-                    print("OK")
-                    print(p)
-                    if self.config['verbose']:
-                        print("time cost: "+ str(t))
-                    print("------------------------")
-
-                else:  # if group by is involved in the query
-                    start=datetime.now()
-                    predictions={}
-                    groupby_attribute =self.parser.get_groupby_value()
-                    groupby_key = mdl + "_groupby_"+groupby_attribute
-
-                    for group_value, model_wrapper in self.model_catalog.model_catalog[groupby_key].items():
-                        reg = model_wrapper.reg
-                        density =model_wrapper.density
-                        n_sample_point = int(model_wrapper.n_sample_point)
-                        n_total_point = int(model_wrapper.n_total_point)
-                        x_min_value = float(model_wrapper.x_min_value)
-                        x_max_value = float(model_wrapper.x_max_value)
-                        query_engine = QueryEngine(reg, density, n_sample_point, n_total_point, x_min_value,
-                                                   x_max_value,
-                                                   self.config)
-                        predictions[model_wrapper.groupby_value]=query_engine.predict(func, x_lb=x_lb, x_ub=x_ub)[0]
-
-                    print("OK")
-                    for key, item in predictions.items():
-                        print(key, item)
-
-                    if self.config['verbose']:
-                        end = datetime.now()
-                        time_cost = (end - start).total_seconds()
-                        print("Time cost: %.4fs." % time_cost)
-                    print("------------------------")
-
-
-
-
-
-
+                model_wrapper = copy.copy(model_wrapper)
+                model_wrapper.n_total_point = sampler.n_total_point
+                n_trained, n_model = 0, 1
+            metrics.add_time('train', (datetime.now() - start).total_seconds())
+            start = datetime.now()
+            model_wrapper.serialize2warehouse(self.config['warehousedir'], model_format=model_format,
+                                              dtype=model_dtype)
+        else:
+            groupby_attribute = plan.groupby_attribute
+            models = self.model_catalog.get_model(model_key)
+            changed = xys[xys[groupby_attribute].isin(sampler.changed_groups)]
+            model_wrapper = GroupByModelTrainer(mdl, metadata['tbl'], xheader, yheader,
+                                                groupby_attribute, sampler.group_counts,
+                                                get_group_count_from_df(xys, groupby_attribute),
+                                                x_min_value=-np.inf, x_max_value=np.inf,
+                                                cumulative_grid_num=self.config.get('cumulative_grid_num', 1000),
+                                                density_backend=metadata['density_backend'],
+                                                n_jobs=int(self.config.get('n_jobs', 1))).fit_from_df(changed)
+            n_trained = len(model_wrapper.models)
+            # the groups whose sample did not change keep their models
+            for model_name in models:
+                groupby_value = models.get_groupby_value(model_name) if isinstance(models, GroupByModelArchive) \
+                    else models[model_name].groupby_value
+                if groupby_value in sampler.changed_groups:
+                    continue
+                simple_model_wrapper = copy.copy(models[model_name])
+                simple_model_wrapper.n_total_point = sampler.group_counts[simple_model_wrapper.groupby_value]
+                model_wrapper.add_simple_model(simple_model_wrapper)
+            n_model = len(model_wrapper.models)
+            metrics.add_time('train', (datetime.now() - start).total_seconds())
+            start = datetime.now()
+            model_wrapper.serialize2warehouse(self.config['warehousedir'] + "/" + model_wrapper.dir,
+                                              model_format=model_format, dtype=model_dtype, overwrite=True)
+        self.model_catalog.add_model_wrapper(model_wrapper, model_format=model_format)
+        os.replace(reservoir_file + ".new", reservoir_file)
+        if self.result_cache is not None:
+            self.result_cache.invalidate(model_key)
+        if plan.b_groupby:
+            self.reset_groupby_pool()
+        metrics.add_time('serialize', (datetime.now() - start).total_seconds())
+        return QueryResult(plan.query, metrics=metrics,
+                           message="Model {0} is updated with {1} rows, {2} of its {3} models are trained again."
+                           .format(reservoir_key, sampler.n_new_point, n_trained, n_model))
+
+    def get_reservoir_file(self, model_key):
+        # the samples of the models are kept apart from the models, see DBEstSampling.save_reservoir()
+        return self.config['warehousedir'] + "/.reservoirs/" + model_key + ".npz"
+
+    def answer_query(self, plan, metrics=None):
+        """
+        DML, provide the prediction using models.
+
+        :param metrics: the QueryMetrics of the query, which gets the time of each stage.
+        :return: the QueryResult
+        """
+        metrics = metrics if metrics is not None else QueryMetrics()
+        mdl = plan.tbl
+        func, yheader = plan.func, plan.yheader
+        if plan.n_bucket is not None:
+            return self.answer_histogram(plan, metrics)
+        if func.lower() == "percentile":
+            if plan.percentile is None or not 0 <= float(plan.percentile) <= 1:
+                return QueryResult(plan.query, status="ERROR",
+                                   message="PERCENTILE(x, q) needs the fraction q, between 0 and 1.")
+            # the results of different percentiles are cached apart
+            func = "percentile(%s)" % plan.percentile
+        if plan.b_where:
+            # {x: (lb, ub)}, for each predicate of the WHERE clause
+            ranges = OrderedDict((x, (float(x_lb), float(x_ub))) for x, x_lb, x_ub in
+                                 [(plan.xheader, plan.x_lb, plan.x_ub)] + plan.x_ranges)
+            xheader = ",".join(ranges)
+            x_lb, x_ub = [bounds[0] for bounds in ranges.values()], [bounds[1] for bounds in ranges.values()]
+            if len(ranges) == 1:
+                x_lb, x_ub = x_lb[0], x_ub[0]
+        elif func.lower() in ("count", "sum", "avg"):
+            return self.answer_total(plan, metrics)
+        else:
+            # VARIANCE, STDDEV and PERCENTILE over the whole table are integrated over the range of x
+            ranges, xheader, x_lb, x_ub = OrderedDict(), "", [], []
+
+        if not plan.b_groupby:  # if group by is not involved in the query
+            with metrics.timer('catalog'):
+                b_exist = get_pickle_file_name(mdl) in self.model_catalog
+            if not b_exist:
+                return QueryResult(plan.query, status="ERROR",
+                                   message="Model {0} does not exist in the warehouse.".format(mdl))
+            cache_key, p = self.get_cached_result(get_pickle_file_name(mdl), func, yheader, xheader, x_lb, x_ub,
+                                                  metrics=metrics, b_explain=plan.b_explain)
+            if p is None:
+                with metrics.timer('catalog'):
+                    simple_model_wrapper = self.model_catalog.get_model(get_pickle_file_name(mdl))
+                bounds = self.get_bounds(simple_model_wrapper, ranges)
+                if bounds is None:
+                    return QueryResult(plan.query, status="ERROR", message="Model {0} is not built on {1}.".format(
+                        mdl, ", ".join(ranges)))
+                message = self.check_aggregate(simple_model_wrapper, plan)
+                if message is not None:
+                    return QueryResult(plan.query, status="ERROR", message=message)
+                query_engine = get_query_engine(simple_model_wrapper, self.config, metrics)
+                with metrics.timer('integrate'):
+                    p,t = query_engine.predict(plan.func,x_lb=bounds[0],x_ub=bounds[1],percentile=plan.percentile)
+                if self.result_cache is not None:
+                    self.result_cache.put(cache_key, p)
+            return QueryResult(plan.query, answer=p)
+
+        else:  # if group by is involved in the query
+            groupby_attribute = plan.groupby_attribute
+            groupby_key = mdl + "_groupby_"+groupby_attribute
+
+            with metrics.timer('catalog'):
+                b_exist = groupby_key in self.model_catalog
+            if not b_exist:
+                return QueryResult(plan.query, status="ERROR",
+                                   message="Model {0} does not exist in the warehouse.".format(groupby_key))
+            cache_key, predictions = self.get_cached_result(groupby_key, func, yheader, xheader, x_lb, x_ub,
+                                                            groupby_attribute, metrics=metrics,
+                                                            b_explain=plan.b_explain)
+            if predictions is None:
+                with metrics.timer('catalog'):
+                    models = self.model_catalog.get_model(groupby_key)
+                    # the models of all the groups are built on the same columns
+                    message = self.check_aggregate(models[next(iter(models))], plan)
+                if message is not None:
+                    return QueryResult(plan.query, status="ERROR", message=message)
+                predictions = self.predict_groupby(groupby_key, plan.func, ranges, metrics, plan.percentile)
+                if predictions is None:
+                    return QueryResult(plan.query, status="ERROR", message="Model {0} is not built on {1}.".format(
+                        groupby_key, ", ".join(ranges)))
+                if self.result_cache is not None:
+                    self.result_cache.put(cache_key, predictions)
+            return QueryResult(plan.query, answer=predictions)
+
+    def answer_total(self, plan, metrics=None):
+        """
+        answer SELECT AF(y) FROM t_m [GROUP BY z], over the whole table, from the row counts and the averages of y
+        kept in the models, without integrating.
+
+        :param metrics: the QueryMetrics of the query, which gets the time of each stage.
+        :return: the QueryResult
+        """
+        metrics = metrics if metrics is not None else QueryMetrics()
+        mdl, func = plan.tbl, plan.func
+        model_key = mdl + "_groupby_" + plan.groupby_attribute if plan.b_groupby else get_pickle_file_name(mdl)
+        with metrics.timer('catalog'):
+            b_exist = model_key in self.model_catalog
+        if not b_exist:
+            return QueryResult(plan.query, status="ERROR",
+                               message="Model {0} does not exist in the warehouse.".format(
+                                   model_key if plan.b_groupby else mdl))
+        if func.lower() not in ("count", "sum", "avg"):
+            return QueryResult(plan.query, status="ERROR",
+                               message="Aggregate function " + func + " is not implemented yet!")
+
+        with metrics.timer('catalog'):
+            models = self.model_catalog.get_model(model_key)
+        if not plan.b_groupby:
+            return QueryResult(plan.query, answer=self.get_total(models, func, metrics))
+        predictions = {}
+        for model_name in models:
+            if isinstance(models, GroupByModelArchive):
+                groupby_value = models.get_groupby_value(model_name)
+                total = models.get_total(model_name, func)
+            else:
+                groupby_value = models[model_name].groupby_value
+                total = models[model_name].get_total(func)
+            predictions[groupby_value] = total if total is not None else \
+                self.get_total(models[model_name], func, metrics)
+        return QueryResult(plan.query, answer=predictions)
+
+    def check_aggregate(self, model_wrapper, plan):
+        """
+        :return: why the model can not answer the aggregate function of the query, or None if it can.
+        """
+        func = plan.func.lower()
+        xheaders = model_wrapper.get_xheaders()
+        if func in ("variance", "stddev", "percentile") and len(xheaders) > 1:
+            return "{0} is not supported by models over several columns.".format(func.upper())
+        if func == "percentile" and plan.yheader not in xheaders:
+            return "PERCENTILE(x, q) should be on the column model {0} is built on, {1}.".format(plan.tbl, xheaders[0])
+        if func in ("variance", "stddev") and getattr(model_wrapper, 'variance', None) is None:
+            return "Model {0} does not keep the variance of y, please create it again to answer {1}.".format(
+                plan.tbl, func.upper())
+        return None
+
+    def get_bounds(self, model_wrapper, ranges):
+        """
+        :param ranges: {x: (lb, ub)}, for each predicate of the WHERE clause.
+        :return: the bounds to integrate the model over, (lb, ub) for a model over one column, or the arrays of the
+            bounds of its columns for a model over several columns. Columns without predicate are unbounded, and
+            are restricted to the support of the density of each model by its QueryEngine. None if a predicate is on
+            a column the model is not built on.
+        """
+        xheaders = model_wrapper.get_xheaders()
+        if any(x not in xheaders for x in ranges):
+            return None
+        if len(xheaders) == 1:
+            return next(iter(ranges.values())) if ranges else (-np.inf, np.inf)
+        return np.array([ranges[x][0] if x in ranges else -np.inf for x in xheaders]), \
+            np.array([ranges[x][1] if x in ranges else np.inf for x in xheaders])
+
+    def get_total(self, model_wrapper, func, metrics):
+        """
+        :return: the aggregate over the whole table of a SimpleModelWrapper. Models built before the average of y
+            was kept are integrated over the range of x in their sample instead, or over the support of their
+            density if they do not keep that range either.
+        """
+        total = model_wrapper.get_total(func)
+        if total is None:
+            query_engine = get_query_engine(model_wrapper, self.config, metrics)
+            with metrics.timer('integrate'):
+                total = query_engine.predict(func, x_lb=query_engine.x_min, x_ub=query_engine.x_max)[0]
+        return total
+
+    def answer_histogram(self, plan, metrics=None):
+        """
+        answer SELECT AF(y) FROM t_m [WHERE x BETWEEN a AND b] GROUP BY WIDTH_BUCKET(x, lb, ub, n), with the n
+        buckets of equal width over [lb, ub), restricted to [a, b] if the WHERE clause is given.
+
+        :param metrics: the QueryMetrics of the query, which gets the time of each stage.
+        :return: the QueryResult, whose answer is {"[bucket lb, bucket ub)": estimate}
+        """
+        metrics = metrics if metrics is not None else QueryMetrics()
+        mdl = plan.tbl
+        with metrics.timer('catalog'):
+            b_exist = get_pickle_file_name(mdl) in self.model_catalog
+        if not b_exist:
+            return QueryResult(plan.query, status="ERROR",
+                               message="Model {0} does not exist in the warehouse.".format(mdl))
+        if plan.b_where and (plan.xheader != plan.bucket_x or plan.x_ranges):
+            return QueryResult(plan.query, status="ERROR",
+                               message="The WHERE clause and WIDTH_BUCKET should be on the same attribute.")
+        if plan.func.lower() not in ("count", "sum", "avg"):
+            return QueryResult(plan.query, status="ERROR", message="Histograms support COUNT, SUM and AVG.")
+        n_bucket = int(plan.n_bucket)
+        if n_bucket < 1:
+            return QueryResult(plan.query, status="ERROR", message="The number of buckets should be positive.")
+
+        edges = np.linspace(float(plan.bucket_lb), float(plan.bucket_ub), n_bucket + 1)
+        x_lbs, x_ubs = edges[:-1], edges[1:]
+        if plan.b_where:
+            x_lbs = np.clip(x_lbs, float(plan.x_lb), float(plan.x_ub))
+            x_ubs = np.clip(x_ubs, float(plan.x_lb), float(plan.x_ub))
+
+        histogram = "width_bucket(%s,%s,%s,%d)" % (plan.bucket_x, plan.bucket_lb, plan.bucket_ub, n_bucket)
+        cache_key, predictions = self.get_cached_result(get_pickle_file_name(mdl), plan.func, plan.yheader,
+                                                        plan.bucket_x, x_lbs[0], x_ubs[-1], histogram, metrics,
+                                                        b_explain=plan.b_explain)
+        if predictions is None:
+            with metrics.timer('catalog'):
+                simple_model_wrapper = self.model_catalog.get_model(get_pickle_file_name(mdl))
+            if len(simple_model_wrapper.get_xheaders()) > 1:
+                return QueryResult(plan.query, status="ERROR",
+                                   message="Histograms are not supported by models over several columns.")
+            if plan.bucket_x not in simple_model_wrapper.get_xheaders():
+                return QueryResult(plan.query, status="ERROR", message="Model {0} is not built on {1}.".format(
+                    mdl, plan.bucket_x))
+            query_engine = get_query_engine(simple_model_wrapper, self.config, metrics)
+            with metrics.timer('integrate'):
+                results = query_engine.predict_many(plan.func, x_lbs, x_ubs)[0]
+            with metrics.timer('format'):
+                predictions = {}
+                for x_lb, x_ub, result in zip(edges[:-1], edges[1:], results.tolist()):
+                    predictions["[{0:g}, {1:g})".format(x_lb, x_ub)] = None if np.isnan(result) else result
+            if self.result_cache is not None:
+                self.result_cache.put(cache_key, predictions)
+        return QueryResult(plan.query, answer=predictions)
+
+    def predict_groupby(self, groupby_key, func, ranges, metrics=None, percentile=None):
+        """
+        :param ranges: {x: (lb, ub)}, for each predicate of the WHERE clause.
+        :param percentile: the fraction of PERCENTILE(x, percentile).
+        :param metrics: the QueryMetrics of the query, which gets the time of each stage. The models evaluated in
+            the worker processes (n_jobs > 1 without b_batch_groupby) are not counted.
+        :return: {group_value: estimate} for every group of the group by model, or None if a predicate is on a
+            column the model is not built on.
+        """
+        metrics = metrics if metrics is not None else QueryMetrics()
+        predictions = {}
+        with metrics.timer('catalog'):
+            models = self.model_catalog.get_model(groupby_key)
+            # the models of all the groups are built on the same columns
+            model_wrapper = models[next(iter(models))]
+        bounds = self.get_bounds(model_wrapper, ranges)
+        if bounds is None:
+            return None
+        x_lb, x_ub = bounds
+        n_jobs = int(self.config.get('n_jobs', 1))
+        # the stacked engine integrates COUNT, SUM and AVG over one column, with the table, gauss or grid methods;
+        # quad integrates each group adaptively.
+        if self.config.get('b_batch_groupby', False) and len(model_wrapper.get_xheaders()) == 1 and \
+                func.lower() in ("count", "sum", "avg") and \
+                self.config.get('integration_method', 'quad') in ('table', 'gauss', 'grid'):
+            with metrics.timer('catalog'):
+                groupby_engine = self.get_groupby_engine(groupby_key, models)
+            predictions = groupby_engine.predict(func, x_lb, x_ub, metrics)[0]
+        elif n_jobs > 1 and len(models) > 1:
+            with self.lock:
+                if self.groupby_pool is None:
+                    self.groupby_pool = GroupByPool(self.config, n_jobs)
+            with metrics.timer('integrate'):
+                predictions = self.groupby_pool.predict(groupby_key, models, func, x_lb, x_ub, percentile)
+        else:
+            for group_value in models:
+                # the models of a .dbg archive are read on first use
+                with metrics.timer('catalog'):
+                    model_wrapper = models[group_value]
+                query_engine = get_query_engine(model_wrapper, self.config, metrics)
+                with metrics.timer('integrate'):
+                    predictions[model_wrapper.groupby_value]=query_engine.predict(func, x_lb=x_lb, x_ub=x_ub,
+                                                                                  percentile=percentile)[0]
+        return predictions
+
+    def get_cached_result(self, model_key, func, yheader, xheader, x_lb, x_ub, groupby_attribute=None,
+                          metrics=None, b_explain=False):
+        """
+        :param metrics: the QueryMetrics of the query, if it is traced.
+        :param b_explain: whether the query is an EXPLAIN ANALYZE, which evaluates the models even if the result is
+            cached, so that its metrics show the integration.
+        :return: the key of the query in the result cache, and its cached result, or None if it is not cached.
+        """
+        if self.result_cache is None:
+            return None, None
+        metrics = metrics if metrics is not None else QueryMetrics()
+        with metrics.timer('result_cache'):
+            cache_key = self.result_cache.get_key(model_key, self.model_catalog.get_version(model_key), func, yheader,
+                                                  xheader, x_lb, x_ub, groupby_attribute,
+                                                  self.config.get('integration_method', 'quad'))
+            result = None if b_explain else self.result_cache.get(cache_key)
+        if result is not None:
+            metrics.count('result_cache_hits')
+        return cache_key, result
+
+    def print_result_cache_stats(self):
+        if self.result_cache is not None:
+            stats = self.result_cache.get_stats()
+            print("result cache: %d hits, %d misses, %d results." % (stats['hits'], stats['misses'], stats['size']))
+
+    def get_groupby_engine(self, groupby_key, models):
+        # the stacked arrays are kept between queries, until the models of the group by change
+        # or are evicted from the catalog.
+        with self.lock:
+            for key in list(self.groupby_engines.keys()):
+                if not self.model_catalog.is_loaded(key):
+                    del self.groupby_engines[key]
+            if groupby_key not in self.groupby_engines or self.groupby_engines[groupby_key][0] is not models:
+                self.groupby_engines[groupby_key] = (models, GroupByQueryEngine(models, self.config))
+            return self.groupby_engines[groupby_key][1]
+
+    def reset_groupby_pool(self):
+        # the workers keep the group by models they have loaded, so that they are restarted when a group by model
+        # is written again, and load the new models on first use.
+        with self.lock:
+            if self.groupby_pool is not None:
+                self.groupby_pool.close()
+                self.groupby_pool = None
+
+    def close(self):
+        # release the worker processes used for group by queries, if any, and persist the result cache.
+        if self.result_cache is not None:
+            self.result_cache.save()
+        if self.groupby_pool is not None:
+            self.groupby_pool.close()
+            self.groupby_pool = None
 
 
 if __name__ == "__main__":
@@ -213,4 +696,4 @@ if __name__ == "__main__":
     }
     sqlExecutor = SqlExecutor(config)
     sqlExecutor.execute("create table mdl(pm25 real, PRES real) from pm25.csv group by z method uniform size 0.1")
-    print(sqlExecutor.parser.parsed)
+    print(sqlExecutor.run("select count(pm25) from mdl where PRES between 1000 and 1020 group by z").answer)
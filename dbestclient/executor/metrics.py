@@ -0,0 +1,53 @@
+# Created by Qingzhi Ma at 2019-07-27
+# All right reserved
+# Department of Computer Science
+# the University of Warwick
+# Q.Ma.2@warwick.ac.uk
+from collections import OrderedDict
+from contextlib import contextmanager
+import time
+
+
+class QueryMetrics:
+    """
+    Where the time of a statement goes: the seconds spent in each stage, and counters such as the number of points
+    the density and the regression are evaluated on.
+
+    The stages of a query are parse, catalog (looking up and loading the model), result_cache, integrate (which
+    includes density and regression, the time spent evaluating the models) and format. The stages of a CREATE TABLE
+    statement are parse, sample, train and serialize.
+    A QueryMetrics belongs to a single statement, so it is not shared between threads.
+    """
+    COUNTERS = ('density_evaluations', 'regression_evaluations', 'plan_cache_hits', 'result_cache_hits')
+
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.counters = OrderedDict((counter, 0) for counter in self.COUNTERS)
+
+    @contextmanager
+    def timer(self, stage):
+        """
+        time a block, and add the time to the stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def add_time(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def count(self, counter, n=1):
+        self.counters[counter] = self.counters.get(counter, 0) + int(n)
+
+    def to_dict(self):
+        """
+        :return: {"<stage>_time": seconds} for every stage, followed by the counters.
+        """
+        metrics = OrderedDict((stage + "_time", seconds) for stage, seconds in self.stages.items())
+        metrics.update(self.counters)
+        return metrics
+
+    def __repr__(self):
+        return "QueryMetrics(" + repr(dict(self.to_dict())) + ")"
@@ -0,0 +1,78 @@
+# Created by Qingzhi Ma at 2019-07-25
+# All right reserved
+# Department of Computer Science
+# the University of Warwick
+# Q.Ma.2@warwick.ac.uk
+from multiprocessing import Pool
+
+from dbestclient.catalog.catalog import DBEstModelCatalog
+from dbestclient.executor.queryengine import get_query_engine
+
+# state of each worker process: the configuration, and a catalog holding the group by models loaded so far,
+# which stay resident in the worker between queries.
+_config = None
+_catalog = None
+
+
+def _init_worker(config):
+    global _config, _catalog
+    _config = config
+    budget = config.get('catalog_memory_budget_mb', None)
+    _catalog = DBEstModelCatalog(config['warehousedir'],
+                                 memory_budget=None if budget is None else float(budget) * 1024 ** 2)
+
+
+def _get_models(groupby_key):
+    if groupby_key not in _catalog:
+        _catalog.load_manifest()
+    return _catalog.get_model(groupby_key)
+
+
+def _predict_groups(args):
+    groupby_key, model_names, func, x_lb, x_ub, percentile = args
+    models = _get_models(groupby_key)
+    predictions = []
+    for model_name in model_names:
+        model_wrapper = models[model_name]
+        query_engine = get_query_engine(model_wrapper, _config)
+        predictions.append((model_name, model_wrapper.groupby_value,
+                            query_engine.predict(func, x_lb=x_lb, x_ub=x_ub, percentile=percentile)[0]))
+    return predictions
+
+
+class GroupByPool:
+    """
+    evaluate group by queries over a pool of worker processes.
+    Each worker loads the models of a group by from the warehouse on first use and keeps them afterwards,
+    so that only the query and the names of the groups are sent to the workers.
+    """
+
+    def __init__(self, config, n_jobs):
+        self.n_jobs = n_jobs
+        self.pool = Pool(n_jobs, initializer=_init_worker, initargs=(config,))
+
+    def predict(self, groupby_key, models, func, x_lb, x_ub, percentile=None):
+        """
+        :param groupby_key: the group by model in the warehouse, <mdl>_groupby_<attribute>.
+        :param models: the per-group models of the group by, as held in the model catalog.
+        :param percentile: the fraction of PERCENTILE(x, percentile).
+        :return: the predictions for each group, in the same order as the models.
+        """
+        model_names = list(models.keys())
+        n_chunk = min(self.n_jobs, len(model_names))
+        chunks = [model_names[i::n_chunk] for i in range(n_chunk)]
+        results = self.pool.map(_predict_groups, [(groupby_key, chunk, func, x_lb, x_ub, percentile)
+                                                  for chunk in chunks])
+
+        # the group values come back from the workers, so that the models of an archive are not read here
+        predictions_by_model = {model_name: (group_value, prediction)
+                                for result in results for model_name, group_value, prediction in result}
+        predictions = {}
+        for model_name in model_names:
+            group_value, prediction = predictions_by_model[model_name]
+            predictions[group_value] = prediction
+        return predictions
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
@@ -6,18 +6,31 @@
 from datetime import  datetime
 from scipy import integrate
 import numpy as np
+from dbestclient.ml.integral import get_integration_nodes, get_box_integration_nodes, get_bandwidth, \
+    get_percentile, get_support
 
 
 
 
 class QueryEngine:
-    def __init__(self, reg, kde, n_training_point, n_total_point, x_min, x_max, config=None):
+    def __init__(self, reg, kde, n_training_point, n_total_point, x_min, x_max, config=None, cumulative=None,
+                 metrics=None, variance=None):
         self.n_training_point = n_training_point
         self.n_total_point = n_total_point
         self.reg = reg
         self.kde = kde
         self.x_min = x_min
         self.x_max = x_max
+        # models trained before the range of x was kept have infinite bounds, the support of the density is used
+        if np.ndim(x_min) == 0 and not (np.isfinite(x_min) and np.isfinite(x_max)):
+            support_lb, support_ub = get_support(kde)
+            self.x_min = x_min if np.isfinite(x_min) else support_lb
+            self.x_max = x_max if np.isfinite(x_max) else support_ub
+        self.cumulative = cumulative
+        # the variance of y around the regression, V(x), for VARIANCE and STDDEV
+        self.variance = variance
+        # the QueryMetrics of the query, if it is traced
+        self.metrics = metrics
         if config is None:
             self.config = config = {
                 'warehousedir': 'dbestwarehouse',
@@ -28,26 +41,82 @@ class QueryEngine:
                 'epsrel': 0.1,
                 'mesh_grid_num': 20,
                 'limit': 30,
-                'csv_split_char': '|'
+                'csv_split_char': '|',
+                'integration_method': 'table'
             }
         else:
             self.config = config
+        # 'quad' integrates with scipy.integrate.quad, one density/regression call per point;
+        # 'gauss' and 'grid' evaluate the models once, in a batch, on mesh_grid_num nodes;
+        # 'table' looks up the cumulative integrals precomputed at training time, if the model has them.
+        self.integration_method = self.config.get('integration_method', 'quad')
+        if self.integration_method == 'table' and self.cumulative is None:
+            self.integration_method = 'gauss'
+
+    def density(self, x):
+        """
+        :param x: the points, of shape (n, 1).
+        :return: p(x), an array of n values.
+        """
+        if self.metrics is None:
+            return np.exp(self.kde.score_samples(x))
+        with self.metrics.timer('density'):
+            p = np.exp(self.kde.score_samples(x))
+        self.metrics.count('density_evaluations', len(x))
+        return p
+
+    def regression(self, x):
+        """
+        :param x: the points, of shape (n, 1).
+        :return: R(x), an array of n values.
+        """
+        if self.metrics is None:
+            return np.asarray(self.reg.predict(x), dtype=float).reshape(-1)
+        with self.metrics.timer('regression'):
+            r = np.asarray(self.reg.predict(x), dtype=float).reshape(-1)
+        self.metrics.count('regression_evaluations', len(x))
+        return r
+
+    def evaluate_integrals(self, x_min, x_max, b_reg=True):
+        """
+        integrate p(x) and p(x)*R(x) over [x_min, x_max], with the density and the regression evaluated only once,
+        in a batch, over the integration nodes.
+
+        :param x_min: the lower bound of the range.
+        :param x_max: the upper bound of the range.
+        :param b_reg: whether the integral of p(x)*R(x) is needed.
+        :return: integral of p(x), integral of p(x)*R(x) (None if b_reg is False)
+        """
+        if self.integration_method == 'table':
+            int_p, int_pr = self.cumulative.integrate(x_min, x_max)
+            return int_p, int_pr if b_reg else None
+        nodes, weights = get_integration_nodes(x_min, x_max, self.config['mesh_grid_num'],
+                                               method=self.integration_method)
+        nodes = nodes.reshape(-1, 1)
+        p = self.density(nodes)
+        int_p = np.dot(weights, p)
+        if not b_reg:
+            return int_p, None
+        r = self.regression(nodes)
+        return int_p, np.dot(weights, p * r)
 
     def approx_avg(self, x_min, x_max):
         start = datetime.now()
 
         def f_pRx(*args):
             # print(self.cregression.predict(x))
-            return np.exp(self.kde.score_samples(np.array(args).reshape(1, -1))) * self.reg.predict(
-                [[args[0]]])[0]
+            return self.density(np.array(args).reshape(1, -1))[0] * self.regression([[args[0]]])[0]
 
         def f_p(*args):
-            return np.exp(self.kde.score_samples(np.array(args).reshape(1, -1)))
+            return self.density(np.array(args).reshape(1, -1))[0]
 
-        a = integrate.quad(f_pRx, x_min, x_max,
-                           epsabs=self.config['epsabs'], epsrel=self.config['epsrel'])[0]
-        b = integrate.quad(f_p, x_min, x_max,
-                           epsabs=self.config['epsabs'], epsrel=self.config['epsrel'])[0]
+        if self.integration_method == 'quad':
+            a = integrate.quad(f_pRx, x_min, x_max,
+                               epsabs=self.config['epsabs'], epsrel=self.config['epsrel'])[0]
+            b = integrate.quad(f_p, x_min, x_max,
+                               epsabs=self.config['epsabs'], epsrel=self.config['epsrel'])[0]
+        else:
+            b, a = self.evaluate_integrals(x_min, x_max)
 
         if b:
             result = a / b
@@ -58,62 +127,363 @@ class QueryEngine:
         # else:
         #     print("Nan")
 
-        if self.config['verbose']:
-            end = datetime.now()
-            time_cost = (end - start).total_seconds()
-            # print("Time spent for approximate AVG: %.4fs." % time_cost)
+        end = datetime.now()
+        time_cost = (end - start).total_seconds()
+        # print("Time spent for approximate AVG: %.4fs." % time_cost)
         return result, time_cost
 
     def approx_sum(self, x_min, x_max):
         start = datetime.now()
 
         def f_pRx(*args):
-            return np.exp(self.kde.score_samples(np.array(args).reshape(1, -1))) \
-                   * self.reg.predict([[args[0]]])[0]
+            return self.density(np.array(args).reshape(1, -1))[0] * self.regression([[args[0]]])[0]
             # * self.reg.predict(np.array(args))
 
         # print(integrate.quad(f_pRx, x_min, x_max, epsabs=epsabs, epsrel=epsrel)[0])
-        result = integrate.quad(f_pRx, x_min, x_max, epsabs=self.config['epsabs'], epsrel=self.config['epsrel'])[
-                     0] * float(self.n_total_point)
+        if self.integration_method == 'quad':
+            result = integrate.quad(f_pRx, x_min, x_max, epsabs=self.config['epsabs'],
+                                    epsrel=self.config['epsrel'])[0]
+        else:
+            result = self.evaluate_integrals(x_min, x_max)[1]
+        result = result * float(self.n_total_point)
         # return result
 
         # result = result / float(self.n_training_point) * float(self.n_total_point)
 
         # print("Approximate SUM: %.4f." % result)
 
-        if self.config['verbose'] and result != None:
-            end = datetime.now()
-            time_cost = (end - start).total_seconds()
-            # print("Time spent for approximate SUM: %.4fs." % time_cost)
+        end = datetime.now()
+        time_cost = (end - start).total_seconds()
+        # print("Time spent for approximate SUM: %.4fs." % time_cost)
         return result, time_cost
 
     def approx_count(self, x_min, x_max):
         start = datetime.now()
 
         def f_p(*args):
-            return np.exp(self.kde.score_samples(np.array(args).reshape(1, -1)))
+            return self.density(np.array(args).reshape(1, -1))[0]
 
-        result = integrate.quad(f_p, x_min, x_max, epsabs=self.config['epsabs'], epsrel=self.config['epsrel'])[0]
+        if self.integration_method == 'quad':
+            result = integrate.quad(f_p, x_min, x_max, epsabs=self.config['epsabs'],
+                                    epsrel=self.config['epsrel'])[0]
+        else:
+            result = self.evaluate_integrals(x_min, x_max, b_reg=False)[0]
         result = result * float(self.n_total_point)
 
         # print("Approximate COUNT: %.4f." % result)
-        if self.config['verbose'] and result != None:
-            end = datetime.now()
-            time_cost = (end - start).total_seconds()
-            # print("Time spent for approximate COUNT: %.4fs." % time_cost)
+        end = datetime.now()
+        time_cost = (end - start).total_seconds()
+        # print("Time spent for approximate COUNT: %.4fs." % time_cost)
         return result, time_cost
 
-    def predict(self,func, x_lb, x_ub):
+    def approx_variance(self, x_min, x_max):
+        """
+        VARIANCE over [x_min, x_max], E[y^2] - E[y]^2, where E[y^2] integrates p(x)*(R(x)^2 + V(x)).
+        The integrals are looked up in the cumulative table if it has them, or evaluated on mesh_grid_num nodes.
+
+        :return: the variance, or None if the model has no residual variance or the range is empty, time cost
+        """
+        start = datetime.now()
+        result = None
+        if self.variance is None:
+            print("The model does not keep the variance of y, please create it again to answer VARIANCE.")
+        else:
+            int_py2 = None
+            if self.integration_method == 'table':
+                int_p, int_pr = self.cumulative.integrate(x_min, x_max)
+                int_py2 = self.cumulative.integrate_square(x_min, x_max)
+            if int_py2 is None:
+                # the range is restricted to the support of the density
+                pad = 3 * get_bandwidth(self.kde)
+                x_min, x_max = max(x_min, self.x_min - pad), min(x_max, self.x_max + pad)
+                int_p = 0.0
+            if int_py2 is None and x_min < x_max:
+                method = self.integration_method if self.integration_method in ('gauss', 'grid') else 'gauss'
+                nodes, weights = get_integration_nodes(x_min, x_max, self.config['mesh_grid_num'], method=method)
+                nodes = nodes.reshape(-1, 1)
+                p = self.density(nodes)
+                r = self.regression(nodes)
+                int_p, int_pr = np.dot(weights, p), np.dot(weights, p * r)
+                int_py2 = np.dot(weights, p * (r * r + self.variance.predict(nodes)))
+            if int_p:
+                avg = int_pr / int_p
+                result = max(float(int_py2 / int_p - avg * avg), 0.0)
+        end = datetime.now()
+        time_cost = (end - start).total_seconds()
+        return result, time_cost
+
+    def approx_percentile(self, x_min, x_max, percentile):
+        """
+        PERCENTILE(x, percentile) over [x_min, x_max], by inverting the cumulative integral of p(x): that of the
+        cumulative table if the model has one, or one computed on cumulative_grid_num points over the range.
+
+        :return: the percentile, or None if the density is zero over the range, time cost
+        """
+        start = datetime.now()
+        if self.integration_method == 'table':
+            result = self.cumulative.get_percentile(x_min, x_max, percentile)
+        else:
+            # the range is restricted to the support of the density
+            pad = 3 * get_bandwidth(self.kde)
+            grid = np.linspace(max(x_min, self.x_min - pad), min(x_max, self.x_max + pad),
+                               max(int(self.config.get('cumulative_grid_num', 1000)), 2))
+            if grid[-1] > grid[0]:
+                p = self.density(grid.reshape(-1, 1))
+                cum_p = np.concatenate(([0.0], np.cumsum(0.5 * (p[1:] + p[:-1]) * np.diff(grid))))
+                result = get_percentile(grid, cum_p, x_min, x_max, percentile)
+            else:
+                result = None
+        end = datetime.now()
+        time_cost = (end - start).total_seconds()
+        return result, time_cost
+
+    def predict(self,func, x_lb, x_ub, percentile=None):
+        """
+        :param percentile: the fraction of PERCENTILE(x, percentile), between 0 and 1.
+        """
         if func.lower() == "count":
             p,t = self.approx_count(x_lb, x_ub)
         elif func.lower() == "sum":
             p,t = self.approx_sum(x_lb, x_ub)
         elif func.lower() == "avg":
             p,t = self.approx_avg(x_lb, x_ub)
+        elif func.lower() == "variance":
+            p,t = self.approx_variance(x_lb, x_ub)
+        elif func.lower() == "stddev":
+            p,t = self.approx_variance(x_lb, x_ub)
+            p = None if p is None else float(np.sqrt(p))
+        elif func.lower() == "percentile":
+            p,t = self.approx_percentile(x_lb, x_ub, float(percentile))
         else:
             print("Aggregate function " + func + " is not implemented yet!")
+            p, t = None, 0.0
         return p,t
 
+    def evaluate_integrals_many(self, x_lbs, x_ubs, b_reg=True):
+        """
+        integrate p(x) and p(x)*R(x) over many ranges. The bounds of all ranges split the domain into segments,
+        each integrated once on its own nodes, and the integral over a range is the difference of the cumulative
+        integrals at its bounds, so that adjacent or overlapping ranges share their density and regression
+        evaluations.
+
+        :return: integrals of p(x), integrals of p(x)*R(x) (None if b_reg is False), as arrays over the ranges
+        """
+        if self.integration_method == 'table':
+            int_p, int_pr = self.cumulative.integrate_many(x_lbs, x_ubs)
+            return int_p, int_pr if b_reg else None
+        breakpoints, inverse = np.unique(np.concatenate((x_lbs, x_ubs)), return_inverse=True)
+        lbs, ubs = inverse[:len(x_lbs)], inverse[len(x_lbs):]
+        if len(breakpoints) < 2:
+            return np.zeros(len(x_lbs)), np.zeros(len(x_lbs)) if b_reg else None
+
+        # the nodes and weights on [0, 1], scaled to every segment
+        method = self.integration_method if self.integration_method in ('gauss', 'grid') else 'gauss'
+        nodes, weights = get_integration_nodes(0.0, 1.0, self.config['mesh_grid_num'], method=method)
+        widths = np.diff(breakpoints)
+        nodes = (breakpoints[:-1, np.newaxis] + widths[:, np.newaxis] * nodes).reshape(-1, 1)
+        weights = widths[:, np.newaxis] * weights
+
+        p = self.density(nodes).reshape(weights.shape) * weights
+        cum_p = np.concatenate(([0.0], np.cumsum(p.sum(axis=1))))
+        if not b_reg:
+            return cum_p[ubs] - cum_p[lbs], None
+        r = self.regression(nodes).reshape(weights.shape)
+        cum_pr = np.concatenate(([0.0], np.cumsum((p * r).sum(axis=1))))
+        return cum_p[ubs] - cum_p[lbs], cum_pr[ubs] - cum_pr[lbs]
+
+    def predict_many(self, func, x_lbs, x_ubs):
+        """
+        evaluate an aggregate over many ranges in one call, see evaluate_integrals_many().
+        With the 'quad' integration method, the ranges are integrated with Gauss-Legendre nodes instead.
+
+        :param func: the aggregate function, COUNT, SUM or AVG.
+        :param x_lbs: the lower bounds of the ranges.
+        :param x_ubs: the upper bounds of the ranges.
+        :return: the array of estimates (NaN where AVG is undefined), time cost
+        """
+        start = datetime.now()
+        x_lbs = np.asarray(x_lbs, dtype=float).reshape(-1)
+        x_ubs = np.asarray(x_ubs, dtype=float).reshape(-1)
+        int_p, int_pr = self.evaluate_integrals_many(x_lbs, x_ubs, b_reg=func.lower() != "count")
+        if func.lower() == "count":
+            results = int_p * float(self.n_total_point)
+        elif func.lower() == "sum":
+            results = int_pr * float(self.n_total_point)
+        elif func.lower() == "avg":
+            with np.errstate(divide='ignore', invalid='ignore'):
+                results = np.where(int_p != 0, int_pr / np.where(int_p != 0, int_p, 1.0), np.nan)
+        else:
+            print("Aggregate function " + func + " is not implemented yet!")
+            results = np.full(len(x_lbs), np.nan)
+        end = datetime.now()
+        time_cost = (end - start).total_seconds()
+        return results, time_cost
+
+class MultivariateQueryEngine(QueryEngine):
+    """
+    evaluate queries on a model over several columns, whose WHERE clause is a box: x_lb and x_ub are the bounds of
+    each column, in the order of the columns of the model.
+    The density and the regression are evaluated once, in a batch, over the nodes of the box: a tensor grid of
+    mesh_grid_num nodes per column with the 'gauss' and 'grid' integration methods, or qmc_point_num quasi-Monte
+    Carlo nodes otherwise.
+    """
+
+    def __init__(self, reg, kde, n_training_point, n_total_point, x_min, x_max, config=None, metrics=None):
+        super().__init__(reg, kde, n_training_point, n_total_point, x_min, x_max, config, metrics=metrics)
+        method = self.config.get('integration_method', 'quad')
+        self.integration_method = method if method in ('gauss', 'grid') else 'qmc'
+
+    def evaluate_integrals(self, x_min, x_max, b_reg=True):
+        """
+        integrate p(x) and p(x)*R(x) over the box [x_min, x_max], restricted to the support of the density, so that
+        unbounded columns and the nodes far from the data cost nothing.
+
+        :return: integral of p(x), integral of p(x)*R(x) (None if b_reg is False)
+        """
+        support_lb, support_ub = self.kde.get_support()
+        x_min = np.maximum(np.asarray(x_min, dtype=float), support_lb)
+        x_max = np.minimum(np.asarray(x_max, dtype=float), support_ub)
+        if np.any(x_min >= x_max):
+            return 0.0, 0.0 if b_reg else None
+        n = self.config['mesh_grid_num'] if self.integration_method != 'qmc' else \
+            self.config.get('qmc_point_num', 4096)
+        nodes, weights = get_box_integration_nodes(x_min, x_max, n, method=self.integration_method)
+        p = self.density(nodes)
+        int_p = np.dot(weights, p)
+        if not b_reg:
+            return int_p, None
+        r = self.regression(nodes)
+        return int_p, np.dot(weights, p * r)
+
+    def predict_many(self, func, x_lbs, x_ubs):
+        print("Histograms are not supported by models over several columns.")
+        return np.full(len(x_lbs), np.nan), 0.0
+
+    def approx_variance(self, x_min, x_max):
+        print("VARIANCE is not supported by models over several columns.")
+        return None, 0.0
+
+    def approx_percentile(self, x_min, x_max, percentile):
+        print("PERCENTILE is not supported by models over several columns.")
+        return None, 0.0
+
+
+class GroupByQueryEngine:
+    """
+    evaluate a query for all the groups of a group by model at once.
+    If every group has a cumulative table of the same size, the tables are stacked into arrays, and all groups are
+    answered by one vectorized lookup. Otherwise, every group is evaluated on a shared set of integration nodes, and
+    the integrals of all groups are computed in one pass. The 'quad' integration method is not batched, see
+    SqlExecutor.predict_groupby().
+    """
+
+    def __init__(self, models, config):
+        """
+        :param models: the per-group SimpleModelWrappers, as held in the model catalog.
+        :param config: the configuration.
+        """
+        self.config = config
+        self.integration_method = self.config.get('integration_method', 'quad')
+        self.model_wrappers = list(models.values())
+        self.group_values = [model_wrapper.groupby_value for model_wrapper in self.model_wrappers]
+        self.n_total_point = np.array([float(model_wrapper.n_total_point) for model_wrapper in self.model_wrappers])
+
+        cumulatives = [getattr(model_wrapper, 'cumulative', None) for model_wrapper in self.model_wrappers]
+        self.b_table = self.integration_method == 'table' and all(cumulative is not None for cumulative in cumulatives) \
+            and len(set(len(cumulative.grid) for cumulative in cumulatives)) == 1
+        if self.b_table:
+            # the grids are uniform, so that the lookup position is computed directly, without searching.
+            self.grid_start = np.array([cumulative.grid[0] for cumulative in cumulatives])
+            self.grid_end = np.array([cumulative.grid[-1] for cumulative in cumulatives])
+            self.grid_step = np.array([cumulative.grid[1] - cumulative.grid[0] for cumulative in cumulatives])
+            self.cum_p = np.vstack([cumulative.cum_p for cumulative in cumulatives])
+            self.cum_pr = np.vstack([cumulative.cum_pr for cumulative in cumulatives])
+
+    def _lookup(self, x):
+        x = np.clip(x, self.grid_start, self.grid_end)
+        position = (x - self.grid_start) / self.grid_step
+        idx = np.minimum(np.floor(position).astype(int), self.cum_p.shape[1] - 2)
+        frac = position - idx
+        rows = np.arange(len(idx))
+        cum_p = self.cum_p[rows, idx] + frac * (self.cum_p[rows, idx + 1] - self.cum_p[rows, idx])
+        cum_pr = self.cum_pr[rows, idx] + frac * (self.cum_pr[rows, idx + 1] - self.cum_pr[rows, idx])
+        return cum_p, cum_pr
+
+    def evaluate_integrals(self, x_min, x_max, b_reg=True, metrics=None):
+        """
+        :param metrics: the QueryMetrics of the query, if it is traced.
+        :return: the integrals of p(x) and of p(x)*R(x) over [x_min, x_max], as arrays over the groups.
+            The latter is None if b_reg is False.
+        """
+        if self.b_table:
+            cum_p_lb, cum_pr_lb = self._lookup(x_min)
+            cum_p_ub, cum_pr_ub = self._lookup(x_max)
+            return cum_p_ub - cum_p_lb, cum_pr_ub - cum_pr_lb
+
+        method = self.integration_method if self.integration_method in ('gauss', 'grid') else 'gauss'
+        nodes, weights = get_integration_nodes(x_min, x_max, self.config['mesh_grid_num'], method=method)
+        nodes = nodes.reshape(-1, 1)
+        start = datetime.now()
+        p = np.vstack([np.exp(model_wrapper.density.score_samples(nodes)) for model_wrapper in self.model_wrappers])
+        if metrics is not None:
+            metrics.add_time('density', (datetime.now() - start).total_seconds())
+            metrics.count('density_evaluations', p.size)
+        if not b_reg:
+            return np.dot(p, weights), None
+        start = datetime.now()
+        r = np.vstack([np.asarray(model_wrapper.reg.predict(nodes), dtype=float).reshape(-1)
+                       for model_wrapper in self.model_wrappers])
+        if metrics is not None:
+            metrics.add_time('regression', (datetime.now() - start).total_seconds())
+            metrics.count('regression_evaluations', r.size)
+        return np.dot(p, weights), np.dot(p * r, weights)
+
+    def predict(self, func, x_lb, x_ub, metrics=None):
+        """
+        :param metrics: the QueryMetrics of the query, if it is traced, which gets the integrate and format stages.
+        :return: {group_value: estimate}, time cost
+        """
+        start = datetime.now()
+        int_p, int_pr = self.evaluate_integrals(x_lb, x_ub, b_reg=func.lower() != "count", metrics=metrics)
+        if func.lower() == "count":
+            results = int_p * self.n_total_point
+        elif func.lower() == "sum":
+            results = int_pr * self.n_total_point
+        elif func.lower() == "avg":
+            with np.errstate(divide='ignore', invalid='ignore'):
+                results = np.where(int_p != 0, int_pr / np.where(int_p != 0, int_p, 1.0), np.nan)
+        else:
+            print("Aggregate function " + func + " is not implemented yet!")
+            results = np.full(len(self.group_values), np.nan)
+        integrated = datetime.now()
+        predictions = {}
+        for group_value, result in zip(self.group_values, results.tolist()):
+            predictions[group_value] = None if np.isnan(result) else result
+        end = datetime.now()
+        if metrics is not None:
+            metrics.add_time('integrate', (integrated - start).total_seconds())
+            metrics.add_time('format', (end - integrated).total_seconds())
+        time_cost = (end - start).total_seconds()
+        return predictions, time_cost
+
+
+def get_query_engine(model_wrapper, config=None, metrics=None):
+    """
+    build the QueryEngine for a SimpleModelWrapper.
+
+    :param metrics: the QueryMetrics of the query, if it is traced.
+    """
+    if len(model_wrapper.get_xheaders()) > 1:
+        return MultivariateQueryEngine(model_wrapper.reg, model_wrapper.density, int(model_wrapper.n_sample_point),
+                                       int(model_wrapper.n_total_point), np.asarray(model_wrapper.x_min_value),
+                                       np.asarray(model_wrapper.x_max_value), config, metrics=metrics)
+    return QueryEngine(model_wrapper.reg, model_wrapper.density, int(model_wrapper.n_sample_point),
+                       int(model_wrapper.n_total_point), float(model_wrapper.x_min_value),
+                       float(model_wrapper.x_max_value), config,
+                       cumulative=getattr(model_wrapper, 'cumulative', None), metrics=metrics,
+                       variance=getattr(model_wrapper, 'variance', None))
+
+
 if __name__ == "__main__":
     pass
 
@@ -0,0 +1,105 @@
+# Created by Qingzhi Ma at 2019-07-26
+# All right reserved
+# Department of Computer Science
+# the University of Warwick
+# Q.Ma.2@warwick.ac.uk
+from collections import OrderedDict
+import json
+import os
+import threading
+
+
+def _normalize_bound(bound):
+    # the bounds of several columns are kept as a string, so that the key stays hashable once read back from JSON
+    if isinstance(bound, (list, tuple)):
+        return ",".join(repr(float(value)) for value in bound)
+    return float(bound)
+
+
+class QueryResultCache:
+    """
+    An LRU cache of query results.
+    Queries are keyed on their normalized form (model, model version, aggregate function, columns, bounds and
+    group by), so that a rebuilt model, which gets a new version, never answers from the results of the former one.
+    """
+
+    def __init__(self, max_size=1024, file=None):
+        """
+        :param max_size: the maximum number of results kept.
+        :param file: if given, the cache is loaded from this file, and saved to it by save().
+        """
+        self.max_size = int(max_size)
+        self.file = file
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if file is not None and os.path.exists(file):
+            self.load()
+
+    @staticmethod
+    def get_key(model_key, version, func, y, x, x_lb, x_ub, groupby_attribute=None, integration_method=None):
+        """
+        :param x: the column of the WHERE clause, or its columns joined by commas, whose bounds are then lists.
+        :return: the normalized key of a query.
+        """
+        return (model_key, version, func.lower(), y, x, _normalize_bound(x_lb), _normalize_bound(x_ub),
+                groupby_attribute, integration_method)
+
+    def get(self, key):
+        """
+        :return: the cached result, or None if the query is not cached.
+        """
+        with self.lock:
+            if key in self.results:
+                self.results.move_to_end(key)
+                self.hits += 1
+                return self.results[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, result):
+        if result is None:
+            return
+        with self.lock:
+            self.results[key] = result
+            self.results.move_to_end(key)
+            while len(self.results) > self.max_size:
+                self.results.popitem(last=False)
+
+    def invalidate(self, model_key):
+        """
+        drop the results of a model, for instance after it is rebuilt.
+        """
+        with self.lock:
+            for key in [key for key in self.results if key[0] == model_key]:
+                del self.results[key]
+
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+
+    def __len__(self):
+        return len(self.results)
+
+    def get_stats(self):
+        return {'size': len(self.results), 'hits': self.hits, 'misses': self.misses}
+
+    def save(self):
+        if self.file is None:
+            return
+        with self.lock:
+            items = [[list(key), result] for key, result in self.results.items()]
+        with open(self.file + ".tmp", 'w') as f:
+            json.dump(items, f)
+        os.replace(self.file + ".tmp", self.file)
+
+    def load(self):
+        try:
+            with open(self.file, 'r') as f:
+                items = json.load(f)
+        except ValueError:
+            print("The result cache " + self.file + " is corrupted, ignore it.")
+            return
+        for key, result in items[-self.max_size:]:
+            self.results[tuple(key)] = result
@@ -16,8 +16,12 @@ except NameError:
     pass
 
 from sys import stderr, stdin
-from random import random
+from random import random, sample
 from math import log
+from collections import Counter
+from multiprocessing import Pool
+import mmap
+import numpy as np
 import pandas as pd
 
 
@@ -25,11 +29,22 @@ class ReservoirSampling:
     def __init__(self):
         self.header = None
         self.n_total_point = None
+        self.group_counts = None
         self.sampledf = None
 
-    def build_reservoir(self, file, R, threshold=None, verbose=False,split_char=","):
+    def build_reservoir(self, file, R, threshold=None, verbose=False,split_char=",", groupby_attribute=None):
+        """
+        build the reservoir in a single pass over the file. The number of rows, and the number of rows in each
+        group if groupby_attribute is given, are counted in the same pass.
 
-        self.n_total_point = sum(1 for _ in open(file)) - 1
+        :param file: the csv file, with a header row.
+        :param R: the size of the reservoir.
+        :param threshold: the number of rows after which gaps are used to skip rows, 4*R by default.
+        :param verbose: whether to print the replacements.
+        :param split_char: the delimiter of the csv file.
+        :param groupby_attribute: the column to count the group sizes of, if any.
+        """
+        self.group_counts = None
 
         with open(file,'r') as data:
             if verbose:
@@ -47,12 +62,26 @@ class ReservoirSampling:
             # skip the first header row
             first_row = next(iterator)
             self.header = first_row.replace("\n",'').split(split_char)
+
+            if groupby_attribute is not None:
+                group_idx = self.header.index(groupby_attribute)
+                group_counts = {}
+                self.group_counts = group_counts
+
+                def count_group(row):
+                    group_value = row.replace("\n", '').split(split_char)[group_idx]
+                    group_counts[group_value] = group_counts.get(group_value, 0) + 1
+            else:
+                def count_group(_):
+                    pass
+
+            j = 0
             try:
-                j = 0
                 # iterator = iter(data)
                 while True:
-                    j += 1
                     item = next(iterator)
+                    j += 1
+                    count_group(item)
                     if len(res) < R:
                         item = item.replace("\n",'').split(split_char)
                         p('> Adding element nb {0}: {1!r}', len(res), item)
@@ -65,28 +94,33 @@ class ReservoirSampling:
                             item = item.replace("\n",'').split(split_char)
                             res[k] = item
                     else:
+                        # the current row is the first candidate, so the replaced row is the (gap+1)-th from here.
                         gap = int(log(random()) / log(1 - R / j))
-                        j += gap
                         for _ in range(gap):
                             item = next(iterator)
+                            j += 1
+                            count_group(item)
                         k = int(random() * R)
                         p('> After skipping {0:>9} lines, swap element nb {1:>5}: {2!r} replaces {3!r}', gap, k, item, res[k])
-                        item = next(iterator).replace("\n", '').split(split_char)
-                        res[k] = item
+                        res[k] = item.replace("\n", '').split(split_char)
 
             except KeyboardInterrupt:
                 print('\n! User interrupted the process, stopping now\n', file=stderr)
             except StopIteration:
                 pass
 
+            self.n_total_point = j
             self.sampledf =  pd.DataFrame(res, columns=self.header)
 
 
     def getyx(self, y, x, dropna=True):
+        # x is a column, or a list of columns for a model over several columns
+        xs = list(x) if isinstance(x, (list, tuple)) else [x]
         # drop non-numerical values.
         if dropna:
-            self.sampledf = self.sampledf.dropna(subset=[y, x])
-        self.sampledf[x] = pd.to_numeric(self.sampledf[x], errors='coerce').fillna(0)
+            self.sampledf = self.sampledf.dropna(subset=[y] + xs)
+        for column in xs:
+            self.sampledf[column] = pd.to_numeric(self.sampledf[column], errors='coerce').fillna(0)
         self.sampledf[y] = pd.to_numeric(self.sampledf[y], errors='coerce').fillna(0)
 
         return self.sampledf
@@ -99,6 +133,378 @@ class ReservoirSampling:
         #     return xyvalues
 
 
+class StratifiedReservoirSampling(ReservoirSampling):
+    """
+    Keep a bounded reservoir for each group value, in a single pass over the file.
+    After the pass, each group keeps a share of the sample size proportional to its size, but at least group_floor
+    points (or the whole group if it is smaller), and at most group_cap points.
+    """
+
+    def build_reservoir(self, file, R, threshold=None, verbose=False, split_char=",", groupby_attribute=None,
+                        group_cap=None, group_floor=100):
+        """
+        :param file: the csv file, with a header row.
+        :param R: the total sample size, shared among the groups.
+        :param groupby_attribute: the column to stratify on.
+        :param group_cap: the maximum number of points kept for a group, R by default.
+        :param group_floor: the minimum number of points kept for a group, if it has as many.
+        """
+        if groupby_attribute is None:
+            raise ValueError("Stratified sampling requires a group by attribute.")
+        if group_cap is None:
+            group_cap = R
+        group_floor = min(group_floor, group_cap)
+
+        reservoirs = {}
+        group_counts = {}
+        with open(file, 'r') as data:
+            iterator = iter(data)
+            self.header = next(iterator).replace("\n", '').split(split_char)
+            group_idx = self.header.index(groupby_attribute)
+            j = 0
+            try:
+                for item in iterator:
+                    j += 1
+                    item = item.replace("\n", '').split(split_char)
+                    group_value = item[group_idx]
+                    n = group_counts.get(group_value, 0) + 1
+                    group_counts[group_value] = n
+                    if n <= group_cap:
+                        reservoirs.setdefault(group_value, []).append(item)
+                    else:
+                        k = int(random() * n)
+                        if k < group_cap:
+                            reservoirs[group_value][k] = item
+            except KeyboardInterrupt:
+                print('\n! User interrupted the process, stopping now\n', file=stderr)
+
+        self._merge_reservoirs(reservoirs, group_counts, j, R, group_floor, reservoirs.keys())
+
+    def _merge_reservoirs(self, reservoirs, group_counts, n_total_point, R, group_floor, shared_groups):
+        # the reservoirs of shared_groups are cut to the share of their group, the others are kept as they are.
+        res = []
+        for group_value, reservoir in reservoirs.items():
+            if group_value in shared_groups:
+                share = max(group_floor, int(round(R * group_counts[group_value] / float(n_total_point))))
+                if share < len(reservoir):
+                    reservoir = sample(reservoir, share)
+            res.extend(reservoir)
+
+        self.n_total_point = n_total_point
+        self.group_counts = group_counts
+        self.sampledf = pd.DataFrame(res, columns=self.header)
+
+    def update_reservoir(self, file, rows, n_total_point, group_counts, R, split_char=",", groupby_attribute=None,
+                         group_cap=None, group_floor=100):
+        """
+        continue a stratified sample with the rows of file, as if they were appended to the sampled file.
+        The sample of a group that has been cut to its share stays a reservoir of that size. The groups that were
+        kept whole, and the new groups, get up to group_cap points, and are then cut to their share, as in
+        build_reservoir().
+
+        :param rows: the rows of the sample, tokenized.
+        :param n_total_point: the number of rows sampled so far.
+        :param group_counts: the number of rows of each group sampled so far.
+        """
+        if group_cap is None:
+            group_cap = R
+        group_floor = min(group_floor, group_cap)
+        group_counts = dict(group_counts)
+
+        with open(file, 'r') as data:
+            iterator = iter(data)
+            self.header = next(iterator).replace("\n", '').split(split_char)
+            group_idx = self.header.index(groupby_attribute)
+            reservoirs = {}
+            for item in rows:
+                reservoirs.setdefault(item[group_idx], []).append(item)
+            capacities = {group_value: group_cap if len(reservoir) >= group_counts[group_value] else len(reservoir)
+                          for group_value, reservoir in reservoirs.items()}
+            growing = set(group_value for group_value, capacity in capacities.items() if capacity == group_cap)
+
+            j = n_total_point
+            for item in iterator:
+                j += 1
+                item = item.replace("\n", '').split(split_char)
+                group_value = item[group_idx]
+                n = group_counts.get(group_value, 0) + 1
+                group_counts[group_value] = n
+                if group_value not in capacities:
+                    capacities[group_value] = group_cap
+                    growing.add(group_value)
+                reservoir = reservoirs.setdefault(group_value, [])
+                if len(reservoir) < capacities[group_value]:
+                    reservoir.append(item)
+                else:
+                    k = int(random() * n)
+                    if k < capacities[group_value]:
+                        reservoir[k] = item
+
+        self._merge_reservoirs(reservoirs, group_counts, j, R, group_floor, growing)
+
+
+class ChunkedReservoirSampling(ReservoirSampling):
+    """
+    Algorithm L reservoir sampling over large byte blocks of the file.
+    Row boundaries are found with NumPy, the skip gaps are drawn from batches of NumPy random numbers, and only the
+    rows that enter the reservoir are decoded and tokenized.
+    """
+
+    def __init__(self, seed=None):
+        ReservoirSampling.__init__(self)
+        self.rng = np.random.RandomState(seed)
+        self.split_char = ","
+        self.group_idx = None
+        self.R = 0
+        self.res = []
+        self.log_w = 0.0
+        self.last_pick = 0.0
+        self.picks = np.empty(0)
+        self.slots = np.empty(0, dtype=np.int64)
+
+    def _draw_picks(self, n=4096):
+        """
+        draw the next n rows to enter the reservoir, and the slots they replace, following Algorithm L:
+        W <- W * u^(1/R), and the gap to the next row is floor(log(v) / log(1 - W)) + 1.
+        """
+        # random_sample() is in [0, 1), while the logarithms below need (0, 1].
+        u, v, s = 1.0 - self.rng.random_sample((3, n))
+        log_w = self.log_w + np.cumsum(np.log(u)) / self.R
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            # once W underflows, the gaps are infinite: no more row enters the reservoir.
+            gaps = np.floor(np.log(v) / np.log1p(-np.exp(log_w))) + 1
+            picks = self.last_pick + np.cumsum(np.where(np.isnan(gaps), 1.0, gaps))
+        self.log_w = log_w[-1]
+        self.last_pick = picks[-1]
+        self.picks = np.concatenate((self.picks, picks))
+        self.slots = np.concatenate((self.slots, np.minimum((s * self.R).astype(np.int64), self.R - 1)))
+
+    def init_reservoir(self, R, split_char=",", group_idx=None):
+        """
+        reset the state of the sampler, before scanning buffers with scan_buffer().
+
+        :param R: the size of the reservoir.
+        :param split_char: the delimiter of the csv file.
+        :param group_idx: the index of the column to count the group sizes of, if any.
+        """
+        self.R = R
+        self.split_char = split_char
+        self.group_idx = group_idx
+        self.group_counts = {} if group_idx is not None else None
+        self.res = []
+        self.n_total_point = 0
+        self.log_w = 0.0
+        self.last_pick = R - 1.0
+        self.picks = np.empty(0)
+        self.slots = np.empty(0, dtype=np.int64)
+
+    def scan_buffer(self, buf, start, end):
+        """
+        continue the sampling over the rows of buf[start:end]. The range holds whole rows, each ended by a newline.
+        """
+        ends = np.flatnonzero(np.frombuffer(buf, dtype=np.uint8, count=end - start, offset=start) == 10) + start
+        starts = np.concatenate(([start], ends[:-1] + 1))
+        n_row = len(ends)
+        first_row = self.n_total_point
+
+        # the first R rows fill the reservoir
+        n_fill = max(0, min(self.R - first_row, n_row))
+        for i in range(n_fill):
+            self.res.append(buf[starts[i]:ends[i]])
+
+        if self.R > 0:
+            # the rows picked in this range; only the last row picked for a slot has to be kept.
+            while len(self.picks) == 0 or self.picks[-1] < first_row + n_row:
+                self._draw_picks()
+            n_pick = np.searchsorted(self.picks, first_row + n_row)
+            picks = (self.picks[:n_pick] - first_row).astype(np.int64)
+            slots = self.slots[:n_pick]
+            self.picks = self.picks[n_pick:]
+            self.slots = self.slots[n_pick:]
+            slots, last = np.unique(slots[::-1], return_index=True)
+            for slot, i in zip(slots.tolist(), picks[::-1][last].tolist()):
+                self.res[slot] = buf[starts[i]:ends[i]]
+
+        if self.group_idx is not None:
+            group_idx = self.group_idx
+            split_char = self.split_char.encode()
+            counts = Counter(row.split(split_char)[group_idx]
+                             for row in bytes(buf[start:end - 1]).replace(b"\r", b"").split(b"\n"))
+            for group_value, count in counts.items():
+                group_value = group_value.decode()
+                self.group_counts[group_value] = self.group_counts.get(group_value, 0) + count
+
+        self.n_total_point += n_row
+
+    def get_rows(self):
+        """
+        :return: the rows in the reservoir, tokenized.
+        """
+        return [bytes(row).decode().rstrip("\r").split(self.split_char) for row in self.res]
+
+    def build_reservoir(self, file, R, threshold=None, verbose=False, split_char=",", groupby_attribute=None,
+                        chunk_size=1 << 24):
+        """
+        build the reservoir in a single pass over the file, reading chunk_size bytes at a time.
+        The number of rows, and the number of rows in each group if groupby_attribute is given,
+        are counted in the same pass. threshold and verbose are accepted for compatibility, and ignored.
+        """
+        with open(file, 'rb') as data:
+            self.header = data.readline().decode().rstrip("\r\n").split(split_char)
+            group_idx = self.header.index(groupby_attribute) if groupby_attribute is not None else None
+            self.init_reservoir(R, split_char=split_char, group_idx=group_idx)
+            self.scan_file(data, chunk_size)
+
+        self.sampledf = pd.DataFrame(self.get_rows(), columns=self.header)
+
+    def scan_file(self, data, chunk_size=1 << 24):
+        """
+        continue the sampling over the rows of an open file, reading chunk_size bytes at a time.
+        """
+        remainder = b''
+        while True:
+            block = data.read(chunk_size)
+            if not block:
+                break
+            block = remainder + block
+            last_newline = block.rfind(b'\n')
+            if last_newline < 0:
+                remainder = block
+                continue
+            remainder = block[last_newline + 1:]
+            self.scan_buffer(block, 0, last_newline + 1)
+        if remainder.strip():
+            self.scan_buffer(remainder + b'\n', 0, len(remainder) + 1)
+
+    def update_reservoir(self, file, rows, n_total_point, R, group_counts=None, split_char=",",
+                         groupby_attribute=None, chunk_size=1 << 24):
+        """
+        continue a reservoir of size R, built over n_total_point rows, with the rows of file, as if they were
+        appended to the sampled file. Only the new rows are read.
+        After n rows, the W of Algorithm L is distributed as the R-th smallest of n uniform numbers,
+        Beta(R, n - R + 1), whatever rows are in the reservoir, so it is drawn again instead of being stored.
+
+        :param rows: the rows of the reservoir, as lines.
+        :param group_counts: the number of rows of each group sampled so far, if groupby_attribute is given.
+        """
+        with open(file, 'rb') as data:
+            self.header = data.readline().decode().rstrip("\r\n").split(split_char)
+            group_idx = self.header.index(groupby_attribute) if groupby_attribute is not None else None
+            self.init_reservoir(R, split_char=split_char, group_idx=group_idx)
+            self.res = [row.encode() for row in rows]
+            self.n_total_point = n_total_point
+            if group_idx is not None:
+                self.group_counts = dict(group_counts)
+            if n_total_point >= R > 0:
+                # the next row to enter the reservoir, the (gap)-th row after the last one sampled
+                self.log_w = np.log(self.rng.beta(R, n_total_point - R + 1))
+                v, s = 1.0 - self.rng.random_sample(2)
+                with np.errstate(divide='ignore'):
+                    gap = np.floor(np.log(v) / np.log1p(-np.exp(self.log_w))) + 1
+                self.last_pick = n_total_point - 1.0 + (gap if np.isfinite(gap) else np.inf)
+                self.picks = np.array([self.last_pick])
+                self.slots = np.array([min(int(s * R), R - 1)], dtype=np.int64)
+            self.scan_file(data, chunk_size)
+
+        self.sampledf = pd.DataFrame(self.get_rows(), columns=self.header)
+
+
+def get_byte_ranges(buf, start, n_range):
+    """
+    split buf[start:] into at most n_range ranges of similar size, each ending right after a newline
+    (or at the end of buf).
+
+    :return: a list of (start, end) byte offsets.
+    """
+    size = len(buf)
+    boundaries = [start]
+    for i in range(1, n_range):
+        newline = buf.find(b'\n', start + i * (size - start) // n_range)
+        boundary = size if newline < 0 else newline + 1
+        if boundary > boundaries[-1]:
+            boundaries.append(boundary)
+    if size > boundaries[-1]:
+        boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def _sample_byte_range(task):
+    file, start, end, R, split_char, group_idx, chunk_size, seed = task
+    sampler = ChunkedReservoirSampling(seed)
+    sampler.init_reservoir(R, split_char=split_char, group_idx=group_idx)
+    with open(file, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            position = start
+            while position < end:
+                newline = buf.rfind(b'\n', position, min(position + chunk_size, end))
+                if newline < 0:
+                    newline = buf.find(b'\n', position, end)
+                if newline < 0:
+                    # the last row of the file, without a newline
+                    if buf[position:end].strip():
+                        sampler.scan_buffer(buf[position:end] + b'\n', 0, end - position + 1)
+                    break
+                sampler.scan_buffer(buf, position, newline + 1)
+                position = newline + 1
+        finally:
+            buf.close()
+    return [bytes(row) for row in sampler.res], sampler.n_total_point, sampler.group_counts
+
+
+class ParallelReservoirSampling(ChunkedReservoirSampling):
+    """
+    Sample the file over several processes. The file is memory-mapped and split into byte ranges that end at
+    newlines; each range is sampled by its own process, and the partial reservoirs are merged into a uniform
+    sample of the whole file, by drawing how many rows come from each range from a multivariate hypergeometric
+    distribution over the row counts of the ranges. Row counts and group counts are summed over the ranges.
+    """
+
+    def build_reservoir(self, file, R, threshold=None, verbose=False, split_char=",", groupby_attribute=None,
+                        chunk_size=1 << 24, n_jobs=2):
+        with open(file, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                header_end = buf.find(b'\n')
+                header_end = len(buf) if header_end < 0 else header_end + 1
+                self.header = buf[:header_end].decode().rstrip("\r\n").split(split_char)
+                ranges = get_byte_ranges(buf, header_end, n_jobs)
+            finally:
+                buf.close()
+        group_idx = self.header.index(groupby_attribute) if groupby_attribute is not None else None
+        self.init_reservoir(R, split_char=split_char, group_idx=group_idx)
+
+        seeds = self.rng.randint(0, 2 ** 31 - 1, size=len(ranges))
+        tasks = [(file, start, end, R, split_char, group_idx, chunk_size, seed)
+                 for (start, end), seed in zip(ranges, seeds)]
+        if len(tasks) > 1:
+            pool = Pool(min(n_jobs, len(tasks)))
+            try:
+                results = pool.map(_sample_byte_range, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [_sample_byte_range(task) for task in tasks]
+
+        n_rows = [n_row for _, n_row, _ in results]
+        self.n_total_point = sum(n_rows)
+        n_left = self.n_total_point
+        n_sample = min(R, self.n_total_point)
+        for (rows, n_row, group_counts) in results:
+            # the number of rows of the merged sample that fall into this range
+            n_pick = self.rng.hypergeometric(n_row, n_left - n_row, n_sample) if n_left > n_row else n_sample
+            n_left -= n_row
+            n_sample -= n_pick
+            if n_pick > 0:
+                self.res.extend(rows[i] for i in self.rng.choice(len(rows), n_pick, replace=False))
+            if group_counts is not None:
+                for group_value, count in group_counts.items():
+                    self.group_counts[group_value] = self.group_counts.get(group_value, 0) + count
+
+        self.sampledf = pd.DataFrame(self.get_rows(), columns=self.header)
+
+
 if __name__ == '__main__':
     file = '../../resources/pm25.csv'
     with open(file, 'r') as f:
@@ -3,22 +3,87 @@
 # Department of Computer Science
 # the University of Warwick
 # Q.Ma.2@warwick.ac.uk
-from dbestclient.io.reservoir import ReservoirSampling
+from dbestclient.io.reservoir import ReservoirSampling, ChunkedReservoirSampling, ParallelReservoirSampling, \
+    StratifiedReservoirSampling
+import numpy as np
+import pandas as pd
+from collections import Counter
+import hashlib
+import json
+import os
+
+
+def get_sample_cache_key(file, *options):
+    """
+    :return: (source_key, sample_key). source_key identifies the source file; sample_key also covers its size and
+        modification time and the sampling options, so that a sample is never reused for a modified file.
+    """
+    path = os.path.abspath(file)
+    stat = os.stat(path)
+    source_key = hashlib.md5(path.encode()).hexdigest()[:16]
+    options = json.dumps([stat.st_size, stat.st_mtime_ns] + [str(option) for option in options])
+    sample_key = hashlib.md5(options.encode()).hexdigest()[:16]
+    return source_key, sample_key
+
 
 class DBEstSampling:
     def __init__(self):
         self.n_sample_point = None
         self.n_total_point = None
+        self.group_counts = None
         self.sample = None
+        # the options of the sample, kept with it by save_reservoir()
+        self.options = None
+        # after update_sample(), the number of rows appended to the table,
+        self.n_new_point = None
+        # and the groups whose rows in the sample changed, or whether the sample changed if it
+        # has no group by attribute.
+        self.changed_groups = None
 
-    def make_sample(self, file, ratio,  method='uniform', split_char=','):
-        if method == 'uniform':
+    def make_sample(self, file, ratio,  method='uniform', split_char=',', groupby_attribute=None, group_cap=None,
+                    group_floor=100, n_jobs=1, cache_dir=None):
+        """
+        make the sample of the file in a single pass, which also counts the rows of the file (n_total_point),
+        and the rows of each group (group_counts) if groupby_attribute is given.
+        With method 'hash', the sample is stratified on groupby_attribute: see StratifiedReservoirSampling for
+        group_cap and group_floor.
+        With n_jobs > 1, uniform samples are built over n_jobs processes, see ParallelReservoirSampling.
+        If cache_dir is given, the sample is kept there in a columnar format, and later samples of the same file
+        with the same options are loaded from it instead of scanning the file.
+        """
+        method = method.lower()
+        if method == 'uniform' or method == 'hash':
             if float(ratio) > 1: # here the ratio is the number of tuples in the sample
                 ratio = int(ratio)
-                self.n_sample_point = ratio
-                self.sample = ReservoirSampling()
-                self.sample.build_reservoir(file,ratio,split_char=split_char)
+                self.options = {'method': method, 'ratio': ratio, 'split_char': split_char,
+                                'groupby_attribute': groupby_attribute, 'group_cap': group_cap,
+                                'group_floor': group_floor}
+                if cache_dir is not None:
+                    cache_key = get_sample_cache_key(file, method, ratio, split_char, groupby_attribute,
+                                                     group_cap if method == 'hash' else None,
+                                                     group_floor if method == 'hash' else None)
+                    if self.load_cached_sample(cache_dir, cache_key, groupby_attribute):
+                        return self.sample
+                if method == 'uniform' and n_jobs > 1:
+                    self.sample = ParallelReservoirSampling()
+                    self.sample.build_reservoir(file, ratio, split_char=split_char,
+                                                groupby_attribute=groupby_attribute, n_jobs=n_jobs)
+                elif method == 'uniform':
+                    self.sample = ChunkedReservoirSampling()
+                    self.sample.build_reservoir(file,ratio,split_char=split_char, groupby_attribute=groupby_attribute)
+                else:
+                    if groupby_attribute is None:
+                        print("hash sampling requires a group by attribute, abort.")
+                        return
+                    self.sample = StratifiedReservoirSampling()
+                    self.sample.build_reservoir(file, ratio, split_char=split_char,
+                                                groupby_attribute=groupby_attribute, group_cap=group_cap,
+                                                group_floor=group_floor)
+                self.n_sample_point = self.sample.sampledf.shape[0]
                 self.n_total_point =  self.sample.n_total_point
+                self.group_counts = self.sample.group_counts
+                if cache_dir is not None:
+                    self.save_cached_sample(cache_dir, cache_key, groupby_attribute)
 
                 return self.sample
             else:
@@ -26,6 +91,132 @@ class DBEstSampling:
         else:
             print("other sampling methods are not implemented, abort.")
 
+    def save_cached_sample(self, cache_dir, cache_key, groupby_attribute=None):
+        """
+        save the sample as typed columns: float64 for the columns that are all numbers, unicode otherwise.
+        The group by column is always kept as strings. Older samples of the same source file are removed.
+        """
+        source_key, sample_key = cache_key
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        for file_name in os.listdir(cache_dir):
+            if file_name.startswith(source_key + "_"):
+                os.remove(os.path.join(cache_dir, file_name))
+
+        df = self.sample.sampledf
+        columns = {}
+        for idx, column in enumerate(df.columns):
+            values = np.array(df[column].tolist())
+            if column != groupby_attribute:
+                try:
+                    values = values.astype(np.float64)
+                except ValueError:
+                    pass
+            if values.dtype != np.float64:
+                values = values.astype(str)
+            columns["c%d" % idx] = values
+        meta = {'header': list(df.columns), 'n_total_point': self.n_total_point, 'group_counts': self.group_counts}
+        columns['meta'] = np.array(json.dumps(meta))
+
+        file_name = os.path.join(cache_dir, source_key + "_" + sample_key + ".npz")
+        with open(file_name + ".tmp", 'wb') as f:
+            np.savez(f, **columns)
+        os.replace(file_name + ".tmp", file_name)
+
+    def load_cached_sample(self, cache_dir, cache_key, groupby_attribute=None):
+        """
+        :return: True if the sample is found in the cache, and loaded.
+        """
+        file_name = os.path.join(cache_dir, "_".join(cache_key) + ".npz")
+        if not os.path.exists(file_name):
+            return False
+        with np.load(file_name, allow_pickle=False) as columns:
+            meta = json.loads(str(columns['meta']))
+            df = pd.DataFrame({column: columns["c%d" % idx] for idx, column in enumerate(meta['header'])},
+                              columns=meta['header'])
+        self.sample = ReservoirSampling()
+        self.sample.header = meta['header']
+        self.sample.sampledf = df
+        self.sample.n_total_point = meta['n_total_point']
+        self.sample.group_counts = meta['group_counts']
+        self.n_sample_point = df.shape[0]
+        self.n_total_point = meta['n_total_point']
+        self.group_counts = meta['group_counts']
+        return True
+
+    def get_rows(self):
+        """
+        :return: the rows of the sample, as lines of the csv file.
+        """
+        split_char = self.options['split_char']
+        return [split_char.join(str(value) for value in row) for row in self.sample.sampledf.itertuples(index=False)]
+
+    def save_reservoir(self, file, **metadata):
+        """
+        keep the sample with its options and its row counts, so that it can be continued by update_sample() when
+        rows are appended to the table. This must be called before getyx(), which converts the sample.
+
+        :param metadata: other values to keep with the sample, returned by load_reservoir().
+        """
+        directory = os.path.dirname(file)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        meta = {'header': list(self.sample.sampledf.columns), 'n_total_point': self.n_total_point,
+                'group_counts': self.group_counts, 'options': self.options, 'metadata': metadata}
+        with open(file + ".tmp", 'wb') as f:
+            np.savez(f, rows=np.array(self.get_rows(), dtype=str), meta=np.array(json.dumps(meta)))
+        os.replace(file + ".tmp", file)
+
+    @staticmethod
+    def load_reservoir(file):
+        """
+        :return: the rows kept by save_reservoir(), as lines, and the rest of what it kept, as a dict.
+        """
+        with np.load(file, allow_pickle=False) as arrays:
+            return arrays['rows'].tolist(), json.loads(str(arrays['meta']))
+
+    def update_sample(self, reservoir_file, file):
+        """
+        continue the sample kept in reservoir_file with the rows of file, as if they were appended to the sampled
+        table; only the new rows are read. The row counts are updated, and changed_groups tells which groups of
+        the sample changed. Use save_reservoir() to keep the updated sample.
+
+        :return: the metadata kept with the sample.
+        """
+        rows, meta = self.load_reservoir(reservoir_file)
+        self.options = options = meta['options']
+        split_char, groupby_attribute = options['split_char'], options['groupby_attribute']
+        with open(file, 'r') as f:
+            header = f.readline().rstrip("\r\n").split(split_char)
+        if header != meta['header']:
+            raise ValueError("The columns of " + file + " differ from the columns of the sampled table.")
+
+        if options['method'] == 'hash':
+            self.sample = StratifiedReservoirSampling()
+            self.sample.update_reservoir(file, [row.split(split_char) for row in rows], meta['n_total_point'],
+                                         meta['group_counts'], options['ratio'], split_char=split_char,
+                                         groupby_attribute=groupby_attribute, group_cap=options['group_cap'],
+                                         group_floor=options['group_floor'])
+        else:
+            self.sample = ChunkedReservoirSampling()
+            self.sample.update_reservoir(file, rows, meta['n_total_point'], options['ratio'],
+                                         group_counts=meta['group_counts'], split_char=split_char,
+                                         groupby_attribute=groupby_attribute)
+        self.n_sample_point = self.sample.sampledf.shape[0]
+        self.n_new_point = self.sample.n_total_point - meta['n_total_point']
+        self.n_total_point = self.sample.n_total_point
+        self.group_counts = self.sample.group_counts
+
+        # the rows which left or entered the sample
+        old_rows, new_rows = Counter(rows), Counter(self.get_rows())
+        changed_rows = (old_rows - new_rows) + (new_rows - old_rows)
+        if groupby_attribute is None:
+            self.changed_groups = len(changed_rows) > 0
+        else:
+            group_idx = header.index(groupby_attribute)
+            self.changed_groups = set(row.split(split_char)[group_idx] for row in changed_rows)
+        return meta['metadata']
+
     def getyx(self, y, x, dropna=True):
         return self.sample.getyx(y,x, dropna=dropna)
 
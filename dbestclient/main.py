@@ -3,11 +3,42 @@
 # Department of Computer Science
 # the University of Warwick
 # Q.Ma.2@warwick.ac.uk
-from dbestclient.cli.prompt import DBEstPrompt
+import argparse
+
+from dbestclient.cli.prompt import DBEstPrompt, load_config
+from dbestclient.server.server import DBEstServer
+from dbestclient.parser.parser import split_statements
+
 
 def main():
+    parser = argparse.ArgumentParser(description="DBEst: a model-based AQP engine. Without arguments, start the "
+                                                 "interactive prompt.")
+    parser.add_argument('-f', '--file', help="run the statements of a SQL script, then exit.")
+    parser.add_argument('-e', '--execute', help="run the given statements, separated by ;, then exit.")
+    parser.add_argument('-o', '--output', help="write the results of -f or -e to this CSV file, instead of "
+                                               "printing them.")
+    parser.add_argument('--serve', action='store_true', help="run as a server, see dbestclient.server.")
+    parser.add_argument('--host', help="the host the server listens on, server_host in config.json by default.")
+    parser.add_argument('--port', type=int, help="the port the server listens on, server_port in config.json by "
+                                                 "default.")
+    parser.add_argument('--socket', help="the Unix socket the server listens on, instead of a TCP port.")
+    args = parser.parse_args()
+
+    if args.serve:
+        DBEstServer(load_config()).serve_forever(args.host, args.port, args.socket)
+        return
+
     p = DBEstPrompt()
-    p.cmdloop()
+    if args.file is None and args.execute is None:
+        p.cmdloop()
+        return
+    try:
+        if args.file is not None:
+            p.run_batch(p.sqlExecutor.execute_script, args.file, output=args.output)
+        else:
+            p.run_batch(p.sqlExecutor.execute_many, split_statements(args.execute), output=args.output)
+    finally:
+        p.sqlExecutor.close()
 
 if __name__=="__main__":
     main()
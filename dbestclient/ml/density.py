@@ -4,15 +4,148 @@
 # the University of Warwick
 # Q.Ma.2@warwick.ac.uk
 
+import numpy as np
 from sklearn.neighbors import KernelDensity
 
 
 class DBEstDensity:
-    def __init__(self, kernel=None):
+    def __init__(self, kernel=None, backend='kde'):
+        """
+        :param kernel: the kernel, 'gaussian' by default.
+        :param backend: 'kde' for sklearn KernelDensity, or 'binned' for BinnedKernelDensity.
+        """
         if kernel is None:
             self.kernel = 'gaussian'
+        else:
+            self.kernel = kernel
+        self.backend = backend
         self.kde = None
 
     def fit(self, x):
-        self.kde = KernelDensity(kernel=self.kernel).fit(x)
-        return self.kde
\ No newline at end of file
+        if np.shape(x)[1] > 1:
+            # the binned density is one-dimensional, models over several columns keep the sample
+            self.kde = MultivariateKernelDensity(kernel=self.kernel).fit(x)
+        elif self.backend == 'kde':
+            self.kde = KernelDensity(kernel=self.kernel).fit(x)
+        elif self.backend == 'binned':
+            self.kde = BinnedKernelDensity(kernel=self.kernel).fit(x)
+        else:
+            raise ValueError("Density backend " + str(self.backend) + " is not supported.")
+        return self.kde
+
+
+class BinnedKernelDensity:
+    """
+    Kernel density estimation on a grid. The sample is linearly binned onto the grid, and the bin counts are
+    convolved with the kernel through FFT. Only the grid and the density on it are kept, so evaluation costs
+    O(grid) and the model size does not depend on the sample size.
+    The bandwidth follows Silverman's rule by default, so that it scales with the data, as the grid does.
+    score_samples() follows sklearn KernelDensity and returns the log density.
+    """
+
+    def __init__(self, bandwidth=None, kernel='gaussian', n_grid=1024):
+        """
+        :param bandwidth: the bandwidth, Silverman's rule if None.
+        """
+        if kernel not in ('gaussian', 'epanechnikov'):
+            raise ValueError("Kernel " + str(kernel) + " is not supported by the binned density.")
+        self.bandwidth = None if bandwidth is None else float(bandwidth)
+        self.kernel = kernel
+        self.n_grid = int(n_grid)
+        self.grid = None
+        self.density = None
+
+    def _kernel(self, u):
+        if self.kernel == 'gaussian':
+            return np.exp(-0.5 * u * u) / (np.sqrt(2 * np.pi) * self.bandwidth)
+        return np.where(np.abs(u) < 1, 0.75 * (1 - u * u), 0.0) / self.bandwidth
+
+    def fit(self, x):
+        x = np.asarray(x, dtype=float).reshape(-1)
+        if self.bandwidth is None:
+            iqr = np.subtract(*np.percentile(x, [75, 25]))
+            spread = min(np.std(x), iqr / 1.34) if iqr > 0 else np.std(x)
+            self.bandwidth = float(0.9 * spread * len(x) ** -0.2) if spread > 0 else 1.0
+        # the support of the kernel, beyond which it is negligible
+        support = 4 * self.bandwidth if self.kernel == 'gaussian' else self.bandwidth
+        self.grid = np.linspace(x.min() - support, x.max() + support, self.n_grid)
+        delta = self.grid[1] - self.grid[0]
+
+        # linear binning: each point splits its weight between the two neighbouring grid points
+        position = (x - self.grid[0]) / delta
+        idx = np.minimum(np.floor(position).astype(int), self.n_grid - 2)
+        frac = position - idx
+        counts = np.bincount(idx, weights=1 - frac, minlength=self.n_grid) + \
+            np.bincount(idx + 1, weights=frac, minlength=self.n_grid)
+
+        # convolve the bin counts with the kernel evaluated on the grid lags
+        n_lag = int(min(self.n_grid - 1, np.ceil(support / delta)))
+        kernel = self._kernel(np.arange(-n_lag, n_lag + 1) * delta / self.bandwidth)
+        # the kernel sampled on the grid integrates to 1, even if the grid is coarse relative to the bandwidth
+        kernel /= kernel.sum() * delta
+        n_fft = 1 << (self.n_grid + 2 * n_lag - 1).bit_length()
+        convolved = np.fft.irfft(np.fft.rfft(counts, n_fft) * np.fft.rfft(kernel, n_fft), n_fft)
+        self.density = np.maximum(convolved[n_lag:n_lag + self.n_grid], 0.0) / len(x)
+        return self
+
+    def score_samples(self, X):
+        x = np.asarray(X, dtype=float).reshape(-1)
+        density = np.interp(x, self.grid, self.density, left=0.0, right=0.0)
+        with np.errstate(divide='ignore'):
+            return np.log(density)
+
+
+class MultivariateKernelDensity:
+    """
+    Kernel density over several columns, with a product kernel. The columns are standardized, and the bandwidth
+    follows Scott's rule, n^(-1/(d+4)) standard deviations, so that columns of different scales get kernels of their
+    own width. score_samples() follows sklearn KernelDensity and returns the log density.
+    The points are evaluated against the sample in chunks, to bound the memory of a batch.
+    """
+
+    def __init__(self, bandwidth=None, kernel='gaussian', chunk_size=1 << 22):
+        """
+        :param bandwidth: the bandwidth, in standard deviations of each column. Scott's rule if None.
+        :param chunk_size: the maximum number of kernel evaluations held in memory at once.
+        """
+        if kernel not in ('gaussian', 'epanechnikov'):
+            raise ValueError("Kernel " + str(kernel) + " is not supported by the multivariate density.")
+        self.bandwidth = bandwidth
+        self.kernel = kernel
+        self.chunk_size = chunk_size
+        self.sample = None
+        self.shift = None
+        self.scale = None
+
+    def fit(self, x):
+        x = np.asarray(x, dtype=float)
+        self.shift = x.mean(axis=0)
+        self.scale = x.std(axis=0)
+        self.scale[self.scale == 0] = 1.0
+        self.sample = (x - self.shift) / self.scale
+        if self.bandwidth is None:
+            self.bandwidth = float(len(x) ** (-1.0 / (x.shape[1] + 4)))
+        return self
+
+    def get_support(self):
+        """
+        :return: the lower and upper bounds of each column, beyond which the density is negligible.
+        """
+        support = (4 if self.kernel == 'gaussian' else 1) * self.bandwidth
+        lb = np.min(self.sample, axis=0) - support
+        ub = np.max(self.sample, axis=0) + support
+        return lb * self.scale + self.shift, ub * self.scale + self.shift
+
+    def score_samples(self, X):
+        x = (np.asarray(X, dtype=float) - self.shift) / self.scale
+        density = np.zeros(len(x))
+        chunk = max(1, self.chunk_size // max(len(x) * x.shape[1], 1))
+        for start in range(0, len(self.sample), chunk):
+            u = (x[:, np.newaxis, :] - np.asarray(self.sample[start:start + chunk])[np.newaxis, :, :]) / self.bandwidth
+            if self.kernel == 'gaussian':
+                density += np.exp(-0.5 * (u * u).sum(axis=2)).sum(axis=1) / np.sqrt(2 * np.pi) ** x.shape[1]
+            else:
+                density += np.prod(np.where(np.abs(u) < 1, 0.75 * (1 - u * u), 0.0), axis=2).sum(axis=1)
+        density /= len(self.sample) * (self.bandwidth ** x.shape[1]) * np.prod(self.scale)
+        with np.errstate(divide='ignore'):
+            return np.log(density)
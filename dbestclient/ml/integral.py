@@ -0,0 +1,244 @@
+# Created by Qingzhi Ma at 2019-07-24
+# All right reserved
+# Department of Computer Science
+# the University of Warwick
+# Q.Ma.2@warwick.ac.uk
+import numpy as np
+from scipy.special import ndtr
+
+
+def get_integration_nodes(x_lb, x_ub, n, method="gauss"):
+    """
+    get the nodes and weights to integrate a function over [x_lb, x_ub], so that
+    integral(f) ~= sum(weights * f(nodes)).
+
+    :param x_lb: the lower bound of the integral.
+    :param x_ub: the upper bound of the integral.
+    :param n: the number of nodes.
+    :param method: 'gauss' for Gauss-Legendre quadrature, 'grid' for the trapezoidal rule on a uniform grid.
+    :return: nodes, weights
+    """
+    n = max(int(n), 2)
+    if method == "gauss":
+        nodes, weights = np.polynomial.legendre.leggauss(n)
+        half_width = 0.5 * (x_ub - x_lb)
+        nodes = half_width * nodes + 0.5 * (x_ub + x_lb)
+        weights = half_width * weights
+    elif method == "grid":
+        nodes = np.linspace(x_lb, x_ub, n)
+        weights = np.full(n, (x_ub - x_lb) / (n - 1))
+        weights[0] *= 0.5
+        weights[-1] *= 0.5
+    else:
+        raise ValueError("Integration method " + str(method) + " is not supported.")
+    return nodes, weights
+
+
+def get_box_integration_nodes(x_lbs, x_ubs, n, method="qmc"):
+    """
+    get the nodes and weights to integrate a function over the box [x_lbs[0], x_ubs[0]] x [x_lbs[1], x_ubs[1]] ...,
+    so that integral(f) ~= sum(weights * f(nodes)).
+
+    :param x_lbs: the lower bounds of the box, one for each dimension.
+    :param x_ubs: the upper bounds of the box.
+    :param n: the number of nodes along each dimension for 'gauss' and 'grid', which take their tensor product, or
+        the total number of nodes for 'qmc', rounded up to a power of 2.
+    :param method: 'gauss' or 'grid', see get_integration_nodes(), or 'qmc' for a scrambled Sobol sequence, whose
+        error grows much slower than the size of a tensor grid with the number of dimensions. Without
+        scipy.stats.qmc (scipy < 1.7), 'qmc' falls back to a Gauss tensor grid of about n nodes.
+    :return: nodes, of shape (n, d), and weights
+    """
+    x_lbs = np.asarray(x_lbs, dtype=float)
+    x_ubs = np.asarray(x_ubs, dtype=float)
+    if method == "qmc":
+        try:
+            from scipy.stats import qmc
+        except ImportError:
+            qmc = None
+        if qmc is not None:
+            # a fixed seed, so that a query always gets the same answer
+            nodes = qmc.Sobol(len(x_lbs), seed=0).random_base2(int(np.ceil(np.log2(max(int(n), 2)))))
+            nodes = x_lbs + nodes * (x_ubs - x_lbs)
+            weights = np.full(len(nodes), np.prod(x_ubs - x_lbs) / len(nodes))
+            return nodes, weights
+        method = "gauss"
+        n = int(np.ceil(max(int(n), 2) ** (1.0 / len(x_lbs))))
+    axes = [get_integration_nodes(x_lb, x_ub, n, method=method) for x_lb, x_ub in zip(x_lbs, x_ubs)]
+    nodes = np.stack(np.meshgrid(*[axis[0] for axis in axes], indexing='ij'), axis=-1).reshape(-1, len(axes))
+    weights = np.prod(np.meshgrid(*[axis[1] for axis in axes], indexing='ij'), axis=0).reshape(-1)
+    return nodes, weights
+
+
+def get_bandwidth(kde):
+    """
+    get the numeric bandwidth of a fitted kernel density estimator, or 0 if it is unknown.
+    """
+    bandwidth = getattr(kde, "bandwidth_", getattr(kde, "bandwidth", 0.0))
+    try:
+        return float(bandwidth)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def get_support(kde):
+    """
+    get the range of a fitted one-dimensional density, beyond which it is negligible: the range of its sample padded
+    by 4 bandwidths, or its grid.
+
+    :return: lb, ub
+    """
+    if hasattr(kde, 'grid'):
+        return float(kde.grid[0]), float(kde.grid[-1])
+    # sklearn KernelDensity keeps its training data in its tree, and has a sample() method
+    sample = np.asarray(kde.tree_.data if hasattr(kde, 'tree_') else kde.sample, dtype=float)
+    pad = 4 * get_bandwidth(kde)
+    return float(sample.min()) - pad, float(sample.max()) + pad
+
+
+def get_cdf(kde, nodes, chunk_size=1 << 22):
+    """
+    get the cumulative integral of a fitted one-dimensional density at the nodes, in closed form: the average of the
+    cumulative distributions of the kernels over the sample, or the cumulative integral of a binned density.
+
+    :param nodes: the sorted nodes.
+    :return: the cumulative integral at the nodes, or None if the kernel has no closed form.
+    """
+    nodes = np.asarray(nodes, dtype=float).reshape(-1)
+    if hasattr(kde, 'grid'):
+        # the binned density is linear between the points of its grid
+        areas = 0.5 * (kde.density[1:] + kde.density[:-1]) * np.diff(kde.grid)
+        return np.interp(nodes, kde.grid, np.concatenate(([0.0], np.cumsum(areas))))
+    kernel = getattr(kde, 'kernel', None)
+    bandwidth = get_bandwidth(kde)
+    if kernel not in ('gaussian', 'epanechnikov') or bandwidth <= 0:
+        return None
+    sample = np.asarray(kde.tree_.data if hasattr(kde, 'tree_') else kde.sample, dtype=float).reshape(-1)
+    cdf = np.zeros(len(nodes))
+    step = max(1, chunk_size // len(nodes))
+    for start in range(0, len(sample), step):
+        u = (nodes.reshape(-1, 1) - sample[start:start + step]) / bandwidth
+        if kernel == 'gaussian':
+            cdf += ndtr(u).sum(axis=1)
+        else:
+            u = np.clip(u, -1, 1)
+            cdf += (0.5 + 0.75 * u - 0.25 * u ** 3).sum(axis=1)
+    return cdf / len(sample)
+
+
+def get_percentile(grid, cum_p, x_lb, x_ub, percentile):
+    """
+    invert a cumulative integral of p(x) tabulated on a grid.
+
+    :return: the value of x below which a fraction percentile of the density over [x_lb, x_ub] lies, or None if the
+        density is zero over the range.
+    """
+    cum_lb, cum_ub = np.interp(np.clip([x_lb, x_ub], grid[0], grid[-1]), grid, cum_p)
+    if cum_ub <= cum_lb:
+        return None
+    # the first grid point where the cumulative integral reaches the target, interpolated within its interval
+    target = cum_lb + percentile * (cum_ub - cum_lb)
+    idx = int(np.clip(np.searchsorted(cum_p, target), 1, len(grid) - 1))
+    width = cum_p[idx] - cum_p[idx - 1]
+    frac = (target - cum_p[idx - 1]) / width if width > 0 else 0.0
+    return float(np.clip(grid[idx - 1] + frac * (grid[idx] - grid[idx - 1]), x_lb, x_ub))
+
+class CumulativeIntegral:
+    """
+    precomputed cumulative integrals of p(x) and p(x)*R(x) on a fine grid over the domain of a model, so that
+    the integrals over any range [a, b] are answered by two interpolated lookups.
+    The integral of p(x) is exact on the grid if the kernel has a closed form cumulative distribution, see get_cdf(),
+    so that the grid may be coarser than the bandwidth; R(x) is weighted by the mass of p(x) between grid points.
+    If the variance of y around the regression, V(x), is given, the integral of p(x)*(R(x)^2 + V(x)) is kept too,
+    for VARIANCE and STDDEV.
+    """
+
+    def __init__(self, n_grid=1000):
+        self.n_grid = int(n_grid)
+        self.grid = None
+        self.cum_p = None
+        self.cum_pr = None
+        self.cum_py2 = None
+
+    def get_grid(self, kde, x_min, x_max):
+        """
+        :return: the grid over the domain, padded by 3 bandwidths on each side to cover the tails of the kernels.
+        """
+        pad = 3 * get_bandwidth(kde)
+        return np.linspace(x_min - pad, x_max + pad, max(self.n_grid, 2))
+
+    def fit(self, kde, reg, x_min, x_max, variance=None):
+        """
+        evaluate the density and the regression on the grid, and accumulate the integrals.
+
+        :param kde: the density estimator, providing score_samples().
+        :param reg: the regression model, providing predict().
+        :param x_min: the minimum value of x in the training data.
+        :param x_max: the maximum value of x in the training data.
+        :param variance: the residual variance on the grid, see get_grid(), or None.
+        :return: self
+        """
+        self.grid = self.get_grid(kde, x_min, x_max)
+        nodes = self.grid.reshape(-1, 1)
+        r = np.asarray(reg.predict(nodes), dtype=float).reshape(-1)
+        cdf = get_cdf(kde, self.grid)
+        if cdf is None:
+            p = np.exp(kde.score_samples(nodes))
+            self.cum_p = self._cumulative_trapezoid(p)
+            self.cum_pr = self._cumulative_trapezoid(p * r)
+            if variance is not None:
+                self.cum_py2 = self._cumulative_trapezoid(p * (r * r + variance))
+            return self
+        # the mass of p(x) between grid points is exact, R(x) is averaged at both ends
+        masses = np.diff(cdf)
+        self.cum_p = np.concatenate(([0.0], np.cumsum(masses)))
+        self.cum_pr = self._cumulative_trapezoid(r, masses)
+        if variance is not None:
+            self.cum_py2 = self._cumulative_trapezoid(r * r + variance, masses)
+        return self
+
+    def _cumulative_trapezoid(self, values, masses=None):
+        """
+        :param masses: the integrals of p(x) between grid points, by which values are weighted, or None to integrate
+            values over x.
+        """
+        masses = np.diff(self.grid) if masses is None else masses
+        areas = 0.5 * (values[1:] + values[:-1]) * masses
+        return np.concatenate(([0.0], np.cumsum(areas)))
+
+    def integrate(self, x_lb, x_ub):
+        """
+        :return: integral of p(x), integral of p(x)*R(x) over [x_lb, x_ub]
+        """
+        bounds = np.clip([x_lb, x_ub], self.grid[0], self.grid[-1])
+        cum_p = np.interp(bounds, self.grid, self.cum_p)
+        cum_pr = np.interp(bounds, self.grid, self.cum_pr)
+        return cum_p[1] - cum_p[0], cum_pr[1] - cum_pr[0]
+
+    def integrate_many(self, x_lbs, x_ubs):
+        """
+        :return: integrals of p(x), integrals of p(x)*R(x), as arrays over the ranges [x_lbs[i], x_ubs[i]]
+        """
+        x_lbs = np.clip(np.asarray(x_lbs, dtype=float), self.grid[0], self.grid[-1])
+        x_ubs = np.clip(np.asarray(x_ubs, dtype=float), self.grid[0], self.grid[-1])
+        int_p = np.interp(x_ubs, self.grid, self.cum_p) - np.interp(x_lbs, self.grid, self.cum_p)
+        int_pr = np.interp(x_ubs, self.grid, self.cum_pr) - np.interp(x_lbs, self.grid, self.cum_pr)
+        return int_p, int_pr
+
+    def integrate_square(self, x_lb, x_ub):
+        """
+        :return: integral of p(x)*(R(x)^2 + V(x)) over [x_lb, x_ub], or None if the variance is not kept.
+        """
+        # cumulative integrals pickled before the variance was kept do not have it
+        if getattr(self, 'cum_py2', None) is None:
+            return None
+        bounds = np.clip([x_lb, x_ub], self.grid[0], self.grid[-1])
+        cum_py2 = np.interp(bounds, self.grid, self.cum_py2)
+        return cum_py2[1] - cum_py2[0]
+
+    def get_percentile(self, x_lb, x_ub, percentile):
+        """
+        :return: the value of x below which a fraction percentile of the density over [x_lb, x_ub] lies, by
+            inverting the cumulative integral of p(x); None if the density is zero over the range.
+        """
+        return get_percentile(self.grid, self.cum_p, x_lb, x_ub, percentile)
+
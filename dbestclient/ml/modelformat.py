@@ -0,0 +1,191 @@
+# Created by Qingzhi Ma at 2019-07-26
+# All right reserved
+# Department of Computer Science
+# the University of Warwick
+# Q.Ma.2@warwick.ac.uk
+"""
+A compact, versioned binary format for models, which does not depend on pickle or on library versions.
+
+A model file holds
+    - a preamble: the magic bytes, the format version and the length of the header,
+    - a JSON header: the metadata of the model, and the dtype, shape and offset of each array,
+    - the raw arrays, each aligned to 64 bytes.
+
+Offsets are relative to the start of the model, so that a model can also be embedded in a larger file.
+Arrays are read with np.memmap, so that processes serving the same warehouse share the pages of a model.
+
+An archive holds several models one after the other, such as the per-group models of a group by, followed by a
+JSON index of their offsets and a trailer giving the position of the index.
+"""
+import json
+import struct
+
+import numpy as np
+from scipy.interpolate import RegularGridInterpolator
+
+MAGIC = b"DBESTMDL"
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+_PREAMBLE = struct.Struct("<8sHQ")
+ARCHIVE_MAGIC = b"DBESTARC"
+_TRAILER = struct.Struct("<QQ8s")
+
+
+def _align(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_model_file(f, header, arrays, dtype=None):
+    """
+    write a model to an open binary file, at its current position.
+
+    :param f: the file object.
+    :param header: a dict of JSON-serializable metadata.
+    :param arrays: a dict of named NumPy arrays.
+    :param dtype: if given, the floating point arrays are stored with this dtype, such as 'float32'.
+    :return: the number of bytes written.
+    """
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    if dtype is not None:
+        arrays = {name: array.astype(dtype) if array.dtype.kind == 'f' else array for name, array in arrays.items()}
+
+    # the offsets depend on the header length, which depends on the offsets: fix the header size first.
+    descriptors = {name: {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': 0}
+                   for name, array in arrays.items()}
+    header = dict(header, format_version=FORMAT_VERSION, arrays=descriptors)
+    header_size = _align(_PREAMBLE.size + len(json.dumps(header).encode()) + 32 * len(arrays) + ALIGNMENT)
+    offset = header_size
+    for name, array in arrays.items():
+        descriptors[name]['offset'] = offset
+        offset = _align(offset + array.nbytes)
+    header_bytes = json.dumps(header).encode()
+    header_bytes += b" " * (header_size - _PREAMBLE.size - len(header_bytes))
+
+    f.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header_bytes)))
+    f.write(header_bytes)
+    position = header_size
+    for name, array in arrays.items():
+        f.write(b"\0" * (descriptors[name]['offset'] - position))
+        f.write(array.tobytes())
+        position = descriptors[name]['offset'] + array.nbytes
+    f.write(b"\0" * (offset - position))
+    return offset
+
+
+def read_model_file(file, offset=0, buffer=None):
+    """
+    read a model written by write_model_file(). The arrays are read-only views of the memory-mapped file.
+
+    :param file: the path of the file.
+    :param offset: the position of the model in the file.
+    :param buffer: the file already memory-mapped as uint8, to share a single mapping between the models of a file.
+    :return: header, arrays
+    """
+    if buffer is None:
+        buffer = np.memmap(file, dtype=np.uint8, mode='r')
+    magic, version, header_length = _PREAMBLE.unpack(buffer[offset:offset + _PREAMBLE.size].tobytes())
+    if magic != MAGIC:
+        raise ValueError(file + " is not a DBEst model file.")
+    if version > FORMAT_VERSION:
+        raise ValueError("Model format version " + str(version) + " is not supported, please upgrade DBEst.")
+    start = offset + _PREAMBLE.size
+    header = json.loads(buffer[start:start + header_length].tobytes().decode())
+
+    arrays = {}
+    for name, descriptor in header['arrays'].items():
+        dtype = np.dtype(descriptor['dtype'])
+        shape = tuple(descriptor['shape'])
+        start = offset + descriptor['offset']
+        arrays[name] = buffer[start:start + int(np.prod(shape)) * dtype.itemsize].view(dtype).reshape(shape)
+    return header, arrays
+
+
+def write_archive_index(f, index):
+    """
+    write the index of an archive of models, after the models. A trailer at the end of the file gives the position
+    of the index, so that the models can be written one after the other without knowing their sizes in advance.
+
+    :param f: the file object, positioned after the last model.
+    :param index: a dict of JSON-serializable metadata, including the offset of each model.
+    """
+    index_offset = f.tell()
+    index_bytes = json.dumps(index).encode()
+    f.write(index_bytes)
+    f.write(_TRAILER.pack(index_offset, len(index_bytes), ARCHIVE_MAGIC))
+
+
+def read_archive_index(file):
+    """
+    :return: the index of an archive written by write_archive_index().
+    """
+    with open(file, 'rb') as f:
+        f.seek(-_TRAILER.size, 2)
+        index_offset, index_length, magic = _TRAILER.unpack(f.read(_TRAILER.size))
+        if magic != ARCHIVE_MAGIC:
+            raise ValueError(file + " is not a DBEst model archive.")
+        f.seek(index_offset)
+        return json.loads(f.read(index_length).decode())
+
+
+class SampleKernelDensity:
+    """
+    Kernel density over a stored sample, evaluated with NumPy. score_samples() follows sklearn KernelDensity and
+    returns the log density. The sample is processed in chunks, so that it can stay memory-mapped, and so that the
+    memory of a batch of points is bounded.
+    """
+
+    def __init__(self, sample, bandwidth=1.0, kernel='gaussian', chunk_size=1 << 22):
+        """
+        :param chunk_size: the maximum number of kernel evaluations held in memory at once.
+        """
+        if kernel not in ('gaussian', 'epanechnikov'):
+            raise ValueError("Kernel " + str(kernel) + " is not supported by the model file format.")
+        self.sample = sample
+        self.bandwidth = float(bandwidth)
+        self.kernel = kernel
+        self.chunk_size = chunk_size
+
+    def score_samples(self, X):
+        x = np.asarray(X, dtype=float).reshape(-1, 1)
+        density = np.zeros(len(x))
+        chunk = max(1, self.chunk_size // max(len(x), 1))
+        for start in range(0, len(self.sample), chunk):
+            u = (x - np.asarray(self.sample[start:start + chunk], dtype=float)) / self.bandwidth
+            if self.kernel == 'gaussian':
+                density += np.exp(-0.5 * u * u).sum(axis=1) / np.sqrt(2 * np.pi)
+            else:
+                density += np.where(np.abs(u) < 1, 0.75 * (1 - u * u), 0.0).sum(axis=1)
+        density /= len(self.sample) * self.bandwidth
+        with np.errstate(divide='ignore'):
+            return np.log(density)
+
+
+class GridRegression:
+    """
+    A regression tabulated on a grid, and evaluated by linear interpolation.
+    Values outside of the grid are those at the nearest end of the grid.
+    """
+
+    def __init__(self, grid, values):
+        self.grid = grid
+        self.values = values
+
+    def predict(self, X):
+        return np.interp(np.asarray(X, dtype=float)[:, 0], self.grid, self.values)
+
+
+class TensorGridRegression:
+    """
+    A regression over several columns, tabulated on a tensor grid, and evaluated by multilinear interpolation.
+    Values outside of the grid are those at the nearest point of the grid.
+    """
+
+    def __init__(self, grids, values):
+        self.grids = grids
+        self.values = values
+        self.interpolator = RegularGridInterpolator(tuple(np.asarray(grid) for grid in grids), np.asarray(values))
+
+    def predict(self, X):
+        X = np.asarray(X, dtype=float)
+        X = np.clip(X, [grid[0] for grid in self.grids], [grid[-1] for grid in self.grids])
+        return self.interpolator(X)
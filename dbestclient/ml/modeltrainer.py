@@ -4,24 +4,54 @@
 # the University of Warwick
 # Q.Ma.2@warwick.ac.uk
 from dbestclient.ml.density import DBEstDensity
+from dbestclient.ml.integral import CumulativeIntegral
+from dbestclient.ml.modelformat import GridRegression
 from dbestclient.ml.modelwraper import SimpleModelWrapper, GroupByModelWrapper
-from dbestclient.ml.regression import DBEstReg
+from dbestclient.ml.regression import DBEstReg, get_residual_variance
 from dbestclient.tools.dftools import convert_df_to_yx
+from multiprocessing import Pool
+from datetime import datetime
 import numpy as np
 
 
 class SimpleModelTrainer:
 
-    def __init__(self, mdl, tbl, xheader, yheader, n_total_point, n_sample_point,groupby_attribute=None, groupby_value=None):
+    def __init__(self, mdl, tbl, xheader, yheader, n_total_point, n_sample_point,groupby_attribute=None, groupby_value=None,
+                 cumulative_grid_num=1000, density_backend='kde'):
         self.xheader = xheader
         self.yheader = yheader
+        self.cumulative_grid_num = cumulative_grid_num
+        self.density_backend = density_backend
         self.simpe_model_wrapper = SimpleModelWrapper(mdl, tbl, xheader, y=yheader, n_total_point=n_total_point,
                                                       n_sample_point=n_sample_point, groupby_attribute=groupby_attribute, groupby_value=groupby_value)
 
     def fit(self, x, y):
         reg = DBEstReg().fit(x, y)
-        density = DBEstDensity().fit(x)
-        self.simpe_model_wrapper.load_model(density, reg)
+        density = DBEstDensity(backend=self.density_backend).fit(x)
+        if np.shape(x)[1] > 1:
+            # a model over several columns keeps the range of each column
+            self.simpe_model_wrapper.x_min_value = np.min(x, axis=0).tolist()
+            self.simpe_model_wrapper.x_max_value = np.max(x, axis=0).tolist()
+        else:
+            self.simpe_model_wrapper.x_min_value = float(np.min(x))
+            self.simpe_model_wrapper.x_max_value = float(np.max(x))
+        self.simpe_model_wrapper.y_avg = float(np.mean(y))
+        if np.shape(x)[1] > 1:
+            self.simpe_model_wrapper.load_model(density, reg)
+            return self.simpe_model_wrapper
+
+        # the regression is evaluated once on the grid, for the residuals and for the cumulative integrals
+        cumulative = CumulativeIntegral(self.cumulative_grid_num or 1000)
+        grid = cumulative.get_grid(density, self.simpe_model_wrapper.x_min_value,
+                                   self.simpe_model_wrapper.x_max_value)
+        grid_reg = GridRegression(grid, np.asarray(reg.predict(grid.reshape(-1, 1)), dtype=float).reshape(-1))
+        variance = GridRegression(grid, get_residual_variance(x, np.asarray(y) - grid_reg.predict(x), grid))
+        if self.cumulative_grid_num:
+            cumulative.fit(density, grid_reg, self.simpe_model_wrapper.x_min_value,
+                           self.simpe_model_wrapper.x_max_value, variance=variance.values)
+        else:
+            cumulative = None
+        self.simpe_model_wrapper.load_model(density, reg, cumulative=cumulative, variance=variance)
         return self.simpe_model_wrapper
 
     def fit_from_df(self, df):
@@ -31,7 +61,7 @@ class SimpleModelTrainer:
 
 class GroupByModelTrainer:
     def __init__(self, mdl, tbl, xheader, yheader, groupby_attribute, n_total_point, n_sample_point,
-                 x_min_value=-np.inf, x_max_value=np.inf):
+                 x_min_value=-np.inf, x_max_value=np.inf, cumulative_grid_num=1000, density_backend='kde', n_jobs=1):
         self.groupby_model_wrapper = GroupByModelWrapper(mdl, tbl, xheader, yheader, groupby_attribute,
                                                          x_min_value=x_min_value, x_max_value=x_max_value)
         self.groupby_attribute = groupby_attribute
@@ -43,16 +73,51 @@ class GroupByModelTrainer:
         self.n_sample_point = n_sample_point
         self.x_min_value = x_min_value
         self.x_max_value = x_max_value
-
+        self.cumulative_grid_num = cumulative_grid_num
+        self.density_backend = density_backend
+        self.n_jobs = n_jobs
+        self.fit_times = {}
 
     def fit_from_df(self,df):
+        """
+        train the models for each group. With n_jobs > 1, the groups are trained over a pool of worker processes;
+        the models are assembled in the order of the group values either way, and the time spent on each group is
+        kept in fit_times.
+        """
         sample_grouped = df.groupby(by=self.groupby_attribute)
+        tasks = []
         for name, group in sample_grouped:
-            print("training " +name )
-            simple_model_wrapper = SimpleModelTrainer(self.mdl, self.tbl, self.xheader, self.yheader,
-                                                      self.n_total_point[name], self.n_sample_point[name],
-                                                      groupby_attribute=self.groupby_attribute, groupby_value=name).fit_from_df(group)
-            self.groupby_model_wrapper.add_simple_model(simple_model_wrapper)
+            trainer = SimpleModelTrainer(self.mdl, self.tbl, self.xheader, self.yheader,
+                                         self.n_total_point[name], self.n_sample_point[name],
+                                         groupby_attribute=self.groupby_attribute, groupby_value=name,
+                                         cumulative_grid_num=self.cumulative_grid_num,
+                                         density_backend=self.density_backend)
+            tasks.append((name, trainer, group))
+
+        if self.n_jobs > 1 and len(tasks) > 1:
+            pool = Pool(min(self.n_jobs, len(tasks)))
+            results = pool.imap(_fit_group, tasks)
+        else:
+            pool = None
+            results = map(_fit_group, tasks)
+
+        try:
+            for name, simple_model_wrapper, time_cost in results:
+                print("training " + name + " finished, time cost: %.4fs." % time_cost)
+                self.fit_times[name] = time_cost
+                self.groupby_model_wrapper.add_simple_model(simple_model_wrapper)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
         # print(self.groupby_model_wrapper)
         return self.groupby_model_wrapper
 
+
+def _fit_group(task):
+    name, trainer, group = task
+    start = datetime.now()
+    simple_model_wrapper = trainer.fit_from_df(group)
+    end = datetime.now()
+    return name, simple_model_wrapper, (end - start).total_seconds()
+
@@ -3,22 +3,184 @@
 # Department of Computer Science
 # the University of Warwick
 # Q.Ma.2@warwick.ac.uk
+from collections.abc import Mapping
 import pickle
 import numpy as np
 import os
+from dbestclient.ml.density import BinnedKernelDensity, MultivariateKernelDensity
+from dbestclient.ml.integral import CumulativeIntegral, get_bandwidth
+from dbestclient.ml.modelformat import read_model_file, write_model_file, read_archive_index, write_archive_index, \
+    SampleKernelDensity, GridRegression, TensorGridRegression
+
+# the file extension of each model format
+MODEL_FILE_EXTENSIONS = {'pickle': ".pkl", 'dbm': ".dbm"}
+# the file extension of the archives holding the per-group models of a group by, in the DBEst model format
+GROUPBY_ARCHIVE_EXTENSION = ".dbg"
+
 
 def deserialize_model_wrapper(file):
     return pickle.load(file)
 
 
+def deserialize_model_file(file, offset=0, buffer=None):
+    """
+    load a SimpleModelWrapper stored in the DBEst model format, see dbestclient.ml.modelformat.
+    The arrays of the model are memory-mapped.
+
+    :param file: the path of the model file.
+    :param offset: the position of the model in the file.
+    :param buffer: the file already memory-mapped, see read_model_file().
+    :return: the SimpleModelWrapper
+    """
+    header, arrays = read_model_file(file, offset, buffer=buffer)
+    metadata = header['metadata']
+    model = SimpleModelWrapper(metadata['mdl'], metadata['tbl'], metadata['x'], y=metadata['y'],
+                               n_total_point=metadata['n_total_point'], n_sample_point=metadata['n_sample_point'],
+                               x_min_value=metadata['x_min_value'], x_max_value=metadata['x_max_value'],
+                               groupby_attribute=metadata['groupby_attribute'],
+                               groupby_value=metadata['groupby_value'], y_avg=metadata.get('y_avg'))
+
+    density_header = header['density']
+    if density_header['type'] == 'binned':
+        density = BinnedKernelDensity(density_header['bandwidth'], density_header['kernel'],
+                                      n_grid=len(arrays['density_grid']))
+        density.grid = arrays['density_grid']
+        density.density = arrays['density_values']
+    elif density_header['type'] == 'multivariate':
+        density = MultivariateKernelDensity(density_header['bandwidth'], density_header['kernel'])
+        density.sample = arrays['kde_sample']
+        density.shift = arrays['kde_shift']
+        density.scale = arrays['kde_scale']
+    else:
+        density = SampleKernelDensity(arrays['kde_sample'], density_header['bandwidth'], density_header['kernel'])
+
+    reg = None
+    if 'reg_values' in arrays and arrays['reg_values'].ndim > 1:
+        reg = TensorGridRegression([arrays['reg_grid_%d' % idx] for idx in range(arrays['reg_values'].ndim)],
+                                   arrays['reg_values'])
+    elif 'reg_values' in arrays:
+        reg = GridRegression(arrays['reg_grid'], arrays['reg_values'])
+
+    cumulative = None
+    if 'cum_p' in arrays:
+        cumulative = CumulativeIntegral(len(arrays['cum_grid']))
+        cumulative.grid = arrays['cum_grid']
+        cumulative.cum_p = arrays['cum_p']
+        cumulative.cum_pr = arrays['cum_pr']
+        cumulative.cum_py2 = arrays.get('cum_py2')
+
+    variance = None
+    if 'var_values' in arrays:
+        variance = GridRegression(arrays['var_grid'], arrays['var_values'])
+    model.load_model(density, reg, cumulative, variance)
+    return model
+
+
+def deserialize_groupby_model_wrapper(directory):
+    """
+    load the per-group models stored in a group by directory of the warehouse.
+
+    :param directory: the directory, named as <mdl>_groupby_<attribute>.
+    :return: the GroupByModelWrapper, or None if the directory contains no model.
+    """
+    groupby_model_wrapper = None
+    for model_name in sorted(os.listdir(directory)):
+        if model_name.endswith(".pkl") or model_name.endswith(".dbm"):
+            if model_name.endswith(".dbm"):
+                model = deserialize_model_file(directory + "/" + model_name)
+            else:
+                with open(directory + "/" + model_name, 'rb') as f:
+                    model = deserialize_model_wrapper(f)
+            if groupby_model_wrapper is None:
+                groupby_model_wrapper = GroupByModelWrapper(model.mdl, model.tbl, model.x, model.y,
+                                                            model.groupby_attribute,
+                                                            x_min_value=model.x_min_value,
+                                                            x_max_value=model.x_max_value)
+            groupby_model_wrapper.add_simple_model(model)
+    return groupby_model_wrapper
+
+
+class GroupByModelArchive(Mapping):
+    """
+    The per-group models of a group by, stored in a single archive file.
+    It behaves as the models dict of a GroupByModelWrapper, but each model is only read on first access, from its
+    offset in the archive, so that using a few groups does not read the others.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.index = read_archive_index(file)
+        self.groups = self.index['groups']
+        # a single mapping of the archive, shared by all the models read from it
+        self.buffer = np.memmap(file, dtype=np.uint8, mode='r')
+        self.models = {}
+
+    def __getitem__(self, model_name):
+        if model_name not in self.models:
+            self.models[model_name] = deserialize_model_file(self.file, self.groups[model_name]['offset'],
+                                                             buffer=self.buffer)
+        return self.models[model_name]
+
+    def __iter__(self):
+        return iter(self.groups)
+
+    def __len__(self):
+        return len(self.groups)
+
+    def get_groupby_value(self, model_name):
+        """
+        :return: the group value of a model, without reading the model.
+        """
+        return self.groups[model_name]['groupby_value']
+
+    def get_total(self, model_name, func):
+        """
+        :return: the aggregate of a group over the whole table, without reading the model, see get_total().
+        """
+        group = self.groups[model_name]
+        if 'y_avg' not in group:
+            return self[model_name].get_total(func)
+        return get_total(func, group['n_total_point'], group['y_avg'])
+
+
 def get_pickle_file_name(mdl):
     return mdl + ".pkl"
     # return mdl+"_yx_"+y+"_"+x+".pkl"
 
 
+def get_total(func, n_total_point, y_avg):
+    """
+    :param func: the aggregate function, COUNT, SUM or AVG.
+    :param n_total_point: the number of rows of the table, or of the group.
+    :param y_avg: the average of y, estimated from the sample.
+    :return: the aggregate over the whole table, or None if it is not known.
+    """
+    func = func.lower()
+    if func == "count":
+        return float(n_total_point)
+    if y_avg is None:
+        return None
+    if func == "sum":
+        return float(n_total_point) * y_avg
+    if func == "avg":
+        return y_avg
+    return None
+
+
+def _to_builtin(value):
+    # numpy scalars are not JSON serializable
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def _to_float(value):
+    # a float, or a list of floats for the bounds of a model over several columns
+    return np.asarray(value, dtype=float).tolist()
+
+
 class SimpleModelWrapper:
     def __init__(self, mdl, tbl, x, y=None, n_total_point=1.0,
-                 n_sample_point=1.0, x_min_value=-np.inf, x_max_value=np.inf, groupby_attribute=None, groupby_value=None):
+                 n_sample_point=1.0, x_min_value=-np.inf, x_max_value=np.inf, groupby_attribute=None, groupby_value=None,
+                 y_avg=None):
         self.mdl = mdl
         self.tbl = tbl
         self.x = x
@@ -29,18 +191,25 @@ class SimpleModelWrapper:
         self.x_max_value = x_max_value
         self.groupby_attribute=groupby_attribute
         self.groupby_value = groupby_value
+        # the average of y in the sample, to answer queries over the whole table without integrating
+        self.y_avg = y_avg
 
         self.reg = None
         self.density = None
+        self.cumulative = None
+        # the variance of y around the regression, tabulated on a grid, for VARIANCE and STDDEV
+        self.variance = None
 
         # generate the pickle file name
         self.pickle_file_name = None
         self.init_pickle_file_name()
         # self.pickle_string = None
 
-    def load_model(self, density, reg=None):
+    def load_model(self, density, reg=None, cumulative=None, variance=None):
         self.reg = reg
         self.density = density
+        self.cumulative = cumulative
+        self.variance = variance
 
     def init_pickle_file_name(self):
         # self.pickle_file_name = self.mdl #+ "_" + self.tbl
@@ -74,11 +243,114 @@ class SimpleModelWrapper:
     def serialize(self):
         return pickle.dumps(self)
 
-    def serialize2warehouse(self, warehouse):
+    def get_total(self, func):
+        """
+        :return: the aggregate over the whole table, see get_total().
+        """
+        # models pickled before y_avg was kept do not have it
+        return get_total(func, self.n_total_point, getattr(self, 'y_avg', None))
+
+    def get_xheaders(self):
+        """
+        :return: the predicate columns of the model, as a list.
+        """
+        return list(self.x) if isinstance(self.x, (list, tuple)) else [self.x]
+
+    def get_model_file_name(self, model_format='pickle'):
+        """
+        :return: the file name of the model in the given format, <mdl>[_groupby_<value>].<extension>
+        """
+        return self.init_pickle_file_name()[:-len(".pkl")] + MODEL_FILE_EXTENSIONS[model_format]
+
+    def serialize2warehouse(self, warehouse, model_format='pickle', dtype=None):
+        """
+        :param model_format: 'pickle', or 'dbm' for the DBEst model format.
+        :param dtype: the dtype of the arrays in the DBEst model format, such as 'float32'. float64 by default.
+        """
         if self.pickle_file_name is None:
             self.init_pickle_file_name()
-        with open(warehouse + '/' + self.pickle_file_name, 'wb') as f:
-            pickle.dump(self, f)
+        if model_format == 'dbm':
+            # the former model may still be memory-mapped, so it is replaced rather than overwritten
+            file = warehouse + '/' + self.get_model_file_name(model_format)
+            with open(file + ".tmp", 'wb') as f:
+                self.serialize2file(f, dtype=dtype)
+            os.replace(file + ".tmp", file)
+        elif model_format == 'pickle':
+            with open(warehouse + '/' + self.pickle_file_name, 'wb') as f:
+                pickle.dump(self, f)
+        else:
+            raise ValueError("Model format " + str(model_format) + " is not supported.")
+
+    def serialize2file(self, f, dtype=None):
+        """
+        write the model to an open file in the DBEst model format. The density is stored as its sample or its
+        grid, and the regression is tabulated on the grid of the cumulative integrals, or on a tensor grid over the
+        support of the density for a model over several columns.
+
+        :return: the number of bytes written.
+        """
+        arrays = {}
+        if isinstance(self.density, MultivariateKernelDensity):
+            density_header = {'type': 'multivariate'}
+            arrays['kde_sample'] = self.density.sample
+            arrays['kde_shift'] = self.density.shift
+            arrays['kde_scale'] = self.density.scale
+            x_lb, x_ub = self.density.get_support()
+        elif isinstance(self.density, BinnedKernelDensity):
+            density_header = {'type': 'binned'}
+            arrays['density_grid'] = self.density.grid
+            arrays['density_values'] = self.density.density
+            x_lb, x_ub = self.density.grid[0], self.density.grid[-1]
+        else:
+            density_header = {'type': 'sample'}
+            if isinstance(self.density, SampleKernelDensity):
+                sample = self.density.sample
+            else:
+                # sklearn KernelDensity keeps its training data in its tree
+                sample = self.density.tree_.data
+            arrays['kde_sample'] = np.asarray(sample, dtype=float).reshape(-1)
+            pad = 3 * get_bandwidth(self.density)
+            x_lb, x_ub = arrays['kde_sample'].min() - pad, arrays['kde_sample'].max() + pad
+        density_header.update({'bandwidth': get_bandwidth(self.density), 'kernel': self.density.kernel})
+
+        if self.cumulative is not None:
+            arrays['cum_grid'] = self.cumulative.grid
+            arrays['cum_p'] = self.cumulative.cum_p
+            arrays['cum_pr'] = self.cumulative.cum_pr
+            if getattr(self.cumulative, 'cum_py2', None) is not None:
+                arrays['cum_py2'] = self.cumulative.cum_py2
+        if getattr(self, 'variance', None) is not None:
+            arrays['var_grid'] = self.variance.grid
+            arrays['var_values'] = self.variance.values
+
+        if isinstance(self.reg, GridRegression):
+            arrays['reg_grid'] = self.reg.grid
+            arrays['reg_values'] = self.reg.values
+        elif isinstance(self.reg, TensorGridRegression):
+            for idx, grid in enumerate(self.reg.grids):
+                arrays['reg_grid_%d' % idx] = grid
+            arrays['reg_values'] = self.reg.values
+        elif self.reg is not None and isinstance(self.density, MultivariateKernelDensity):
+            # about 4096 points over the support of the density, as many along each column
+            n_grid = max(2, int(round(4096 ** (1.0 / len(x_lb)))))
+            grids = [np.linspace(lb, ub, n_grid) for lb, ub in zip(x_lb, x_ub)]
+            nodes = np.stack(np.meshgrid(*grids, indexing='ij'), axis=-1).reshape(-1, len(grids))
+            for idx, grid in enumerate(grids):
+                arrays['reg_grid_%d' % idx] = grid
+            arrays['reg_values'] = np.asarray(self.reg.predict(nodes), dtype=float).reshape((n_grid,) * len(grids))
+        elif self.reg is not None:
+            grid = self.cumulative.grid if self.cumulative is not None else np.linspace(x_lb, x_ub, 1000)
+            arrays['reg_grid'] = grid
+            arrays['reg_values'] = np.asarray(self.reg.predict(np.asarray(grid).reshape(-1, 1)),
+                                              dtype=float).reshape(-1)
+
+        metadata = {'mdl': self.mdl, 'tbl': self.tbl, 'x': self.x, 'y': self.y,
+                    'n_total_point': _to_builtin(self.n_total_point),
+                    'n_sample_point': _to_builtin(self.n_sample_point),
+                    'x_min_value': _to_float(self.x_min_value), 'x_max_value': _to_float(self.x_max_value),
+                    'groupby_attribute': self.groupby_attribute, 'groupby_value': self.groupby_value,
+                    'y_avg': _to_builtin(getattr(self, 'y_avg', None))}
+        return write_model_file(f, {'metadata': metadata, 'density': density_header}, arrays, dtype=dtype)
 
 
 class GroupByModelWrapper:
@@ -102,13 +374,48 @@ class GroupByModelWrapper:
         self.n_total_point[simple_model.groupby_value] = simple_model.n_total_point
         self.n_sample_point[simple_model.groupby_value] = simple_model.n_sample_point
 
-    def serialize2warehouse(self, warehouse):
-        if os.path.exists(warehouse):
+    def serialize2warehouse(self, warehouse, model_format='pickle', dtype=None, overwrite=False):
+        """
+        :param warehouse: the path of the group by model, <warehouse dir>/<mdl>_groupby_<attribute>. With the 'dbm'
+            format, the models are stored in the archive <path>.dbg, otherwise one file per group in the directory.
+        :param overwrite: whether to replace the stored models, when the model is updated.
+        """
+        if model_format == 'dbm':
+            if os.path.exists(warehouse + GROUPBY_ARCHIVE_EXTENSION) and not overwrite:
+                print("archive for the group by exists! abort!")
+            else:
+                self.serialize2archive(warehouse + GROUPBY_ARCHIVE_EXTENSION, dtype=dtype)
+        elif os.path.exists(warehouse) and not overwrite:
             print("warehouse for the group by exists! abort!")
         else:
-            os.mkdir(warehouse)
+            if not os.path.exists(warehouse):
+                os.mkdir(warehouse)
+            # the models of the groups which are gone
+            for file_name in os.listdir(warehouse):
+                if file_name not in self.models and file_name.endswith(MODEL_FILE_EXTENSIONS['pickle']):
+                    os.remove(os.path.join(warehouse, file_name))
             for group, model_wrapper in self.models.items():
-                model_wrapper.serialize2warehouse(warehouse)
+                model_wrapper.serialize2warehouse(warehouse, model_format=model_format, dtype=dtype)
+
+    def serialize2archive(self, file, dtype=None):
+        """
+        write the per-group models one after the other in a single file, followed by an index of their offsets,
+        see GroupByModelArchive.
+        """
+        groups = {}
+        with open(file + ".tmp", 'wb') as f:
+            offset = 0
+            for model_name, model_wrapper in self.models.items():
+                length = model_wrapper.serialize2file(f, dtype=dtype)
+                groups[model_name] = {'offset': offset, 'length': length,
+                                      'groupby_value': _to_builtin(model_wrapper.groupby_value),
+                                      'n_total_point': _to_builtin(model_wrapper.n_total_point),
+                                      'y_avg': _to_builtin(getattr(model_wrapper, 'y_avg', None))}
+                offset += length
+            metadata = {'mdl': self.mdl, 'tbl': self.tbl, 'x': self.x, 'y': self.y,
+                        'groupby_attribute': self.groupby_attribute}
+            write_archive_index(f, {'metadata': metadata, 'groups': groups})
+        os.replace(file + ".tmp", file)
 
 
 
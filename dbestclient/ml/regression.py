@@ -3,7 +3,11 @@
 # Department of Computer Science
 # the University of Warwick
 # Q.Ma.2@warwick.ac.uk
+import numpy as np
 from qregpy import qreg
+from sklearn.linear_model import LinearRegression
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import PolynomialFeatures
 
 
 class DBEstReg:
@@ -11,5 +15,37 @@ class DBEstReg:
         self.reg = None
 
     def fit(self, x, y):
-        self.reg = qreg.QReg(base_models=["linear", "polynomial"], verbose=False).fit(x, y)
+        if np.shape(x)[1] > 1:
+            # qreg predicts one point at a time, over a single column: models over several columns use a quadratic
+            # regression, which is evaluated in a batch.
+            self.reg = make_pipeline(PolynomialFeatures(degree=2), LinearRegression()).fit(x, y)
+        else:
+            self.reg = qreg.QReg(base_models=["linear", "polynomial"], verbose=False).fit(x, y)
         return self.reg
+
+
+def get_residual_variance(x, residuals, grid):
+    """
+    estimate the variance of y around the regression, as a function of x, with a Nadaraya-Watson regression of the
+    squared residuals. The residuals are binned on the grid and smoothed with a Gaussian kernel of Scott's bandwidth.
+
+    :param x: the values of x in the sample.
+    :param residuals: y - R(x) in the sample.
+    :param grid: the uniform grid to tabulate the variance on.
+    :return: the variance on the grid.
+    """
+    x = np.asarray(x, dtype=float).reshape(-1)
+    squares = np.asarray(residuals, dtype=float).reshape(-1) ** 2
+    delta = grid[1] - grid[0]
+    idx = np.clip(np.round((x - grid[0]) / delta).astype(int), 0, len(grid) - 1)
+    counts = np.bincount(idx, minlength=len(grid))
+    sums = np.bincount(idx, weights=squares, minlength=len(grid))
+
+    bandwidth = max(np.std(x) * len(x) ** -0.2, delta)
+    n_lag = int(min((len(grid) - 1) // 2, np.ceil(4 * bandwidth / delta)))
+    kernel = np.exp(-0.5 * (np.arange(-n_lag, n_lag + 1) * delta / bandwidth) ** 2)
+    counts = np.convolve(counts, kernel, mode='same')
+    sums = np.convolve(sums, kernel, mode='same')
+    # away from the sample, the variance is that of the whole sample
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(counts > 1e-3, sums / counts, np.mean(squares))
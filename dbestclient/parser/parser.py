@@ -1,55 +1,286 @@
+from collections import OrderedDict
+import copy
+import re
+import threading
+
 import sqlparse
-from sqlparse.sql import IdentifierList, Identifier, Function
+from sqlparse.sql import IdentifierList, Identifier, Function, Where
 from sqlparse.tokens import Keyword, DML, DDL
 
+# the numeric literals of a query, which are not part of an identifier
+_LITERAL = re.compile(r"(?<![\w.])-?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?(?![\w.])")
+_EXPLAIN = re.compile(r"^\s*explain\s+analyze\s+", re.IGNORECASE)
+
+
+def parameterize_query(query):
+    """
+    :return: the query with its whitespace normalized and its numeric literals replaced by ?, and the literals.
+    """
+    query = " ".join(query.split())
+    return _LITERAL.sub("?", query), _LITERAL.findall(query)
+
+
+def split_statements(script):
+    """
+    :return: the statements of a SQL script, which are separated by ;. Comments starting with -- are dropped.
+    """
+    lines = [line.split("--")[0] for line in script.splitlines()]
+    return [statement.strip() for statement in " ".join(lines).split(";") if statement.strip()]
+
+
+def parse_explain(query):
+    """
+    :return: whether the query is prefixed by EXPLAIN ANALYZE, and the query without the prefix.
+    """
+    match = _EXPLAIN.match(query)
+    if match is None:
+        return False, query
+    return True, query[match.end():]
+
+
+def parse_where_clause(whereclause):
+    """
+    :param whereclause: WHERE x1 BETWEEN a1 AND b1 [AND x2 BETWEEN a2 AND b2 ...]
+    :return: the predicates of the clause, as a list of (x, lb, ub).
+    """
+    words = whereclause.split()[1:]
+    return [(words[idx], words[idx + 2], words[idx + 4]) for idx in range(0, len(words) - 4, 6)]
+
+
+class QueryPlan:
+    """
+    The parsed form of a query, as plain attributes, see DBEstParser.get_plan().
+    Values are kept as the strings found in the query.
+    """
+    # the attributes holding the numeric literals of a query, in the order they appear in the query.
+    LITERAL_ATTRIBUTES = ('sampling_ratio', 'percentile', 'x_lb', 'x_ub', 'bucket_lb', 'bucket_ub', 'n_bucket')
+
+    def __init__(self, query):
+        self.query = query
+        self.b_nested = False
+        self.b_ddl = False
+        # EXPLAIN ANALYZE, the statement is executed and its metrics are returned instead of its answer
+        self.b_explain = False
+        # INSERT INTO t_m FROM tbl, the model is updated with the rows of tbl
+        self.b_insert = False
+        # DDL and INSERT
+        self.model_name = None
+        self.y = None
+        self.x = None
+        # all the predicate columns of the model, as (name, type); x is the first of them
+        self.x_columns = None
+        self.sampling_ratio = None
+        self.sampling_method = "uniform"
+        self.density_backend = "kde"
+        # DML
+        self.func = None
+        self.yheader = None
+        # PERCENTILE(x, q), the fraction q of the percentile
+        self.percentile = None
+        self.b_where = False
+        self.xheader = None
+        self.x_lb = None
+        self.x_ub = None
+        # the other predicates of a conjunctive WHERE clause, as (x, lb, ub)
+        self.x_ranges = []
+        # GROUP BY WIDTH_BUCKET(x, a, b, n), a histogram over x
+        self.bucket_x = None
+        self.bucket_lb = None
+        self.bucket_ub = None
+        self.n_bucket = None
+        # both
+        self.tbl = None
+        self.b_groupby = False
+        self.groupby_attribute = None
+
+    def get_literals(self):
+        return [getattr(self, name) for name in self.LITERAL_ATTRIBUTES if getattr(self, name) is not None]
+
+    def bind(self, query, literals):
+        """
+        :return: a copy of the plan for another query of the same template, with the literals of that query.
+        """
+        plan = copy.copy(self)
+        plan.query = query
+        names = [name for name in self.LITERAL_ATTRIBUTES if getattr(self, name) is not None]
+        for name, literal in zip(names, literals):
+            setattr(plan, name, literal)
+        return plan
+
+    def __repr__(self):
+        return "QueryPlan(" + repr(self.__dict__) + ")"
+
+
+class QueryPlanCache:
+    """
+    An LRU cache of query plans, so that repeated queries are not parsed again.
+    Plans are looked up by the text of the query first, then by its template, the query with its numeric literals
+    replaced by ?, so that queries which only differ by their literals are not parsed either.
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = int(max_size)
+        self.plans = OrderedDict()
+        self.templates = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_plan(self, query, metrics=None):
+        """
+        :param query: a SQL query
+        :param metrics: the QueryMetrics of the query, if it is traced.
+        :return: the QueryPlan of the query
+        """
+        with self.lock:
+            if query in self.plans:
+                self.plans.move_to_end(query)
+                if metrics is not None:
+                    metrics.count('plan_cache_hits')
+                return self.plans[query]
+            template, literals = parameterize_query(query)
+            template_plan = self.templates.get(template)
+            if template_plan is not None:
+                self.templates.move_to_end(template)
+
+        # parse outside of the lock, so that other threads are not held by sqlparse
+        if template_plan is not None:
+            plan = template_plan.bind(query, literals)
+            if metrics is not None:
+                metrics.count('plan_cache_hits')
+        else:
+            parser = DBEstParser()
+            parser.parse(query)
+            plan = parser.get_plan()
+        with self.lock:
+            # the template is only reusable if every literal of the query is one of the literals of the plan
+            if template_plan is None and plan.get_literals() == literals:
+                self._put(self.templates, template, plan)
+            self._put(self.plans, query, plan)
+        return plan
+
+    def _put(self, cache, key, plan):
+        cache[key] = plan
+        while len(cache) > self.max_size:
+            cache.popitem(last=False)
+
 
 class DBEstParser:
     """
     parse a single SQL query, of the following form:
 
     - **DDL**
-        >>> CREATE TABLE t_m(y real, x real)
+        >>> CREATE TABLE t_m(y real, x1 real [, x2 real ...])
         >>> FROM tbl
         >>> [GROUP BY z]
         >>> [SIZE 0.01]
         >>> [METHOD UNIFROM|HASH]
+        >>> [USING KDE|BINNED]
+
+    - **INSERT**, to update the model with the rows appended to the table, in tbl
+        >>> INSERT INTO t_m
+        >>> FROM tbl
+        >>> [GROUP BY z]
 
     - **DML**
-        >>> SELECT AF(y)
+        >>> [EXPLAIN ANALYZE] SELECT AF(y) | PERCENTILE(x, q)
         >>> FROM t_m
-        >>> [WHERE x BETWEEN a AND b]
-        >>> [GROUP BY z]
+        >>> [WHERE x1 BETWEEN a1 AND b1 [AND x2 BETWEEN a2 AND b2 ...]]
+        >>> [GROUP BY z | GROUP BY WIDTH_BUCKET(x, a, b, n)]
 
     .. note::
         - model name should be ended with **_m** to indicate that it is a model, not a table.
-        - AF, or aggregate function, could be COUNT, SUM, AVG, VARIANCE, PERCENTILE, etc.
+        - AF, or aggregate function, could be COUNT, SUM, AVG, VARIANCE or STDDEV.
+        - PERCENTILE(x, q) is the value of x below which a fraction q of the rows fall, with 0 <= q <= 1.
     """
     def __init__(self):
         self.query = ""
         self.parsed = None
+        self.b_explain = False
 
     def parse(self, query):
         """
         parse a single SQL query, of the following form:
 
         - **DDL**
-            >>> CREATE TABLE t_m(y real, x real)
+            >>> CREATE TABLE t_m(y real, x1 real [, x2 real ...])
             >>> FROM tbl
             >>> [GROUP BY z]
             >>> [SIZE 0.01]
             >>> [METHOD UNIFROM|HASH]
+            >>> [USING KDE|BINNED]
+
+        - **INSERT**, to update the model with the rows appended to the table, in tbl
+            >>> INSERT INTO t_m
+            >>> FROM tbl
+            >>> [GROUP BY z]
 
         - **DML**
-            >>> SELECT AF(y)
+            >>> [EXPLAIN ANALYZE] SELECT AF(y) | PERCENTILE(x, q)
             >>> FROM t_m
-            >>> [WHERE x BETWEEN a AND b]
-            >>> [GROUP BY z]
+            >>> [WHERE x1 BETWEEN a1 AND b1 [AND x2 BETWEEN a2 AND b2 ...]]
+            >>> [GROUP BY z | GROUP BY WIDTH_BUCKET(x, a, b, n)]
 
         - **parameters**
         :param query: a SQL query
         """
         self.query = query
-        self.parsed = sqlparse.parse(self.query)[0]
+        self.b_explain, query = parse_explain(query)
+        self.parsed = sqlparse.parse(query)[0]
+
+    def get_plan(self):
+        """
+        get the QueryPlan of the query, in a single pass over the tokens.
+        """
+        plan = QueryPlan(self.query)
+        plan.b_explain = self.b_explain
+        tokens = self.parsed.tokens
+        n_select = 0
+        for idx, item in enumerate(tokens):
+            value = item.value.lower()
+            if item.ttype is DML and value == 'select':
+                n_select += 1
+                if n_select == 1:
+                    plan.func = tokens[idx + 2].tokens[0].value
+                    arguments = tokens[idx + 2].tokens[1].value.replace("(", "").replace(")", "").split(",")
+                    plan.yheader = arguments[0].strip()
+                    if len(arguments) > 1:
+                        plan.percentile = arguments[1].strip()
+            elif item.ttype is DDL and value == "create":
+                plan.b_ddl = True
+            elif item.ttype is DML and value == "insert":
+                plan.b_insert = True
+            elif item.ttype is Keyword and value == "into":
+                plan.model_name = tokens[idx + 2].value
+            elif item.ttype is Keyword and value == "group by":
+                groupby = tokens[idx + 2]
+                if isinstance(groupby, Function) and groupby.value.split("(")[0].strip().lower() == "width_bucket":
+                    arguments = groupby.value[groupby.value.index("(") + 1:groupby.value.rindex(")")].split(",")
+                    plan.bucket_x, plan.bucket_lb, plan.bucket_ub, plan.n_bucket = \
+                        [argument.strip() for argument in arguments]
+                else:
+                    plan.b_groupby = True
+                    plan.groupby_attribute = groupby.value
+            elif item.ttype is Keyword and value == "from":
+                plan.tbl = tokens[idx + 2].value
+            elif item.ttype is Keyword and value == "size":
+                plan.sampling_ratio = tokens[idx + 2].value
+            elif item.ttype is Keyword and value == "method":
+                plan.sampling_method = tokens[idx + 2].value
+            elif item.ttype is Keyword and value == "using":
+                plan.density_backend = tokens[idx + 2].value.lower()
+            elif isinstance(item, Where):
+                plan.b_where = True
+                predicates = parse_where_clause(item.value)
+                plan.xheader, plan.x_lb, plan.x_ub = predicates[0]
+                plan.x_ranges = predicates[1:]
+            elif plan.b_ddl and plan.model_name is None and item.ttype is None and "(" in value:
+                plan.model_name = item.tokens[0].value
+                columns = item.value[item.value.index("(") + 1:item.value.rindex(")")].split(",")
+                columns = [tuple(column.split()) for column in columns]
+                plan.y, plan.x, plan.x_columns = columns[0], columns[1], columns[1:]
+        plan.b_nested = n_select > 1
+        if plan.b_ddl and plan.sampling_ratio is None:
+            plan.sampling_ratio = 0.01
+        return plan
 
     def if_nested_query(self):
         idx = 0
@@ -78,9 +309,12 @@ class DBEstParser:
     def get_where_name_and_range(self):
         for item in self.parsed.tokens:
             if 'where' in item.value.lower():
-                whereclause = item.value.split()
-                # print(whereclause)
-                return whereclause[1], whereclause[3], whereclause[5]
+                return parse_where_clause(item.value)[0]
+
+    def get_where_ranges(self):
+        for item in self.parsed.tokens:
+            if 'where' in item.value.lower():
+                return parse_where_clause(item.value)
 
     def if_contain_groupby(self):
         for item in self.parsed.tokens:
@@ -135,6 +369,13 @@ class DBEstParser:
                 return self.parsed.tokens[idx].value
         return "uniform"
 
+    def get_density_backend(self):
+        for item in self.parsed.tokens:
+            if item.ttype is Keyword and item.value.lower() == "using":
+                idx = self.parsed.token_index(item,0) + 2
+                return self.parsed.tokens[idx].value.lower()
+        return "kde"
+
 
 if __name__ == "__main__":
     parser = DBEstParser()
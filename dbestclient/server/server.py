@@ -0,0 +1,157 @@
+# Created by Qingzhi Ma at 2019-07-27
+# All right reserved
+# Department of Computer Science
+# the University of Warwick
+# Q.Ma.2@warwick.ac.uk
+"""
+A long-running DBEst server, so that clients share a warm model catalog instead of each loading the warehouse.
+
+The protocol is line based: each request is a line holding a JSON object {"id": ..., "query": "select ..."},
+or simply the SQL statement. Each response is a line holding a JSON object with the id and the query of the request,
+its status, answer and message, its latency in the executor and its latency in the server (seconds).
+Requests of a connection are answered in order; connections are served concurrently.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import math
+import socket
+import time
+
+from dbestclient.executor.executor import SqlExecutor, QueryResult
+
+
+def _to_json(answer):
+    # NaN is not valid JSON, and group values may not be strings
+    if isinstance(answer, dict):
+        return {str(group): _to_json(value) for group, value in answer.items()}
+    if answer is None:
+        return None
+    answer = float(answer)
+    return None if math.isnan(answer) else answer
+
+
+class DBEstServer:
+    """
+    An asyncio front end accepting clients over TCP or a Unix socket, and a pool of threads evaluating the
+    statements on a shared SqlExecutor.
+    """
+
+    def __init__(self, config, n_threads=None):
+        """
+        :param config: the configuration.
+        :param n_threads: the number of statements evaluated at the same time, server_threads in config by default.
+        """
+        self.config = config
+        self.sqlExecutor = SqlExecutor(config)
+        self.n_threads = int(n_threads if n_threads is not None else config.get('server_threads', 4))
+        self.pool = ThreadPoolExecutor(max_workers=self.n_threads)
+
+    async def handle_request(self, line):
+        """
+        :param line: a request, see the protocol above.
+        :return: the response, as a dict.
+        """
+        start = time.perf_counter()
+        request = {'query': line}
+        if line.startswith("{"):
+            try:
+                request = json.loads(line)
+            except ValueError:
+                request = {}
+        if not isinstance(request.get('query'), str):
+            return {'id': request.get('id'), 'status': "ERROR", 'message': "Invalid request: " + line}
+        query = request['query'].strip().rstrip(";")
+
+        loop = asyncio.get_event_loop()
+        try:
+            result = await loop.run_in_executor(self.pool, self.sqlExecutor.run, query)
+        except Exception as e:
+            result = QueryResult(query, status="ERROR", message=str(e))
+        return {'id': request.get('id'), 'query': query, 'status': result.status, 'answer': _to_json(result.answer),
+                'message': result.message, 'latency': result.latency,
+                'server_latency': time.perf_counter() - start}
+
+    async def handle_client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                line = line.decode().strip()
+                if not line:
+                    continue
+                response = await self.handle_request(line)
+                writer.write((json.dumps(response) + "\n").encode())
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            # the client left, or the server is closed
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host=None, port=None, socket_path=None):
+        """
+        start listening, on the Unix socket socket_path if given, otherwise on host:port.
+
+        :return: the asyncio server
+        """
+        socket_path = socket_path if socket_path is not None else self.config.get('server_socket', None)
+        if socket_path is not None:
+            server = await asyncio.start_unix_server(self.handle_client, path=socket_path)
+            print("DBEst server listening on " + socket_path)
+        else:
+            host = host if host is not None else self.config.get('server_host', 'localhost')
+            port = int(port if port is not None else self.config.get('server_port', 8009))
+            server = await asyncio.start_server(self.handle_client, host, port)
+            print("DBEst server listening on %s:%d" % (host, port))
+        return server
+
+    def serve_forever(self, host=None, port=None, socket_path=None):
+        # asyncio.run() and Server.serve_forever() need python 3.7
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        server = None
+        try:
+            server = loop.run_until_complete(self.start(host, port, socket_path))
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if server is not None:
+                server.close()
+            # cancel the clients still connected, as asyncio.run() does
+            tasks = (asyncio.all_tasks if hasattr(asyncio, 'all_tasks') else asyncio.Task.all_tasks)(loop)
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            if server is not None:
+                loop.run_until_complete(server.wait_closed())
+            loop.close()
+            self.close()
+            print("DBEst server closed successfully.")
+
+    def close(self):
+        self.pool.shutdown()
+        self.sqlExecutor.close()
+
+
+def query_server(queries, host='localhost', port=8009, socket_path=None):
+    """
+    send statements to a DBEst server over a single connection.
+
+    :param queries: a list of SQL statements.
+    :return: the responses, as dicts, in the order of the statements.
+    """
+    if socket_path is not None:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(socket_path)
+    else:
+        connection = socket.create_connection((host, port))
+    responses = []
+    with connection, connection.makefile('rw') as f:
+        for query_id, query in enumerate(queries):
+            f.write(json.dumps({'id': query_id, 'query': query}) + "\n")
+            f.flush()
+            responses.append(json.loads(f.readline()))
+    return responses
@@ -7,7 +7,8 @@ import pandas as pd
 
 
 def convert_df_to_yx(df,x, y):
-    return df[y].values, df[x].values.reshape(-1,1)
+    # x is a column, or a list of columns
+    return df[y].values, df[x].values.reshape(df.shape[0], -1)
 
 def get_group_count_from_df(df, group_attr,convert_to_str=True):
     if convert_to_str:
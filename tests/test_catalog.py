@@ -0,0 +1,55 @@
+# Created by Qingzhi Ma at 2019-07-27
+# All right reserved
+# Department of Computer Science
+# the University of Warwick
+# Q.Ma.2@warwick.ac.uk
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from sklearn.linear_model import LinearRegression
+from sklearn.neighbors import KernelDensity
+
+from dbestclient.catalog.catalog import DBEstModelCatalog
+from dbestclient.ml.modelwraper import SimpleModelWrapper
+
+
+class TestModelCatalog(unittest.TestCase):
+    """
+    the manifest should follow the models deleted from or copied into the warehouse.
+    """
+
+    def setUp(self):
+        self.warehousedir = tempfile.mkdtemp()
+        x = np.random.RandomState(0).uniform(20, 80, 200).reshape(-1, 1)
+        model = SimpleModelWrapper("m", "t.csv", "x", y="y", n_total_point=1000, n_sample_point=200)
+        model.load_model(KernelDensity().fit(x), LinearRegression().fit(x, 2 * x[:, 0]))
+        with open(os.path.join(self.warehousedir, "m.pkl"), 'wb') as f:
+            pickle.dump(model, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.warehousedir)
+
+    def test_deleted_model(self):
+        catalog = DBEstModelCatalog(self.warehousedir)
+        self.assertEqual(catalog.load_manifest(), 1)
+        os.remove(os.path.join(self.warehousedir, "m.pkl"))
+        self.assertNotIn("m.pkl", catalog)
+        self.assertRaises(KeyError, catalog.get_model, "m.pkl")
+        # the manifest is checked again at startup
+        self.assertEqual(DBEstModelCatalog(self.warehousedir).load_manifest(), 0)
+
+    def test_added_model(self):
+        catalog = DBEstModelCatalog(self.warehousedir)
+        catalog.load_manifest()
+        shutil.copy(os.path.join(self.warehousedir, "m.pkl"), os.path.join(self.warehousedir, "m2.pkl"))
+        self.assertIn("m2.pkl", catalog)
+        self.assertEqual(catalog.get_model("m2.pkl").n_total_point, 1000)
+        self.assertEqual(DBEstModelCatalog(self.warehousedir).load_manifest(), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+# Created by Qingzhi Ma at 2019-07-27
+# All right reserved
+# Department of Computer Science
+# the University of Warwick
+# Q.Ma.2@warwick.ac.uk
+import unittest
+
+import numpy as np
+
+from dbestclient.ml.density import BinnedKernelDensity
+
+
+class TestBinnedKernelDensity(unittest.TestCase):
+    """
+    the binned density should integrate to 1, whatever the range of the column relative to the bandwidth.
+    """
+
+    def setUp(self):
+        self.x = np.random.RandomState(0).uniform(0, 1e5, 12007)
+
+    def get_mass(self, kde):
+        return np.sum(kde.density) * (kde.grid[1] - kde.grid[0])
+
+    def test_wide_range(self):
+        for kernel in ('gaussian', 'epanechnikov'):
+            kde = BinnedKernelDensity(kernel=kernel).fit(self.x)
+            self.assertAlmostEqual(self.get_mass(kde), 1.0, delta=1e-3)
+
+    def test_coarse_grid(self):
+        # a bandwidth much smaller than the grid spacing, as for the models trained with a fixed bandwidth
+        kde = BinnedKernelDensity(bandwidth=1.0).fit(self.x)
+        self.assertAlmostEqual(self.get_mass(kde), 1.0, delta=1e-3)
+
+    def test_count(self):
+        kde = BinnedKernelDensity().fit(self.x)
+        lb, ub = 2e4, 3e4
+        nodes = np.linspace(lb, ub, 2001)
+        count = len(self.x) * np.mean(np.exp(kde.score_samples(nodes))) * (ub - lb)
+        exact = np.sum((self.x >= lb) & (self.x <= ub))
+        self.assertAlmostEqual(count, exact, delta=0.05 * exact)
+
+
+if __name__ == "__main__":
+    unittest.main()
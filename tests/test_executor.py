@@ -0,0 +1,132 @@
+# Created by Qingzhi Ma at 2019-07-27
+# All right reserved
+# Department of Computer Science
+# the University of Warwick
+# Q.Ma.2@warwick.ac.uk
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+from sklearn.linear_model import LinearRegression
+from sklearn.neighbors import KernelDensity
+
+from dbestclient.executor.executor import SqlExecutor
+from dbestclient.ml.modelwraper import SimpleModelWrapper
+
+
+class TestBaselineModels(unittest.TestCase):
+    """
+    models pickled by the first versions of DBEst have no range of x (infinite bounds), no cumulative table and no
+    average of y, and should still be answered.
+    """
+
+    def setUp(self):
+        self.warehousedir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        x = rng.uniform(20, 80, 500).reshape(-1, 1)
+        y = 2 * x[:, 0] + rng.normal(0, 3, 500)
+        self.y_avg = float(np.mean(y))
+        model = SimpleModelWrapper("m", "t.csv", "x", y="y", n_total_point=10000, n_sample_point=500)
+        model.load_model(KernelDensity().fit(x), LinearRegression().fit(x, y))
+        # the attributes the first versions did not have
+        for attribute in ('y_avg', 'cumulative', 'variance'):
+            delattr(model, attribute)
+        with open(os.path.join(self.warehousedir, "m.pkl"), 'wb') as f:
+            pickle.dump(model, f)
+        self.executor = SqlExecutor({'warehousedir': self.warehousedir, 'verbose': False, 'mesh_grid_num': 20,
+                                     'epsabs': 10.0, 'epsrel': 0.1, 'csv_split_char': ',',
+                                     'integration_method': 'table'})
+
+    def tearDown(self):
+        self.executor.close()
+        shutil.rmtree(self.warehousedir)
+
+    def test_total(self):
+        self.assertEqual(self.executor.run("select count(y) from m").answer, 10000.0)
+        result = self.executor.run("select avg(y) from m")
+        self.assertEqual(result.status, "OK")
+        self.assertAlmostEqual(result.answer, self.y_avg, delta=0.02 * self.y_avg)
+        result = self.executor.run("select sum(y) from m")
+        self.assertAlmostEqual(result.answer, 10000 * self.y_avg, delta=0.02 * 10000 * self.y_avg)
+
+    def test_percentile(self):
+        result = self.executor.run("select percentile(x, 0.5) from m")
+        self.assertEqual(result.status, "OK")
+        self.assertAlmostEqual(result.answer, 50, delta=2)
+
+    def test_unsupported_aggregates(self):
+        for sql in ("select variance(y) from m where x between 30 and 60", "select stddev(y) from m",
+                    "select percentile(y, 0.5) from m", "select percentile(zzz, 0.5) from m"):
+            self.assertEqual(self.executor.run(sql).status, "ERROR", sql)
+
+    def test_explain_bypasses_result_cache(self):
+        self.executor.close()
+        self.executor = SqlExecutor({'warehousedir': self.warehousedir, 'verbose': False, 'mesh_grid_num': 20,
+                                     'epsabs': 10.0, 'epsrel': 0.1, 'csv_split_char': ',',
+                                     'integration_method': 'gauss', 'b_result_cache': True})
+        self.executor.run("select count(y) from m where x between 30 and 60")
+        result = self.executor.run("explain analyze select count(y) from m where x between 30 and 60")
+        self.assertEqual(result.answer['result_cache_hits'], 0)
+        self.assertEqual(result.answer['density_evaluations'], 20)
+
+
+class TestMultivariateModels(unittest.TestCase):
+    """
+    a model over two columns should answer a box of predicates on its columns, given in any order, and reject a
+    predicate on a column it is not built on.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.warehousedir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        x1 = rng.uniform(0, 100, 20000)
+        x2 = rng.normal(50, 15, len(x1))
+        cls.df = pd.DataFrame({'y': 2 * x1 - x2 + rng.normal(0, 5, len(x1)), 'x1': x1, 'x2': x2})
+        cls.df.to_csv(os.path.join(cls.warehousedir, "t.csv"), index=False)
+        executor = SqlExecutor(cls.get_config('table'))
+        result = executor.run("create table m(y real, x1 real, x2 real) from t.csv method uniform size 5000")
+        executor.close()
+        assert result.status == "OK", result.message
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.warehousedir)
+
+    @classmethod
+    def get_config(cls, integration_method):
+        return {'warehousedir': cls.warehousedir, 'verbose': False, 'mesh_grid_num': 20, 'epsabs': 10.0,
+                'epsrel': 0.1, 'csv_split_char': ',', 'integration_method': integration_method}
+
+    def check_count(self, answer, selected):
+        # the sampling error of the sample of 5000 rows, and the smoothing of the density
+        p = np.mean(selected)
+        self.assertAlmostEqual(answer, np.sum(selected), delta=(4 * np.sqrt(p * (1 - p) / 5000) + 0.05 * p) *
+                               len(selected))
+
+    def test_box(self):
+        df = self.df
+        for integration_method in ('table', 'gauss'):
+            executor = SqlExecutor(self.get_config(integration_method))
+            try:
+                # wide on x1 and narrow on x2, so that mixing up the columns would halve the count
+                answer = executor.run("select count(y) from m where x1 between 10 and 90 and x2 between 45 and 55")
+                self.assertEqual(answer.status, "OK", answer.message)
+                self.check_count(answer.answer, df.x1.between(10, 90) & df.x2.between(45, 55))
+                swapped = executor.run("select count(y) from m where x2 between 45 and 55 and x1 between 10 and 90")
+                self.assertAlmostEqual(swapped.answer, answer.answer, delta=1e-9 * answer.answer)
+                # a column without predicate is unbounded
+                self.check_count(executor.run("select count(y) from m where x2 between 45 and 55").answer,
+                                 df.x2.between(45, 55))
+                result = executor.run("select count(y) from m where x1 between 10 and 90 and x3 between 45 and 55")
+                self.assertEqual(result.status, "ERROR")
+            finally:
+                executor.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
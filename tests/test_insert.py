@@ -0,0 +1,103 @@
+# Created by Qingzhi Ma at 2019-07-27
+# All right reserved
+# Department of Computer Science
+# the University of Warwick
+# Q.Ma.2@warwick.ac.uk
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from dbestclient.executor.executor import SqlExecutor
+from dbestclient.io.sampling import DBEstSampling
+from dbestclient.ml.modelwraper import get_pickle_file_name
+
+
+def make_table(rng, group_sizes):
+    """
+    :param group_sizes: {group value: number of rows}
+    :return: the rows, with x uniform over [0, 100] and y = 2x + noise, in random order.
+    """
+    z = np.concatenate([[group] * size for group, size in group_sizes.items()])
+    x = rng.uniform(0, 100, len(z))
+    df = pd.DataFrame({'z': z, 'x': x, 'y': 2 * x + rng.normal(0, 5, len(z))})
+    return df.iloc[rng.permutation(len(df))]
+
+
+class TestInsertInto(unittest.TestCase):
+    """
+    after INSERT INTO, the models should count the rows of both files exactly, and answer as if they were created
+    over both.
+    """
+
+    def setUp(self):
+        self.warehousedir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.old = make_table(rng, {'a': 3000, 'b': 1500, 'c': 500})
+        # a new group, and rows appended to the existing ones
+        self.new = make_table(rng, {'a': 1000, 'c': 2500, 'd': 800})
+        self.all = pd.concat([self.old, self.new])
+        self.old.to_csv(os.path.join(self.warehousedir, "t.csv"), index=False)
+        self.new.to_csv(os.path.join(self.warehousedir, "t_new.csv"), index=False)
+        self.executor = SqlExecutor({'warehousedir': self.warehousedir, 'verbose': False, 'mesh_grid_num': 20,
+                                     'epsabs': 10.0, 'epsrel': 0.1, 'csv_split_char': ',',
+                                     'integration_method': 'table', 'model_format': 'dbm',
+                                     'b_keep_reservoir': True, 'stratified_group_floor': 50})
+
+    def tearDown(self):
+        self.executor.close()
+        shutil.rmtree(self.warehousedir)
+
+    def run_sql(self, sql):
+        result = self.executor.run(sql)
+        self.assertEqual(result.status, "OK", result.message)
+        return result.answer
+
+    def check_count(self, answer, df, reservoir_file, group=None):
+        """
+        the count of x between 20 and 60 should be that of the sample kept for the model, scaled to the rows of
+        both files, and within the sampling error of the exact count.
+        """
+        rows, meta = DBEstSampling.load_reservoir(reservoir_file)
+        sample = pd.DataFrame([row.split(',') for row in rows], columns=meta['header'])
+        if group is not None:
+            sample = sample[sample.z == group]
+        p = np.mean((sample.x.astype(float) >= 20) & (sample.x.astype(float) <= 60))
+        self.assertAlmostEqual(answer, p * len(df), delta=0.05 * p * len(df))
+        exact = np.sum((df.x >= 20) & (df.x <= 60))
+        self.assertAlmostEqual(answer, exact, delta=4 * np.sqrt(p * (1 - p) / len(sample)) * len(df))
+
+    def test_uniform(self):
+        self.run_sql("create table m(y real, x real) from t.csv method uniform size 1000")
+        self.run_sql("insert into m from t_new.csv")
+        self.assertEqual(self.executor.model_catalog.get_model(get_pickle_file_name("m")).n_total_point,
+                         len(self.all))
+        self.assertEqual(self.run_sql("select count(y) from m"), len(self.all))
+        self.check_count(self.run_sql("select count(y) from m where x between 20 and 60"), self.all,
+                         self.executor.get_reservoir_file("m"))
+
+    def check_groupby(self, method):
+        self.run_sql("create table m(y real, x real) from t.csv group by z method {0} size 1000".format(method))
+        self.run_sql("insert into m from t_new.csv group by z")
+        exact = self.all.groupby('z').size().to_dict()
+        self.assertEqual(self.run_sql("select count(y) from m group by z"), exact)
+        # the row counts are kept with the sample too, for the next INSERT INTO
+        reservoir_file = self.executor.get_reservoir_file("m_groupby_z")
+        self.assertEqual(DBEstSampling.load_reservoir(reservoir_file)[1]['group_counts'], exact)
+        counts = self.run_sql("select count(y) from m where x between 20 and 60 group by z")
+        self.assertEqual(set(counts), set(exact))
+        for group, count in counts.items():
+            self.check_count(count, self.all[self.all.z == group], reservoir_file, group)
+
+    def test_uniform_groupby(self):
+        self.check_groupby("uniform")
+
+    def test_hash(self):
+        self.check_groupby("hash")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+# Created by Qingzhi Ma at 2019-07-27
+# All right reserved
+# Department of Computer Science
+# the University of Warwick
+# Q.Ma.2@warwick.ac.uk
+import unittest
+
+import numpy as np
+from sklearn.linear_model import LinearRegression
+from sklearn.neighbors import KernelDensity
+
+from dbestclient.ml.density import BinnedKernelDensity
+from dbestclient.ml.integral import CumulativeIntegral
+
+
+class TestCumulativeIntegral(unittest.TestCase):
+    """
+    the cumulative table should keep the mass of the density over ranges, whatever the spacing of its grid relative
+    to the bandwidth.
+    """
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.x = rng.uniform(0, 1e5, 5000).reshape(-1, 1)
+        self.y = 0.01 * self.x[:, 0] + rng.normal(0, 5, len(self.x))
+        self.reg = LinearRegression().fit(self.x, self.y)
+
+    def check(self, kde):
+        cumulative = CumulativeIntegral(1000).fit(kde, self.reg, self.x.min(), self.x.max())
+        for lb, ub in ((6e4, 8e4), (0, 1e4), (12345, 12345 + 2e3)):
+            selected = (self.x[:, 0] >= lb) & (self.x[:, 0] <= ub)
+            int_p, int_pr = cumulative.integrate(lb, ub)
+            self.assertAlmostEqual(int_p * len(self.x), np.sum(selected), delta=0.05 * np.sum(selected))
+            self.assertAlmostEqual(int_pr / int_p, np.mean(self.y[selected]), delta=0.05 * np.mean(self.y[selected]))
+
+    def test_coarse_grid(self):
+        # the default bandwidth of 1.0, much smaller than the spacing of the grid
+        self.check(KernelDensity().fit(self.x))
+        self.check(KernelDensity(kernel='epanechnikov').fit(self.x))
+
+    def test_binned(self):
+        # the bandwidth of the binned density is wide on this sample, the table is compared with its own mass
+        kde = BinnedKernelDensity().fit(self.x)
+        cumulative = CumulativeIntegral(1000).fit(kde, self.reg, self.x.min(), self.x.max())
+        for lb, ub in ((6e4, 8e4), (0, 1e4)):
+            nodes = np.linspace(lb, ub, 20001)
+            mass = np.mean(np.exp(kde.score_samples(nodes))) * (ub - lb)
+            self.assertAlmostEqual(cumulative.integrate(lb, ub)[0], mass, delta=1e-3 * mass)
+
+    def test_histogram(self):
+        cumulative = CumulativeIntegral(1000).fit(KernelDensity().fit(self.x), self.reg, self.x.min(), self.x.max())
+        edges = np.linspace(0, 1e5, 11)
+        counts = cumulative.integrate_many(edges[:-1], edges[1:])[0] * len(self.x)
+        exact = np.histogram(self.x[:, 0], edges)[0]
+        np.testing.assert_allclose(counts, exact, rtol=0.02)
+
+
+if __name__ == "__main__":
+    unittest.main()
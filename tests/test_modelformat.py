@@ -0,0 +1,102 @@
+# Created by Qingzhi Ma at 2019-07-27
+# All right reserved
+# Department of Computer Science
+# the University of Warwick
+# Q.Ma.2@warwick.ac.uk
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from dbestclient.executor.queryengine import get_query_engine, GroupByQueryEngine
+from dbestclient.ml.modeltrainer import SimpleModelTrainer, GroupByModelTrainer
+from dbestclient.ml.modelwraper import deserialize_model_file, GroupByModelArchive
+
+
+class TestModelFormat(unittest.TestCase):
+    """
+    a model written in the DBEst model format (.dbm), or in a group by archive (.dbg), should answer as the model
+    it was written from.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.RandomState(0)
+        x = rng.uniform(0, 100, 1000)
+        cls.df = pd.DataFrame({'z': rng.choice(['a', 'b', 'c'], len(x)), 'x': x, 'x2': rng.normal(50, 10, len(x)),
+                               'y': 2 * x + rng.normal(0, 5, len(x))})
+
+    def setUp(self):
+        self.warehousedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.warehousedir)
+
+    def round_trip(self, model, dtype=None):
+        model.serialize2warehouse(self.warehousedir, model_format='dbm', dtype=dtype)
+        return deserialize_model_file(os.path.join(self.warehousedir, model.get_model_file_name('dbm')))
+
+    def check_answers(self, model, loaded, funcs, ranges, rtol):
+        for method in ('table', 'gauss'):
+            config = {'mesh_grid_num': 20, 'integration_method': method}
+            for func in funcs:
+                for lb, ub in ranges:
+                    expected = get_query_engine(model, config).predict(func, lb, ub, percentile=0.5)[0]
+                    answer = get_query_engine(loaded, config).predict(func, lb, ub, percentile=0.5)[0]
+                    np.testing.assert_allclose(answer, expected, rtol=rtol, err_msg="{0} {1}".format(func, method))
+
+    def test_simple(self):
+        for density_backend in ('kde', 'binned'):
+            model = SimpleModelTrainer("m", "t.csv", "x", "y", 10000, 1000,
+                                       density_backend=density_backend).fit_from_df(self.df[['y', 'x']])
+            loaded = self.round_trip(model)
+            self.assertEqual((loaded.n_total_point, loaded.y_avg), (10000, model.y_avg))
+            funcs = ('count', 'sum', 'avg', 'variance', 'percentile')
+            self.check_answers(model, loaded, funcs, ((20, 60), (0, 100), (-10, 5)), rtol=1e-3)
+            self.check_answers(model, self.round_trip(model, dtype='float32'), funcs, ((20, 60), (0, 100)),
+                               rtol=1e-3)
+
+    def test_multivariate(self):
+        model = SimpleModelTrainer("m", "t.csv", ["x", "x2"], "y", 10000, 1000).fit_from_df(
+            self.df[['y', 'x', 'x2']])
+        ranges = ((np.array([20, 40]), np.array([60, 60])), (np.array([-np.inf, 50]), np.array([np.inf, np.inf])))
+        self.check_answers(model, self.round_trip(model), ('count', 'sum', 'avg'), ranges, rtol=1e-2)
+
+    def test_groupby_archive(self):
+        n_total_point = {'a': 4000, 'b': 3000, 'c': 3000}
+        model = GroupByModelTrainer("m", "t.csv", "x", "y", "z", n_total_point,
+                                    self.df.groupby('z').size().to_dict()).fit_from_df(self.df[['y', 'x', 'z']])
+        directory = os.path.join(self.warehousedir, model.dir)
+        model.serialize2warehouse(directory, model_format='dbm')
+        archive = GroupByModelArchive(directory + ".dbg")
+        self.assertEqual(set(archive), set(model.models))
+        for model_name in archive:
+            self.assertEqual(archive.get_groupby_value(model_name), model.models[model_name].groupby_value)
+            self.assertEqual(archive.get_total(model_name, 'sum'), model.models[model_name].get_total('sum'))
+        # the archive is only read as far as the groups used
+        self.assertEqual(archive.models, {})
+        self.check_answers(model.models["m_groupby_a.pkl"], archive["m_groupby_a.pkl"], ('count', 'avg'),
+                           ((20, 60),), rtol=1e-3)
+        for method in ('table', 'gauss'):
+            config = {'mesh_grid_num': 20, 'integration_method': method}
+            for func in ('count', 'sum', 'avg'):
+                expected = GroupByQueryEngine(model.models, config).predict(func, 20, 60)[0]
+                answers = GroupByQueryEngine(archive, config).predict(func, 20, 60)[0]
+                self.assertEqual(set(answers), set(expected))
+                for group, answer in answers.items():
+                    self.assertAlmostEqual(answer, expected[group], delta=1e-3 * abs(expected[group]))
+
+    def test_pickle(self):
+        model = SimpleModelTrainer("m", "t.csv", "x", "y", 10000, 1000).fit_from_df(self.df[['y', 'x']])
+        model.serialize2warehouse(self.warehousedir)
+        with open(os.path.join(self.warehousedir, model.get_model_file_name()), 'rb') as f:
+            loaded = pickle.load(f)
+        self.check_answers(model, loaded, ('count', 'sum', 'avg'), ((20, 60),), rtol=1e-12)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+# Created by Qingzhi Ma at 2019-07-27
+# All right reserved
+# Department of Computer Science
+# the University of Warwick
+# Q.Ma.2@warwick.ac.uk
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from dbestclient.io.reservoir import ReservoirSampling, StratifiedReservoirSampling, ChunkedReservoirSampling, \
+    ParallelReservoirSampling, get_byte_ranges
+
+GROUP_SIZES = {'a': 12000, 'b': 5000, 'c': 2900, 'd': 100}
+
+
+def write_table(file, ids, rng, b_trailing_newline=True):
+    """
+    write the rows ids, whose group is given by GROUP_SIZES, in random order.
+    """
+    groups = np.concatenate([[group] * size for group, size in GROUP_SIZES.items()])[ids]
+    order = rng.permutation(len(ids))
+    lines = ["{0},{1},{2:.3f}".format(i, group, x) for i, group, x in
+             zip(np.asarray(ids)[order], groups[order], rng.uniform(0, 100, len(ids)))]
+    with open(file, 'w') as f:
+        f.write("id,z,x\n" + "\n".join(lines) + ("\n" if b_trailing_newline else ""))
+
+
+class TestReservoirSampling(unittest.TestCase):
+    """
+    the samplers should count the rows and the groups of the file exactly, and keep a uniform sample of its rows.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.n = sum(GROUP_SIZES.values())
+        self.file = os.path.join(self.dir, "t.csv")
+        write_table(self.file, np.arange(self.n), np.random.RandomState(0))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def check(self, sampler, R, n=None, group_counts=None):
+        n = self.n if n is None else n
+        self.assertEqual(sampler.n_total_point, n)
+        if group_counts is not None:
+            self.assertEqual(sampler.group_counts, group_counts)
+        ids = sampler.sampledf['id'].astype(int)
+        self.assertEqual(len(ids), min(R, n))
+        # rows of the file, each once
+        self.assertEqual(ids.nunique(), len(ids))
+        self.assertTrue(ids.between(0, n - 1).all())
+        # the share of the largest group, within 4 standard errors
+        p = GROUP_SIZES['a'] / float(self.n)
+        share = np.mean(sampler.sampledf['z'] == 'a')
+        self.assertAlmostEqual(share, p, delta=4 * np.sqrt(p * (1 - p) / len(ids)))
+
+    def test_one_pass(self):
+        sampler = ReservoirSampling()
+        sampler.build_reservoir(self.file, 1000, groupby_attribute='z')
+        self.check(sampler, 1000, group_counts=GROUP_SIZES)
+
+    def test_chunked(self):
+        for chunk_size in (1 << 24, 4096, 7):
+            sampler = ChunkedReservoirSampling()
+            sampler.build_reservoir(self.file, 1000, groupby_attribute='z', chunk_size=chunk_size)
+            self.check(sampler, 1000, group_counts=GROUP_SIZES)
+
+    def test_chunked_without_trailing_newline(self):
+        write_table(self.file, np.arange(self.n), np.random.RandomState(1), b_trailing_newline=False)
+        sampler = ChunkedReservoirSampling()
+        sampler.build_reservoir(self.file, 1000, groupby_attribute='z', chunk_size=4096)
+        self.check(sampler, 1000, group_counts=GROUP_SIZES)
+
+    def test_chunked_larger_than_file(self):
+        sampler = ChunkedReservoirSampling()
+        sampler.build_reservoir(self.file, 2 * self.n, groupby_attribute='z')
+        self.check(sampler, 2 * self.n, group_counts=GROUP_SIZES)
+
+    def test_chunked_update(self):
+        # the rows of a second file, appended to the first one
+        new_file = os.path.join(self.dir, "t_new.csv")
+        write_table(new_file, np.arange(self.n, 2 * self.n) % self.n, np.random.RandomState(1))
+        sampler = ChunkedReservoirSampling()
+        sampler.build_reservoir(self.file, 1000, groupby_attribute='z')
+        rows = [",".join(row) for row in sampler.get_rows()]
+        sampler = ChunkedReservoirSampling()
+        sampler.update_reservoir(new_file, rows, self.n, 1000, group_counts=GROUP_SIZES, groupby_attribute='z')
+        self.assertEqual(sampler.n_total_point, 2 * self.n)
+        self.assertEqual(sampler.group_counts, {group: 2 * size for group, size in GROUP_SIZES.items()})
+        self.assertEqual(len(sampler.sampledf), 1000)
+
+    def test_parallel(self):
+        for b_trailing_newline in (True, False):
+            write_table(self.file, np.arange(self.n), np.random.RandomState(1), b_trailing_newline)
+            sampler = ParallelReservoirSampling()
+            sampler.build_reservoir(self.file, 1000, groupby_attribute='z', n_jobs=3)
+            self.check(sampler, 1000, group_counts=GROUP_SIZES)
+
+    def test_byte_ranges(self):
+        with open(self.file, 'rb') as f:
+            buf = f.read()
+        header_end = buf.find(b'\n') + 1
+        ranges = get_byte_ranges(buf, header_end, 4)
+        self.assertEqual((ranges[0][0], ranges[-1][1]), (header_end, len(buf)))
+        for (_, end), (start, _) in zip(ranges[:-1], ranges[1:]):
+            self.assertEqual(end, start)
+            self.assertEqual(buf[end - 1:end], b'\n')
+
+    def test_stratified(self):
+        sampler = StratifiedReservoirSampling()
+        sampler.build_reservoir(self.file, 1000, groupby_attribute='z', group_floor=50)
+        self.assertEqual(sampler.n_total_point, self.n)
+        self.assertEqual(sampler.group_counts, GROUP_SIZES)
+        sizes = sampler.sampledf.groupby('z').size().to_dict()
+        self.assertEqual(sizes, {group: min(size, max(50, int(round(1000 * size / float(self.n)))))
+                                 for group, size in GROUP_SIZES.items()})
+        self.assertEqual(sampler.sampledf['id'].nunique(), len(sampler.sampledf))
+
+
+if __name__ == "__main__":
+    unittest.main()